@@ -0,0 +1,253 @@
+"""
+Post-processing benchmarks for FDM Smart Media Optimizer.
+
+Measures how fast extractor.py turns a yt-dlp info dict into FDM output.
+Fixtures are generated from a fixed seed, so runs are offline and
+comparable between commits:
+
+  youtube-300   - 300 mixed formats with YouTube-like URLs and headers
+  dash-10k      - 6 DASH formats with 10,000 fragments each
+  captions-150  - a few formats plus 150 auto-caption languages
+  playlist-500  - a 500-entry flat playlist
+
+Targets, each run once per profile (FASTEST, BALANCED, QUALITY):
+  process_single_entry - the whole single-entry branch
+  build_format         - build_format() over every format of the entry
+  playlist             - the playlist branch of build_output()
+
+Usage:
+  python benchmarks/bench_extractor.py [--repeat N] [--only TEXT]
+                                       [--json PATH] [--compare PATH]
+
+Reported per case: best and median wall time over N runs, memory blocks
+allocated by one call that are still alive afterwards (the result
+included) and peak traced memory during that call. --json saves the
+results, --compare prints the change against a saved run.
+"""
+
+import sys
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import extractor
+
+PROFILES = ("FASTEST", "BALANCED", "QUALITY")
+DEFAULT_REPEAT = 5
+SEED = 20240101
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-us,en;q=0.5",
+    "Sec-Fetch-Mode": "navigate",
+}
+
+
+# === FIXTURES ===
+
+def make_format(rng, index, kind, fragments=0):
+    """One yt-dlp format dict of the given kind ("video", "audio" or "combined")."""
+    host = f"https://rr{index % 8}---sn-bench.googlevideo.com"
+    f = {
+        "format_id": str(index),
+        "url": f"{host}/videoplayback?expire=1900000000&id=o-bench{index}&itag={index}&source=youtube",
+        "ext": rng.choice(["mp4", "webm", "m4a"]),
+        "protocol": "https",
+        "tbr": round(rng.uniform(48, 8000), 3),
+        "preference": rng.choice([None, -1, 0, 1]),
+        "http_headers": dict(HEADERS),
+    }
+    if kind == "audio":
+        f.update(vcodec="none", acodec=rng.choice(["mp4a.40.2", "opus"]),
+                 abr=rng.choice([48, 64, 128, 160]), language=rng.choice([None, "en", "en-US", "de", "ja"]))
+    elif kind == "video":
+        f.update(vcodec=rng.choice(["avc1.4d401f", "vp09.00.40.08", "av01.0.08M.08"]), acodec="none",
+                 height=rng.choice([144, 240, 360, 480, 720, 1080, 1440, 2160]), width=1920, fps=rng.choice([30, 60]))
+    else:
+        f.update(vcodec="avc1.42001E", acodec="mp4a.40.2", height=rng.choice([360, 720]), width=1280, fps=30)
+    if rng.random() < 0.3:
+        f["filesize"] = rng.randint(1024 * 1024, 4 * 1024 ** 3)
+
+    if fragments:
+        f["protocol"] = "http_dash_segments"
+        f["fragment_base_url"] = f"{host}/videoplayback/id/o-bench{index}/itag/{index}/"
+        f["fragments"] = [{"path": f"sq/{n}", "duration": 2.0} for n in range(fragments)]
+        f["fragments"][-1]["duration"] = 1.4
+    return f
+
+
+def make_entry(rng, formats, caption_languages=10):
+    captions = {}
+    for k in range(caption_languages):
+        lang = f"l{k:03d}" if k >= len(extractor.LANGUAGE_PREFERENCE) else list(extractor.LANGUAGE_PREFERENCE)[k]
+        captions[lang] = [
+            {"ext": ext, "url": f"https://www.youtube.com/api/timedtext?v=bench&lang={lang}&fmt={ext}", "name": lang}
+            for ext in ("json3", "srv1", "vtt", "ttml")
+        ]
+    return {
+        "id": "bench",
+        "title": "Benchmark entry",
+        "webpage_url": "https://www.youtube.com/watch?v=bench",
+        "duration": 3600,
+        "upload_date": "20240101",
+        "http_headers": dict(HEADERS),
+        "formats": formats,
+        "automatic_captions": captions,
+        "thumbnails": [{"url": f"https://i.ytimg.com/vi/bench/{k}.jpg", "height": rng.randint(90, 1080),
+                        "width": rng.randint(120, 1920)} for k in range(40)],
+    }
+
+
+def make_fixtures():
+    """All fixtures, rebuilt identically from SEED on every run."""
+    rng = random.Random(SEED)
+    kinds = ["video", "video", "audio", "combined"]
+    youtube = make_entry(rng, [make_format(rng, i, kinds[i % 4]) for i in range(300)])
+    dash = make_entry(rng, [make_format(rng, i, "audio" if i >= 4 else "video", fragments=10000) for i in range(6)])
+    captions = make_entry(rng, [make_format(rng, i, kinds[i % 4]) for i in range(12)], caption_languages=150)
+    playlist = {
+        "_type": "playlist",
+        "id": "PLbench",
+        "title": "Benchmark playlist",
+        "webpage_url": "https://www.youtube.com/playlist?list=PLbench",
+        "entries": [{"_type": "url", "id": f"v{k:05d}", "url": f"https://www.youtube.com/watch?v=v{k:05d}",
+                     "title": f"Video {k}", "duration": rng.randint(30, 7200),
+                     **({"filesize": rng.randint(1024 ** 2, 8 * 1024 ** 3)} if k % 10 == 0 else {})}
+                    for k in range(500)],
+        "thumbnails": [{"url": f"https://i.ytimg.com/pl/bench/{k}.jpg", "height": 90 * k, "width": 160 * k}
+                       for k in range(1, 6)],
+    }
+    return {"youtube-300": youtube, "dash-10k": dash, "captions-150": captions, "playlist-500": playlist}
+
+
+# === TARGETS ===
+
+def run_build_format(entry):
+    headers = extractor.build_entry_headers(entry)
+    return [extractor.build_format(f, entry, i, headers) for i, f in enumerate(entry["formats"])]
+
+
+TARGETS = {
+    "process_single_entry": extractor.process_single_entry,
+    "build_format": run_build_format,
+    "playlist": extractor.build_output,
+}
+
+CASES = [
+    ("youtube-300", "process_single_entry"),
+    ("youtube-300", "build_format"),
+    ("dash-10k", "process_single_entry"),
+    ("dash-10k", "build_format"),
+    ("captions-150", "process_single_entry"),
+    ("captions-150", "build_format"),
+    ("playlist-500", "playlist"),
+]
+
+
+# === MEASUREMENT ===
+
+def measure(func, arg, repeat):
+    """Wall times over repeat calls, then blocks/peak memory of one traced call."""
+    func(arg)  # Warm up caches and lazily compiled regexes
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        "bestMs": round(min(times) * 1000, 3),
+        "medianMs": round(statistics.median(times) * 1000, 3),
+        "blocks": blocks,
+        "peakKiB": round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(repeat, only=None):
+    fixtures = make_fixtures()
+    results = {}
+    for fixture_name, target in CASES:
+        for profile in PROFILES:
+            name = f"{fixture_name}/{target}/{profile}"
+            if only and only not in name:
+                continue
+            extractor.configure_request("https://www.youtube.com/watch?v=bench", profile,
+                                        config_override={"resultCache": False})
+            results[name] = measure(TARGETS[target], fixtures[fixture_name], repeat)
+    return results
+
+
+def format_change(new, old):
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def print_table(results, baseline=None):
+    header = f"{'case':<44} {'best ms':>10} {'median ms':>10} {'blocks':>9} {'peak KiB':>10}"
+    if baseline:
+        header += f" {'median':>8} {'peak':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        line = f"{name:<44} {r['bestMs']:>10.3f} {r['medianMs']:>10.3f} {r['blocks']:>9} {r['peakKiB']:>10.1f}"
+        if baseline:
+            old = baseline.get(name, {})
+            line += f" {format_change(r['medianMs'], old.get('medianMs')):>8} {format_change(r['peakKiB'], old.get('peakKiB')):>8}"
+        print(line)
+
+
+def parse_option(args, name, default=None):
+    """Read a --option value from the argument list."""
+    if name in args:
+        try:
+            return args[args.index(name) + 1]
+        except IndexError:
+            pass
+    return default
+
+
+def main():
+    args = sys.argv[1:]
+    try:
+        repeat = max(1, int(parse_option(args, "--repeat", DEFAULT_REPEAT)))
+    except ValueError:
+        print("--repeat needs a number")
+        sys.exit(1)
+    only = parse_option(args, "--only")
+    json_path = parse_option(args, "--json")
+    compare_path = parse_option(args, "--compare")
+
+    baseline = None
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)["cases"]
+
+    results = run_benchmarks(repeat, only)
+    print(f"Python {sys.version.split()[0]}, {repeat} runs per case")
+    print_table(results, baseline)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as fh:
+            json.dump({"python": sys.version.split()[0], "repeat": repeat, "cases": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
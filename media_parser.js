@@ -10,7 +10,15 @@ var LARGE_DOWNLOAD_CONFIG = {
   maxFormats: 50,                        // More format options for large files
   maxFragments: 10000,                   // Support up to 10k fragments (for long/large content)
   maxPlaylistEntries: 500,               // Support larger playlists
-  chunkSize: 10 * 1024 * 1024            // 10MB chunk size hint for FDM
+  chunkSize: 10 * 1024 * 1024,           // 10MB chunk size hint for FDM
+  useService: false,                     // Reuse a warm extractor_service.py between parses
+  compactFragments: true,                // Receive fragment templates, expanded here for FDM
+  compactHeaders: true,                  // Receive shared headers/cookies once per entry, expanded here
+  resolvePlaylistEntries: 0,             // Fully extract the first N playlist entries (0 = off)
+  resolveHlsFormats: 0,                  // Fetch the top N HLS media playlists for segment counts/sizes (0 = off)
+  streamPlaylist: false,                 // Playlists as NDJSON lines; keeps partial results on timeout
+  playlistPageSize: 0,                   // Entries per playlist page (0 = no paging, see _nextCursor)
+  syncPlaylist: false                    // Only return playlist entries not returned by earlier parses
 };
 
 // Dependency state tracking
@@ -107,6 +115,36 @@ function sanitizeString(str, maxLength) {
   return sanitized.substring(0, maxLength || 1024);
 }
 
+/**
+ * Whether a recent yt-dlp check result can be trusted without re-checking
+ */
+function isYtdlpCheckFresh() {
+  return ytdlpState.checked && (Date.now() - ytdlpState.lastCheckTime) < YTDLP_CHECK_CACHE_MS;
+}
+
+/**
+ * Record the "_runtime" block extractor.py reports in combined mode
+ */
+function recordRuntimeCheck(runtime) {
+  if (!runtime || !runtime.ytdlp) return;
+  ytdlpState.checked = true;
+  ytdlpState.installed = runtime.ytdlp.installed === true;
+  ytdlpState.version = runtime.ytdlp.version || null;
+  ytdlpState.lastCheckTime = Date.now();
+}
+
+/**
+ * Whether a failed extractor launch reported a missing yt-dlp
+ */
+function isDependencyMissing(result) {
+  if (result && result.errorCode === "DEPENDENCY_MISSING") return true;
+  try {
+    return JSON.parse(result.output).errorCode === "DEPENDENCY_MISSING";
+  } catch (e) {
+    return false;
+  }
+}
+
 /**
  * Check if yt-dlp is installed
  * @returns {Promise} Resolves with {installed: boolean, version: string|null}
@@ -114,8 +152,7 @@ function sanitizeString(str, maxLength) {
 function checkYtdlpInstalled(requestId, interactive) {
   return new Promise(function(resolve, reject) {
     // Use cached result if recent enough
-    var now = Date.now();
-    if (ytdlpState.checked && (now - ytdlpState.lastCheckTime) < YTDLP_CHECK_CACHE_MS) {
+    if (isYtdlpCheckFresh()) {
       resolve({
         installed: ytdlpState.installed,
         version: ytdlpState.version,
@@ -312,7 +349,7 @@ var msParser = {
   },
 
   parse: function (obj) {
-    return parseMedia(obj, false);
+    return parseMedia(obj, false, true);
   }
 };
 
@@ -385,7 +422,7 @@ var msBatchVideoParser = {
   },
 
   parse: function(obj) {
-    return parseMedia(obj, true);
+    return parseMedia(obj, true, true);
   }
 };
 
@@ -393,8 +430,11 @@ var msBatchVideoParser = {
  * Shared parsing logic for both single and playlist parsers
  * @param {object} obj - Parse request object
  * @param {boolean} isPlaylistContext - Whether called from playlist parser
+ * @param {boolean} combinedRuntimeCheck - When no fresh check_dependencies.py result exists, let
+ *   extractor.py check yt-dlp itself (runtimeCheck) instead of running the check first;
+ *   false always runs check_dependencies.py first
  */
-function parseMedia(obj, isPlaylistContext) {
+function parseMedia(obj, isPlaylistContext, combinedRuntimeCheck) {
   return new Promise(function (resolve, reject) {
     // Security: Validate URL before processing
     var validation = validateUrlSecurity(obj.url);
@@ -449,8 +489,20 @@ function parseMedia(obj, isPlaylistContext) {
       }
     } catch (e) {}
 
-    // First ensure yt-dlp is available
-    ensureYtdlpAvailable(obj.requestId, obj.interactive).then(function(ytdlpStatus) {
+    // With no fresh dependency check, let extractor.py check yt-dlp itself
+    // (one process launch instead of two); a missing yt-dlp comes back as
+    // DEPENDENCY_MISSING and goes through the regular check/install path
+    var combinedCheck = combinedRuntimeCheck && !isYtdlpCheckFresh();
+    var dependencyCheck = combinedCheck ?
+      Promise.resolve({ installed: true, preflight: true }) :
+      ensureYtdlpAvailable(obj.requestId, obj.interactive);
+
+    function retryWithDependencyCheck() {
+      ytdlpState.checked = false;
+      resolve(parseMedia(obj, isPlaylistContext, false));
+    }
+
+    dependencyCheck.then(function(ytdlpStatus) {
       if (ytdlpStatus.justInstalled) {
         console.log("yt-dlp was just installed (version " + ytdlpStatus.version + "). Proceeding with extraction...");
       }
@@ -545,6 +597,7 @@ function parseMedia(obj, isPlaylistContext) {
 
       var config = JSON.parse(JSON.stringify(LARGE_DOWNLOAD_CONFIG));
       config.isPlaylistContext = isPlaylistContext;
+      config.runtimeCheck = combinedCheck;
 
       var args = [
         obj.url,
@@ -572,9 +625,13 @@ function parseMedia(obj, isPlaylistContext) {
             return;
           }
 
-          var result = JSON.parse(res.output);
+          var result = parseExtractorOutput(res.output);
+          recordRuntimeCheck(result._runtime);
+          delete result._runtime;
           
-          if (result.error) {
+          if (result.error && combinedCheck && isDependencyMissing(result)) {
+            retryWithDependencyCheck();
+          } else if (result.error) {
             reject({ error: result.error, isParseError: true });
           } else {
             if (result.formats && !Array.isArray(result.formats)) {
@@ -587,9 +644,21 @@ function parseMedia(obj, isPlaylistContext) {
             }
             
             if (result.formats) {
+              expandHeaders(result);
+              expandFragments(result);
               result.formats = addLargeDownloadHints(result.formats);
             }
             
+            // Playlist entries resolved up front carry their own formats
+            var entries = result.entries || [];
+            for (var e = 0; e < entries.length; e++) {
+              if (entries[e] && Array.isArray(entries[e].formats)) {
+                expandHeaders(entries[e]);
+                expandFragments(entries[e]);
+                entries[e].formats = addLargeDownloadHints(entries[e].formats);
+              }
+            }
+            
             resolve(result);
           }
         } catch (e) {
@@ -597,6 +666,10 @@ function parseMedia(obj, isPlaylistContext) {
         }
       }).catch(function (err) {
         cleanup(); // Clean up temp file on error
+        if (combinedCheck && isDependencyMissing(err)) {
+          retryWithDependencyCheck();
+          return;
+        }
         reject({ error: err.error || "Extractor failed", isParseError: false });
       });
     }).catch(function(depErr) {
@@ -610,6 +683,156 @@ function parseMedia(obj, isPlaylistContext) {
   });
 }
 
+/**
+ * Parse extractor.py output: a single JSON object, or a playlist stream
+ * (header line, one line per entry, trailer line) written with streamPlaylist
+ */
+function parseExtractorOutput(output) {
+  var lines = output.split("\n");
+  var result = JSON.parse(lines[0]);
+  if (!result || !result._stream) {
+    return result;
+  }
+
+  delete result._stream;
+  result.entries = [];
+  var ended = false;
+  for (var i = 1; i < lines.length; i++) {
+    if (!lines[i]) continue;
+    var line;
+    try {
+      line = JSON.parse(lines[i]);
+    } catch (e) {
+      break; // Cut off mid-line - keep what arrived intact
+    }
+    if (line._streamEnd) {
+      delete line._streamEnd;
+      for (var key in line) {
+        if (line.hasOwnProperty(key)) {
+          result[key] = line[key];
+        }
+      }
+      ended = true;
+      break;
+    }
+    result.entries.push(line);
+  }
+
+  if (!ended) {
+    result._entriesIncluded = result.entries.length;
+    result._truncated = "incomplete";
+  }
+  return result;
+}
+
+/**
+ * Copy entry-level httpHeaders and cookies (see compactHeaders in
+ * extractor.py) into every format; a format's own headers take precedence
+ */
+function expandHeaders(result) {
+  var shared = result.httpHeaders;
+  var cookies = result.cookies;
+  var formats = result.formats || [];
+  for (var i = 0; i < formats.length; i++) {
+    var fmt = formats[i];
+    if (shared) {
+      var headers = {};
+      var key;
+      for (key in shared) {
+        if (shared.hasOwnProperty(key)) {
+          headers[key] = shared[key];
+        }
+      }
+      var own = fmt.httpHeaders || {};
+      for (key in own) {
+        if (own.hasOwnProperty(key)) {
+          headers[key] = own[key];
+        }
+      }
+      fmt.httpHeaders = headers;
+    }
+    if (cookies && fmt.cookies === undefined) {
+      fmt.cookies = cookies;
+    }
+  }
+  delete result.httpHeaders;
+  delete result.cookies;
+  return result;
+}
+
+/**
+ * Expand compact fragment templates and shared fragment lists
+ * (see compact_fragments() in extractor.py) into plain fragment arrays
+ */
+function expandFragments(result) {
+  var shared = result.fragmentLists || {};
+  var formats = result.formats || [];
+  for (var i = 0; i < formats.length; i++) {
+    var fmt = formats[i];
+    var source = fmt.fragmentTemplate;
+    if (fmt.fragmentsRef !== undefined) {
+      source = shared[fmt.fragmentsRef];
+      delete fmt.fragmentsRef;
+    }
+    delete fmt.fragmentTemplate;
+    if (!source) continue;
+    fmt.fragments = Array.isArray(source) ? source.slice() : expandFragmentTemplate(source);
+  }
+  delete result.fragmentLists;
+  return result;
+}
+
+/**
+ * Expand one fragment template: {n} runs from start in step increments,
+ * skipping gaps, until count fragments exist; exceptions override by index
+ */
+function expandFragmentTemplate(template) {
+  var fragments = [];
+  var count = Math.min(template.count || 0, LARGE_DOWNLOAD_CONFIG.maxFragments);
+  if (!(template.step > 0) || typeof template.pattern !== "string") {
+    return fragments;
+  }
+
+  var gaps = {};
+  var gapList = template.gaps || [];
+  for (var i = 0; i < gapList.length; i++) {
+    gaps[gapList[i]] = true;
+  }
+
+  var hasDuration = template.duration !== undefined && template.duration !== null;
+  var n = template.start || 0;
+  while (fragments.length < count) {
+    if (!gaps[n]) {
+      var number = String(n);
+      while (template.width && number.length < template.width) {
+        number = "0" + number;
+      }
+      var frag = { path: template.pattern.replace("{n}", number) };
+      if (hasDuration) {
+        frag.duration = template.duration;
+      }
+      fragments.push(frag);
+    }
+    n += template.step;
+  }
+
+  var exceptions = template.exceptions || [];
+  for (var j = 0; j < exceptions.length; j++) {
+    var exception = exceptions[j];
+    var target = fragments[exception.index];
+    if (!target) continue;
+    if (exception.path !== undefined) {
+      target.path = exception.path;
+    }
+    if (exception.duration === null) {
+      delete target.duration;
+    } else if (exception.duration !== undefined) {
+      target.duration = exception.duration;
+    }
+  }
+  return fragments;
+}
+
 /**
  * Add hints for large download handling
  * Adds range request support and chunking hints for FDM
@@ -8,16 +8,36 @@ Commands:
   check   - Check if yt-dlp is installed
   install - Install yt-dlp via pip (use --upgrade for updates)
   status  - Full status report (Python, pip, yt-dlp)
+  startup - Time a cold extractor.py start (use --budget MS, default 1000)
+
+Checks read the version from package metadata when yt-dlp is importable
+and remember the result in a stamp file keyed by the yt-dlp executable's
+path and mtime, so `yt-dlp --version` only runs when that stamp is stale.
+
+yt-dlp loads its extractor registry (well over a thousand classes) from
+yt_dlp/extractor/lazy_extractors.py when that module exists, importing
+only the extractor a URL needs. Release wheels ship it; `check` and
+`install` generate it for source installs that lack it or have a stale one.
 """
 
 import sys
 import json
 import subprocess
 import os
+import shutil
+import stat
+import tempfile
+import time
 
 # Consistent timeout values
 TIMEOUT_VERSION_CHECK = 15
 TIMEOUT_INSTALL = 300  # 5 minutes, matching extractor.py
+TIMEOUT_LAZY_EXTRACTORS = 120
+TIMEOUT_STARTUP = 60
+
+# Cold-start budget for importing extractor.py, yt-dlp and its extractor registry
+DEFAULT_STARTUP_BUDGET_MS = 1000
+SLOWEST_IMPORTS = 10
 
 # Minimum recommended yt-dlp version (YYYY.MM.DD format)
 MIN_RECOMMENDED_VERSION = "2024.01.01"
@@ -51,8 +71,200 @@ def get_python_info():
     }
 
 
-def check_ytdlp():
-    """Check if yt-dlp is installed and get version."""
+def get_stamp_path():
+    """Per-user stamp file holding the last check result."""
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(tempfile.gettempdir(), f"fdm-smo-deps-{uid}.json")
+
+
+def get_stamp_key():
+    """Identify the current yt-dlp install: interpreter, executable path and mtime, lazy extractors."""
+    executable = shutil.which("yt-dlp")
+    key = {"python": sys.executable, "executable": executable}
+    if executable:
+        try:
+            st = os.stat(executable)
+            key["mtime"] = st.st_mtime_ns
+            key["size"] = st.st_size
+        except OSError:
+            pass
+    package_dir = get_package_dir()
+    if package_dir:
+        # Regenerating the lazy module or updating a source checkout changes these
+        key["lazyMtimes"] = [get_mtime(path) for path in get_registry_paths(package_dir)]
+    return key
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def is_private_file(st):
+    """Whether a stat result is a regular file only this user can write."""
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    if not hasattr(os, "getuid"):
+        return True  # Windows temp directories are already per-user
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def read_stamp(key):
+    """Return the stamped check result if it was recorded for the same install.
+
+    The stamp sits in the shared temp directory, so one another user could
+    have planted (or could still rewrite) is ignored.
+    """
+    try:
+        fd = os.open(get_stamp_path(), os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        with os.fdopen(fd, "r", encoding="utf-8") as fh:
+            if not is_private_file(os.fstat(fd)):
+                return None
+            stamp = json.load(fh)
+        if stamp.get("key") == key and stamp.get("result", {}).get("installed"):
+            return stamp["result"]
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def write_stamp(key, result):
+    """Atomically record a successful check result."""
+    path = get_stamp_path()
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".fdm-smo-deps-")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump({"key": key, "result": result}, fh)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def clear_stamp():
+    try:
+        os.unlink(get_stamp_path())
+    except OSError:
+        pass
+
+
+def get_metadata_version():
+    """Read the yt-dlp version from this interpreter's package metadata, without importing it."""
+    try:
+        from importlib import metadata
+        return metadata.version("yt-dlp")
+    except Exception:
+        return None
+
+
+def get_package_dir():
+    """Directory of this interpreter's yt_dlp package, found without importing it."""
+    try:
+        from importlib.util import find_spec
+        spec = find_spec("yt_dlp")
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return list(spec.submodule_search_locations)[0]
+
+
+def get_registry_paths(package_dir):
+    """yt-dlp's lazy extractor module and the full extractor list it is generated from."""
+    extractor_dir = os.path.join(package_dir, "extractor")
+    registry = os.path.join(extractor_dir, "_extractors.py")
+    if not os.path.isfile(registry):
+        registry = os.path.join(extractor_dir, "extractors.py")  # Older yt-dlp releases
+    return os.path.join(extractor_dir, "lazy_extractors.py"), registry
+
+
+def get_lazy_generator(package_dir):
+    """yt-dlp's make_lazy_extractors.py, present only when running from a source checkout."""
+    script = os.path.join(os.path.dirname(package_dir), "devscripts", "make_lazy_extractors.py")
+    return script if os.path.isfile(script) else None
+
+
+def check_lazy_extractors():
+    """Whether yt-dlp will load its extractor registry lazily.
+
+    A source checkout can generate the module and may have an older one
+    than its extractor list; a wheel install ships a matching one or none.
+    """
+    package_dir = get_package_dir()
+    if not package_dir:
+        return {"present": False, "stale": False, "canGenerate": False, "path": None}
+    path, registry = get_registry_paths(package_dir)
+    generator = get_lazy_generator(package_dir)
+    present = os.path.isfile(path)
+    stale = bool(present and generator and (get_mtime(registry) or 0) > get_mtime(path))
+    return {"present": present, "stale": stale, "canGenerate": bool(generator), "path": path}
+
+
+def ensure_lazy_extractors():
+    """Generate yt-dlp's lazy extractor module when it is missing or stale and can be built."""
+    status = check_lazy_extractors()
+    if (status["present"] and not status["stale"]) or not status["canGenerate"]:
+        return status
+
+    package_dir = get_package_dir()
+    # The generator must see the full registry, not an existing lazy module
+    env = dict(os.environ, YTDLP_NO_LAZY_EXTRACTORS="1", YTDLP_NO_PLUGINS="1")
+    try:
+        result = subprocess.run(
+            [sys.executable, get_lazy_generator(package_dir), status["path"]],
+            cwd=os.path.dirname(package_dir),
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=TIMEOUT_LAZY_EXTRACTORS,
+            shell=False
+        )
+        error = (result.stderr.strip()[-300:] or "Unknown error") if result.returncode != 0 else None
+    except subprocess.TimeoutExpired:
+        error = "Generating lazy extractors timed out"
+    except Exception as e:
+        error = str(e)[:200]
+
+    status = check_lazy_extractors()
+    status["generated"] = error is None and status["present"]
+    if error:
+        status["error"] = error
+    return status
+
+
+def check_ytdlp(use_stamp=True):
+    """Check if yt-dlp is installed and get version.
+
+    Tries the stamp, then package metadata, and only then runs the
+    executable. Successful results are stamped for the next check.
+    """
+    key = get_stamp_key()
+    if use_stamp:
+        stamped = read_stamp(key)
+        if stamped:
+            return dict(stamped, source="stamp")
+
+    version = get_metadata_version()
+    if version:
+        result = {
+            "installed": True,
+            "version": version,
+            "versionAdequate": is_version_adequate(version),
+            "minRecommended": MIN_RECOMMENDED_VERSION,
+            "error": None,
+            "source": "metadata",
+            "lazyExtractors": check_lazy_extractors()
+        }
+    else:
+        result = probe_ytdlp_executable()
+    if result["installed"]:
+        write_stamp(key, result)
+    return result
+
+
+def probe_ytdlp_executable():
+    """Run `yt-dlp --version` (slow path: a full interpreter start plus import)."""
     try:
         result = subprocess.run(
             ["yt-dlp", "--version"],
@@ -68,7 +280,8 @@ def check_ytdlp():
                 "version": version,
                 "versionAdequate": is_version_adequate(version),
                 "minRecommended": MIN_RECOMMENDED_VERSION,
-                "error": None
+                "error": None,
+                "source": "executable"
             }
         return {
             "installed": False,
@@ -111,14 +324,18 @@ def install_ytdlp(upgrade=False):
             shell=False
         )
         
+        # The installed version changed, whatever the stamp says
+        clear_stamp()
         if result.returncode == 0:
+            lazy = ensure_lazy_extractors()
             # Verify installation
-            check = check_ytdlp()
+            check = check_ytdlp(use_stamp=False)
             return {
                 "success": True,
                 "message": "yt-dlp installed successfully",
                 "version": check.get("version"),
                 "versionAdequate": check.get("versionAdequate", False),
+                "lazyExtractors": lazy,
                 "output": result.stdout[-500:] if result.stdout else None
             }
         else:
@@ -144,6 +361,94 @@ def install_ytdlp(upgrade=False):
         }
 
 
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import extractor
+imported = time.perf_counter()
+ytdlp = extractor.load_ytdlp_module()
+loaded = time.perf_counter()
+lazy = None
+if ytdlp is not None:
+    ytdlp.YoutubeDL({"quiet": True, "no_warnings": True}).close()
+    try:
+        from yt_dlp.globals import LAZY_EXTRACTORS
+        lazy = LAZY_EXTRACTORS.value
+    except ImportError:
+        lazy = getattr(sys.modules.get("yt_dlp.extractor"), "_LAZY_LOADER", None)
+registry = time.perf_counter()
+print(json.dumps({
+    "extractor": (imported - started) * 1000,
+    "ytdlp": (loaded - imported) * 1000,
+    "registry": (registry - loaded) * 1000,
+    "ytdlpAvailable": ytdlp is not None,
+    "lazyLoaded": lazy,
+}))
+"""
+
+
+def parse_importtime(stderr):
+    """Slowest imports from `python -X importtime` output, by cumulative time."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            imports.append((int(cumulative), module.strip()))
+        except ValueError:
+            continue  # Header line
+    imports.sort(reverse=True)
+    return [{"module": module, "cumulativeMs": round(us / 1000, 1)} for us, module in imports[:SLOWEST_IMPORTS]]
+
+
+def measure_startup(budget_ms=DEFAULT_STARTUP_BUDGET_MS):
+    """Time a cold start of extractor.py up to a ready yt-dlp, in a fresh interpreter.
+
+    Phases: interpreter start, importing extractor.py, importing yt_dlp and
+    building a YoutubeDL (which loads the extractor registry). Fails when
+    the probe couldn't import yt-dlp.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_PROBE, script_dir],
+            capture_output=True,
+            text=True,
+            timeout=TIMEOUT_STARTUP,
+            shell=False
+        )
+    except subprocess.TimeoutExpired:
+        return {"success": False, "error": f"Startup took longer than {TIMEOUT_STARTUP} seconds"}
+    total_ms = (time.perf_counter() - started) * 1000
+
+    try:
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return {"success": False, "error": result.stderr.strip()[-300:] or "Startup probe failed"}
+
+    phases = {name: probe[name] for name in ("extractor", "ytdlp", "registry")}
+    phases["interpreter"] = max(0.0, total_ms - sum(phases.values()))
+    # Without yt-dlp the run skipped its most expensive phases, so the
+    # numbers say nothing about a real cold start
+    output = {
+        "success": probe["ytdlpAvailable"],
+        "totalMs": round(total_ms, 1),
+        "budgetMs": budget_ms,
+        "withinBudget": probe["ytdlpAvailable"] and total_ms <= budget_ms,
+        "phasesMs": {name: round(ms, 1) for name, ms in phases.items()},
+        "ytdlpAvailable": probe["ytdlpAvailable"],
+        "lazyExtractorsLoaded": probe["lazyLoaded"],
+        "lazyExtractors": check_lazy_extractors(),
+        "slowestImports": parse_importtime(result.stderr),
+    }
+    if not probe["ytdlpAvailable"]:
+        output["error"] = "yt-dlp could not be imported, so only extractor.py's own start was timed"
+    return output
+
+
 def check_pip():
     """Check if pip is available."""
     try:
@@ -172,13 +477,18 @@ def check_pip():
 
 def main():
     if len(sys.argv) < 2:
-        print(json.dumps({"error": "No command provided. Use: check, install, or status"}))
+        print(json.dumps({"error": "No command provided. Use: check, install, status, or startup"}))
         sys.exit(1)
     
     command = sys.argv[1].lower()
     
     if command == "check":
         result = check_ytdlp()
+        if result["installed"]:
+            lazy = result.get("lazyExtractors")
+            if lazy and (not lazy["present"] or lazy["stale"]) and lazy["canGenerate"]:
+                lazy = ensure_lazy_extractors()
+                result = dict(check_ytdlp(use_stamp=False), lazyExtractors=lazy)
         print(json.dumps(result))
         sys.exit(0 if result["installed"] else 1)
     
@@ -200,16 +510,31 @@ def main():
         sys.exit(0 if result["success"] else 1)
     
     elif command == "status":
-        result = {
-            "python": get_python_info(),
-            "pip": check_pip(),
-            "ytdlp": check_ytdlp()
-        }
+        # The pip and yt-dlp probes are independent subprocesses. Imported
+        # here: extractor.py imports this module on its cold start
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pip_future = pool.submit(check_pip)
+            ytdlp_future = pool.submit(check_ytdlp)
+            result = {
+                "python": get_python_info(),
+                "pip": pip_future.result(),
+                "ytdlp": ytdlp_future.result()
+            }
         print(json.dumps(result, indent=2))
         sys.exit(0)
+
+    elif command == "startup":
+        try:
+            budget = float(sys.argv[sys.argv.index("--budget") + 1]) if "--budget" in sys.argv else DEFAULT_STARTUP_BUDGET_MS
+        except (IndexError, ValueError):
+            budget = DEFAULT_STARTUP_BUDGET_MS
+        result = measure_startup(budget)
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result["success"] and result["withinBudget"] else 1)
     
     else:
-        print(json.dumps({"error": f"Unknown command: {command}. Use: check, install, or status"}))
+        print(json.dumps({"error": f"Unknown command: {command}. Use: check, install, status, or startup"}))
         sys.exit(1)
 
 
@@ -1,5 +1,16 @@
-import sys, json, subprocess, os, re
-from urllib.parse import urlparse
+import sys, json, os, re, shutil, stat, tempfile, threading, time, hashlib, heapq, queue
+import contextlib
+from collections import Counter
+from urllib.parse import urlparse, parse_qsl, urlencode
+# subprocess, socket, calendar, base64 and concurrent.futures are imported
+# where they are used: a run needs at most a few of them, and every module
+# imported here is paid for on each cold start
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # === LARGE DOWNLOAD CONFIGURATION ===
 
@@ -10,15 +21,219 @@ DEFAULT_LARGE_CONFIG = {
     "maxFormats": 50,
     "maxFragments": 10000,
     "maxPlaylistEntries": 500,
-    "chunkSize": 10 * 1024 * 1024
+    "chunkSize": 10 * 1024 * 1024,
+    "engine": "auto",                      # "auto" (in-process yt_dlp if importable) or "subprocess"
+    "useService": False,                   # Route requests through the warm extractor_service.py
+    "resultCache": True,                   # Reuse results until their signed URLs expire
+    "cacheTtl": 1800,                      # Seconds to keep results without a known URL expiry
+    "cacheNegativeTtl": 300,               # Seconds to remember permanent failures
+    "cacheMaxBytes": 64 * 1024 * 1024,     # LRU size bound of the on-disk cache
+    "compactFragments": True,              # Emit fragment templates instead of expanded lists
+    "compactHeaders": True,                # Emit shared headers/cookies once per entry, not per format
+    "coalesceByteRanges": True,            # Single-file byte-range fragments become one file URL
+    "subtitleLanguages": None,             # Subtitle languages to keep (None = LANGUAGE_PREFERENCE keys, "all")
+    "maxThumbnails": 20,                   # Thumbnails kept per video
+    "lazyFragments": False,                # Expand fragments only for the top video/audio picks
+    "resolveFormat": None,                 # Return only this format ID, fragments fully expanded
+    "refreshFormat": None,                 # Return only a fresh URL/headers for this format ID (no cache)
+    "extractionPlans": {},                 # Per-site/profile yt-dlp extractor args, merged over the defaults
+    "maxConcurrentExtractions": 4,         # yt-dlp runs at once across all processes (0 = no limit)
+    "maxSiteExtractions": 2,               # ...and per site domain
+    "singleFlight": True,                  # Concurrent identical requests share one extraction
+    "batchWorkers": 4,                     # URLs extracted at once in --batch mode
+    "batchStream": False,                  # --batch: one NDJSON line per URL as it finishes
+    "resolvePlaylistEntries": 0,           # Fully extract the first N playlist entries (0 = off)
+    "playlistWorkers": 4,                  # Concurrent entry extractions
+    "perHostConcurrency": 2,               # Concurrent entry extractions per host
+    "entryTimeout": 60,                    # Seconds per entry before falling back to its bare URL
+    "resolveHlsFormats": 0,                # Fetch the top N HLS media playlists for segment counts/sizes (0 = off)
+    "hlsPlaylistTimeout": 5,               # Seconds per media playlist fetch
+    "streamPlaylist": False,               # Write playlists as NDJSON lines while they're enumerated
+    "playlistOffset": 0,                   # First playlist entry of a page (0-based)
+    "playlistPageSize": 0,                 # Entries per page (0 = no paging)
+    "playlistCursor": None,                # Opaque "_nextCursor" from a previous page
+    "syncPlaylist": False,                 # Return only entries not returned by earlier syncs
+    "syncStopAfterKnown": 5,               # Consecutive known entries that end a sync (0 = scan all)
+    "syncArchiveSize": 10000,              # Entry IDs remembered per playlist
+    "runtimeCheck": False,                 # Report yt-dlp availability/version in a "_runtime" block
+    "timings": False,                      # Add a "_timings" block (phase times, byte sizes, counts)
+    "profileDump": False                   # Write a cProfile dump of the run, path in "_profile"
 }
 
-# Will be updated from command line args if provided
-LARGE_CONFIG = DEFAULT_LARGE_CONFIG.copy()
+
+class ActiveRequest(threading.local):
+    """Per-request state used by the output builders, kept per thread.
+
+    configure_settings() puts a request's config, profile, user agent,
+    cookie string and Timings in its request dict and makes them active
+    on the calling thread; use_request() does the same on worker threads.
+    Requests on different threads (the warm service, batches) so never
+    see each other's settings.
+    """
+
+    def __init__(self):
+        self.config = DEFAULT_LARGE_CONFIG.copy()
+        self.profile = "BALANCED"
+        self.user_agent = None
+        self.cookies_string = ""
+        # None when the "timings" option is off; hot paths check for None
+        # directly so disabled timing costs nothing
+        self.timings = None
+
+
+active = ActiveRequest()
+
+
+class ActiveConfig:
+    """The active request's config dict; reads and writes go to this thread's request."""
+
+    def __getattr__(self, name):
+        return getattr(active.config, name)
+
+    def __getitem__(self, key):
+        return active.config[key]
+
+    def __setitem__(self, key, value):
+        active.config[key] = value
+
+    def __contains__(self, key):
+        return key in active.config
+
+    def __iter__(self):
+        return iter(active.config)
+
+
+# Defaults plus the request's config override (set by configure_request)
+LARGE_CONFIG = ActiveConfig()
+
+
+def activate(request):
+    """Make a configured request's state the active one on this thread."""
+    vars(active).update(request["state"])
+
+
+@contextlib.contextmanager
+def use_request(request):
+    """Make a configured request's state active on this thread for the block."""
+    saved = dict(vars(active))
+    if "state" in request:
+        activate(request)
+    try:
+        yield
+    finally:
+        vars(active).update(saved)
+
+
+class ExtractionError(Exception):
+    """A request failure whose message is safe to return to the plugin."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# === INSTRUMENTATION ===
+
+class Timings:
+    """Phase durations, byte sizes and counters for one request.
+
+    Phases may nest (e.g. "validateFragments" runs inside "build") and
+    repeated phases add up, so they are not meant to sum to "total".
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.bytes = {}
+        self.counts = Counter()
+
+    def add(self, name, started):
+        """Add the time since started (a perf_counter() value) to a phase."""
+        self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started)
+
+    def to_dict(self):
+        phases = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        phases["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return {"phasesMs": phases, "bytes": dict(self.bytes), "counts": dict(self.counts)}
+
+
+# Outputs are only read by the plugin, so skip the cosmetic spaces
+OUTPUT_SEPARATORS = (",", ":")
+
+
+def dump_output(obj):
+    """Serialize an output object as compact JSON."""
+    return json.dumps(obj, separators=OUTPUT_SEPARATORS)
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def timed(name):
+    """Time a phase of the active request; a shared no-op context when timings are off."""
+    timings = active.timings
+    return timings.phase(name) if timings is not None else _NO_PHASE
+
+
+def start_profile():
+    """Start a cProfile run and reserve the temp file its stats will be dumped to."""
+    import cProfile
+
+    fd, path = tempfile.mkstemp(prefix="fdm-smo-profile-", suffix=".pstats")
+    os.close(fd)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler, path
+
+
+def finish_profile(profiler, path):
+    """Stop a run started by start_profile() and write its pstats dump."""
+    profiler.disable()
+    try:
+        profiler.dump_stats(path)
+    except OSError:
+        pass
 
 
 # === SECURITY VALIDATION ===
 
+# Characters that could enable command injection or path traversal
+DANGEROUS_URL_PATTERNS = [
+    r'[;\|&`$]',           # Shell metacharacters
+    r'\$\(',               # Command substitution
+    r'`',                  # Backtick execution
+    r'\.\.',               # Path traversal
+    r'[\x00-\x1f\x7f]',    # Control characters
+]
+_DANGEROUS_URL_RES = [(pattern, re.compile(pattern)) for pattern in DANGEROUS_URL_PATTERNS]
+
+# Local/private hostnames that must never be requested
+PRIVATE_HOST_PATTERNS = [
+    r'^localhost$',
+    r'^127\.',
+    r'^10\.',
+    r'^192\.168\.',
+    r'^172\.(1[6-9]|2[0-9]|3[01])\.',
+    r'^0\.0\.0\.0$',
+    r'^\[::1\]$',
+    r'^file://',
+]
+_PRIVATE_HOST_RES = [re.compile(pattern) for pattern in PRIVATE_HOST_PATTERNS]
+
+# All dangerous URL/fragment characters in one pass (union of the above
+# shell, traversal and control-character checks)
+_UNSAFE_CHARS_RE = re.compile(r'[;|&`$\x00-\x1f\x7f]|\.\.')
+_URL_ORIGIN_RE = re.compile(r'^https?://[^/?#]*')
+
+
 def is_safe_url(url):
     """Validate URL to prevent command injection and malicious schemes."""
     if not url or not isinstance(url, str):
@@ -29,15 +244,8 @@ def is_safe_url(url):
         return False, "URL exceeds maximum length (4096 characters)"
     
     # Reject dangerous characters that could enable command injection
-    dangerous_patterns = [
-        r'[;\|&`$]',           # Shell metacharacters
-        r'\$\(',               # Command substitution
-        r'`',                  # Backtick execution
-        r'\.\.',               # Path traversal
-        r'[\x00-\x1f\x7f]',    # Control characters
-    ]
-    for pattern in dangerous_patterns:
-        if re.search(pattern, url):
+    for pattern, compiled in _DANGEROUS_URL_RES:
+        if compiled.search(url):
             return False, f"URL contains potentially dangerous characters (pattern: {pattern})"
     
     try:
@@ -52,18 +260,8 @@ def is_safe_url(url):
         
         # Reject local/private addresses
         hostname = parsed.netloc.split(':')[0].lower()
-        private_patterns = [
-            r'^localhost$',
-            r'^127\.',
-            r'^10\.',
-            r'^192\.168\.',
-            r'^172\.(1[6-9]|2[0-9]|3[01])\.',
-            r'^0\.0\.0\.0$',
-            r'^\[::1\]$',
-            r'^file://',
-        ]
-        for pattern in private_patterns:
-            if re.match(pattern, hostname):
+        for compiled in _PRIVATE_HOST_RES:
+            if compiled.match(hostname):
                 return False, "WARNING: URL points to local/private network. This could be a security risk attempting to access internal resources."
         
         return True, None
@@ -144,143 +342,690 @@ def is_safe_fragment_path(path, base_url=None):
     return True, None
 
 
-# === MAIN EXECUTION ===
+def fragment_path(frag, base_url):
+    """A fragment's path as validated and output: relative to base_url when under it."""
+    frag_url = frag.get("url", "")
+    frag_path = frag.get("path", "")
+    if frag_url and base_url and frag_url.startswith(base_url):
+        return frag_url[len(base_url):]
+    if frag_url and not frag_path:
+        return frag_url
+    return frag_path
+
+
+def validate_fragment_paths(paths, base_url=None):
+    """Validate a format's fragment paths in one pass.
+
+    Accepts exactly what is_safe_fragment_path(path, base_url) accepts, but
+    the base URL and each distinct absolute-URL host are validated once
+    instead of once per fragment. Returns (accepted_indices, skipped_count).
+    """
+    accepted = []
+    skipped = 0
+    base = base_url.rstrip('/') + '/' if base_url else None
+    # Joined URLs share the base's scheme and host, so one check covers them
+    base_valid = is_safe_url(base)[0] if base else True
+    origin_verdicts = {}
+
+    for i, path in enumerate(paths):
+        if (not path or not isinstance(path, str) or len(path) > 4096
+                or _UNSAFE_CHARS_RE.search(path)):
+            skipped += 1
+            continue
 
-if len(sys.argv) < 2:
-    print(json.dumps({"error": "No URL provided"}))
-    sys.exit(1)
+        if path.startswith(('http://', 'https://')):
+            origin = _URL_ORIGIN_RE.match(path).group(0)
+            valid = origin_verdicts.get(origin)
+            if valid is None:
+                valid = origin_verdicts[origin] = is_safe_url(origin + '/')[0]
+        elif base:
+            valid = base_valid and len(base) + len(path.lstrip('/')) <= 4096
+        else:
+            valid = True
+
+        if valid:
+            accepted.append(i)
+        else:
+            skipped += 1
+    return accepted, skipped
+
+
+# === EXTRACTION ENGINES ===
+
+# yt-dlp extractor arguments per extractor key and profile. Each profile
+# skips fetching what score_format() would only throw away: FASTEST never
+# picks DASH/HLS manifest formats and BALANCED rarely picks HLS ones.
+# Arguments for other sites' extractors are simply ignored by yt-dlp.
+DEFAULT_EXTRACTION_PLANS = {
+    "youtube": {
+        "FASTEST": {"skip": ["dash", "hls", "translated_subs"]},
+        "BALANCED": {"skip": ["hls"]},
+        "QUALITY": {},
+    },
+}
 
-# Validate and sanitize all inputs
-try:
-    url = sys.argv[1]
-    url_valid, url_error = is_safe_url(url)
-    if not url_valid:
-        print(json.dumps({"error": f"Security: {url_error}"}))
-        sys.exit(1)
-    
-    profile = validate_profile(sys.argv[2] if len(sys.argv) > 2 else "BALANCED")
-    cookies_file = sanitize_string_arg(sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] else None, "cookies_file", 1024)
-    cookies_string = sanitize_string_arg(sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] else "", "cookies_string", 8192)
-    proxy_url = sanitize_string_arg(sys.argv[5] if len(sys.argv) > 5 and sys.argv[5] else None, "proxy_url", 512)
-    user_agent = sanitize_string_arg(sys.argv[6] if len(sys.argv) > 6 and sys.argv[6] else None, "user_agent", 512)
-    
-    # Parse large download configuration if provided
-    if len(sys.argv) > 7 and sys.argv[7]:
-        try:
-            config_override = json.loads(sys.argv[7])
-            LARGE_CONFIG.update(config_override)
-        except json.JSONDecodeError:
-            pass  # Use defaults if parsing fails
-    
-    # Validate proxy URL if provided
-    if proxy_url:
-        proxy_valid, proxy_error = is_safe_url(proxy_url.replace("socks5://", "http://").replace("socks4://", "http://"))
-        if not proxy_valid and "scheme" not in (proxy_error or ""):
-            print(json.dumps({"error": f"Security: Invalid proxy URL - {proxy_error}"}))
-            sys.exit(1)
-
-except ValueError as e:
-    print(json.dumps({"error": f"Security: {e}"}))
-    sys.exit(1)
-
-# Extraction timeout from config
-extraction_timeout = LARGE_CONFIG.get("extractionTimeout", 300)
-
-# Check if this looks like a playlist URL
-is_playlist_url = any(pattern in url.lower() for pattern in [
-    'list=', '/playlist/', '/album/', '/channel/', '/user/', '/c/', '/sets/', '/@'
-])
-
-# Get playlist context from config
-is_playlist_context = LARGE_CONFIG.get("isPlaylistContext", False)
-
-cmd = [
-    "yt-dlp",
-    "-J",
-    "--no-warnings",
-    "--socket-timeout", "60",           # Increased for large files
-    "--extractor-retries", "5",         # More retries for reliability
-    "--ignore-errors",
-    "--no-exec",           # Prevent execution of external commands
-    "--no-batch-file",     # Prevent reading batch files
-    "--no-download",       # Ensure we're only extracting info
-]
+# Sites a plan's extractor key handles besides <key>.<tld>
+PLAN_SITE_HOSTS = {
+    "youtube": ("youtube.com", "youtu.be", "youtube-nocookie.com"),
+}
+
+# Extractor keys/argument names, and values the --extractor-args syntax can carry
+PLAN_NAME_PATTERN = re.compile(r'^[a-z0-9_]{1,64}$')
+PLAN_VALUE_PATTERN = re.compile(r'^[A-Za-z0-9_.:+-]{1,128}$')
+
+
+def extraction_plan(profile_name):
+    """yt-dlp extractor_args for a profile: the defaults with extractionPlans applied.
+
+    extractionPlans entries replace the default arguments of a site's
+    profile, e.g. {"youtube": {"FASTEST": {"player_client": ["tv"]}}};
+    an empty dict turns the plan off. Raises ExtractionError on names or
+    values that can't be passed to yt-dlp safely.
+    """
+    plans = {site: dict(profiles) for site, profiles in DEFAULT_EXTRACTION_PLANS.items()}
+    overrides = LARGE_CONFIG.get("extractionPlans") or {}
+    if not isinstance(overrides, dict):
+        raise ExtractionError("Security: extractionPlans must be an object")
+    for site, profiles in overrides.items():
+        if not isinstance(profiles, dict):
+            raise ExtractionError(f"Security: Invalid extraction plan for {sanitize_text_output(str(site), 64)}")
+        plans.setdefault(site, {}).update(profiles)
+
+    extractor_args = {}
+    for site, profiles in plans.items():
+        args = profiles.get(profile_name) or {}
+        if not args:
+            continue
+        if not PLAN_NAME_PATTERN.match(str(site)) or not isinstance(args, dict):
+            raise ExtractionError(f"Security: Invalid extraction plan for {sanitize_text_output(str(site), 64)}")
+        for name, values in args.items():
+            if (not PLAN_NAME_PATTERN.match(str(name)) or not isinstance(values, list)
+                    or not all(isinstance(v, str) and PLAN_VALUE_PATTERN.match(v) for v in values)):
+                raise ExtractionError(f"Security: Invalid extraction plan argument {sanitize_text_output(str(name), 64)}")
+        extractor_args[site] = {name: list(values) for name, values in args.items()}
+    return extractor_args
+
+
+def plan_for_url(extractor_args, url):
+    """The part of extractor_args meant for the extractor that handles url.
+
+    yt-dlp would ignore the rest, but a plan also turns on
+    ignore_no_formats_error and the retry without it, which only make
+    sense on the site it was written for.
+    """
+    site = site_key(url)
+    return {key: args for key, args in extractor_args.items()
+            if site in PLAN_SITE_HOSTS.get(key, ()) or site.split(".")[0] == key}
+
+
+def format_extractor_args(extractor_args):
+    """--extractor-args command line values for an extractor_args dict."""
+    return [
+        site + ":" + ";".join(name + "=" + ",".join(values) for name, values in args.items())
+        for site, args in extractor_args.items()
+    ]
+
+
+def build_ytdlp_command(url, playlist_mode, cookies_path=None, proxy_url=None, user_agent=None,
+                        playlist_items=None, extractor_args=None):
+    """Build the yt-dlp command line used by the subprocess engine."""
+    cmd = [
+        "yt-dlp",
+        "-J",
+        "--no-warnings",
+        "--socket-timeout", "60",           # Increased for large files
+        "--extractor-retries", "5",         # More retries for reliability
+        "--ignore-errors",
+        "--no-exec",           # Prevent execution of external commands
+        "--no-batch-file",     # Prevent reading batch files
+        "--no-download",       # Ensure we're only extracting info
+    ]
+
+    # Only use --flat-playlist for actual playlist URLs to speed up extraction
+    # For single videos, we need full format info
+    if playlist_mode:
+        cmd.extend([
+            "--yes-playlist",
+            "--flat-playlist",              # Faster playlist extraction
+        ])
+        if playlist_items:
+            cmd.extend(["--playlist-items", playlist_items])
+    else:
+        cmd.extend([
+            "--no-playlist",                # Extract single video only
+        ])
+
+    for value in format_extractor_args(extractor_args or {}):
+        cmd.extend(["--extractor-args", value])
+    if extractor_args:
+        # A plan that leaves no formats must return the info dict so
+        # run_planned_extraction() can retry without it
+        cmd.append("--ignore-no-formats-error")
 
-# Only use --flat-playlist for actual playlist URLs to speed up extraction
-# For single videos, we need full format info
-if is_playlist_url or is_playlist_context:
-    cmd.extend([
-        "--yes-playlist",
-        "--flat-playlist",              # Faster playlist extraction
-    ])
-else:
     cmd.extend([
-        "--no-playlist",                # Extract single video only
+        "--no-check-formats",               # Skip format availability check for speed
+        url
     ])
 
-cmd.extend([
-    "--no-check-formats",               # Skip format availability check for speed
-    url
-])
+    # Add cookie support for authenticated downloads
+    if cookies_path:
+        cmd.insert(1, "--cookies")
+        cmd.insert(2, cookies_path)
+
+    # Add proxy support
+    if proxy_url:
+        cmd.insert(1, "--proxy")
+        cmd.insert(2, proxy_url)
+
+    # Add user agent if provided
+    if user_agent:
+        cmd.insert(1, "--user-agent")
+        cmd.insert(2, user_agent)
+
+    return cmd
+
+
+def build_ytdlp_options(playlist_mode, cookies_path=None, proxy_url=None, user_agent=None,
+                        playlist_items=None, extractor_args=None):
+    """Build YoutubeDL params equivalent to build_ytdlp_command()."""
+    opts = {
+        "quiet": True,
+        "no_warnings": True,
+        "no_color": True,
+        "noprogress": True,
+        "socket_timeout": 60,
+        "extractor_retries": 5,
+        "ignoreerrors": True,
+        "skip_download": True,
+        "check_formats": False,
+        "noplaylist": not playlist_mode,
+        "extract_flat": "in_playlist" if playlist_mode else False,
+    }
+    if playlist_mode and playlist_items:
+        opts["playlist_items"] = playlist_items
+    if extractor_args:
+        opts["extractor_args"] = extractor_args
+        opts["ignore_no_formats_error"] = True
+    if cookies_path:
+        opts["cookiefile"] = cookies_path
+    if proxy_url:
+        opts["proxy"] = proxy_url
+    if user_agent:
+        opts["http_headers"] = {"User-Agent": user_agent}
+    return opts
+
+
+def sanitize_error_output(text):
+    """Trim and strip control characters from yt-dlp error text."""
+    text = text[:2000] if text else "Unknown error"
+    return re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', text)
 
-# Add cookie support for authenticated downloads
-if cookies_file:
+
+def load_ytdlp_module():
+    """Import yt_dlp for in-process extraction, or return None if unavailable."""
     try:
-        validated_cookies = validate_file_path(cookies_file, must_exist=True)
-        if validated_cookies:
-            cmd.insert(1, "--cookies")
-            cmd.insert(2, validated_cookies)
-    except ValueError as e:
-        print(json.dumps({"error": f"Security: Cookies file - {e}"}))
-        sys.exit(1)
+        import yt_dlp
+        return yt_dlp
+    except Exception:
+        # Missing or broken install - the subprocess engine is the fallback
+        return None
 
-# Add proxy support
-if proxy_url:
-    cmd.insert(1, "--proxy")
-    cmd.insert(2, proxy_url)
 
-# Add user agent if provided
-if user_agent:
-    cmd.insert(1, "--user-agent")
-    cmd.insert(2, user_agent)
+def select_engine():
+    """Return the yt_dlp module for in-process extraction, or None for the executable.
 
-try:
-    # Use explicit arguments to prevent shell injection
-    # Increased timeout for large downloads
-    proc = subprocess.run(
-        cmd, 
-        capture_output=True, 
-        text=True, 
-        timeout=extraction_timeout,
-        shell=False,  # CRITICAL: Never use shell=True
-        env={**os.environ, "PYTHONIOENCODING": "utf-8"}  # Controlled environment
-    )
-except subprocess.TimeoutExpired:
-    print(json.dumps({"error": f"Extraction timed out after {extraction_timeout} seconds. Try a more specific URL."}))
-    sys.exit(1)
-except Exception as e:
-    print(json.dumps({"error": f"Failed to run yt-dlp: {e}"}))
-    sys.exit(1)
-
-if proc.returncode != 0:
-    # Sanitize error output before returning
-    stderr = proc.stderr[:2000] if proc.stderr else "Unknown error"
-    stderr = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', stderr)  # Remove control chars
-    print(json.dumps({"error": stderr}))
-    sys.exit(1)
-
-# Limit output size to prevent memory exhaustion (configurable)
-MAX_OUTPUT_SIZE = LARGE_CONFIG.get("maxOutputSize", 50 * 1024 * 1024)
-if len(proc.stdout) > MAX_OUTPUT_SIZE:
-    print(json.dumps({"error": "Output too large - possible malicious response"}))
-    sys.exit(1)
+    Raises a DEPENDENCY_MISSING ExtractionError when neither is available.
+    """
+    if LARGE_CONFIG.get("engine", "auto") != "subprocess":
+        with timed("import"):
+            ytdlp_module = load_ytdlp_module()
+        if ytdlp_module:
+            return ytdlp_module
+    if not shutil.which("yt-dlp"):
+        raise ExtractionError("DEPENDENCY MISSING: yt-dlp is not installed for this Python "
+                              "interpreter and was not found in PATH", "DEPENDENCY_MISSING")
+    return None
 
-try:
-    info = json.loads(proc.stdout)
-except json.JSONDecodeError as e:
-    print(json.dumps({"error": f"Failed to parse yt-dlp output: {e}"}))
-    sys.exit(1)
 
+def check_runtime():
+    """yt-dlp availability and version, in check_dependencies.py's "check" shape.
+
+    An already imported yt_dlp reports its own version; otherwise the
+    stamp/package-metadata check from check_dependencies.py is used, so
+    this never imports yt-dlp just to look at it.
+    """
+    from check_dependencies import check_ytdlp, check_lazy_extractors, is_version_adequate, MIN_RECOMMENDED_VERSION
+
+    ytdlp_module = sys.modules.get("yt_dlp")
+    version = getattr(getattr(ytdlp_module, "version", None), "__version__", None)
+    if not version:
+        return {"ytdlp": check_ytdlp()}
+    return {"ytdlp": {
+        "installed": True,
+        "version": version,
+        "versionAdequate": is_version_adequate(version),
+        "minRecommended": MIN_RECOMMENDED_VERSION,
+        "error": None,
+        "source": "module",
+        "lazyExtractors": check_lazy_extractors(),
+    }}
+
+
+class _ErrorCollector:
+    """Minimal yt-dlp logger that keeps error messages and drops the rest."""
+
+    def __init__(self):
+        self.errors = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        self.errors.append(str(msg))
+
+
+def run_ytdlp_inprocess(ytdlp, url, ydl_opts, timeout, ydl=None, collector=None):
+    """Run YoutubeDL.extract_info in this interpreter and return the info dict.
+
+    A long-lived YoutubeDL (and the _ErrorCollector it logs to) may be passed
+    in to reuse its connections and cookie jar; otherwise a fresh one is used.
+    """
+    if ydl is None:
+        collector = _ErrorCollector()
+    outcome = {}
+
+    def worker():
+        try:
+            if ydl is not None:
+                outcome["info"] = ydl.extract_info(url, download=False)
+                return
+            with ytdlp.YoutubeDL({**ydl_opts, "logger": collector}) as fresh_ydl:
+                outcome["info"] = fresh_ydl.extract_info(url, download=False)
+        except Exception as e:
+            outcome["exception"] = e
+
+    # Extraction can't be killed like a subprocess, so run it on a daemon
+    # thread and stop waiting once the timeout passes
+    thread = threading.Thread(target=worker, daemon=True)
+    with timed("ytdlp"):
+        thread.start()
+        thread.join(timeout)
+    if thread.is_alive():
+        hold_admission_until(thread)
+        raise ExtractionError(f"Extraction timed out after {timeout} seconds. Try a more specific URL.", "TIMEOUT")
+
+    if "exception" in outcome:
+        raise ExtractionError(sanitize_error_output(f"Failed to run yt-dlp: {outcome['exception']}"))
+
+    info = outcome.get("info")
+    if not info:
+        raise ExtractionError(sanitize_error_output("\n".join(collector.errors)))
+    # Same cap and projection as yt-dlp's JSON output gets on the subprocess engine
+    if exceeds_json_size(info, LARGE_CONFIG.get("maxOutputSize", 50 * 1024 * 1024)):
+        raise ExtractionError("Output too large - possible malicious response")
+    return project_info(info)
+
+
+def exceeds_json_size(value, max_bytes):
+    """Whether value's JSON encoding (as yt-dlp -J writes it) would be longer than max_bytes.
+
+    Adds up the length of each string, key, number and separator, ignoring
+    escapes, and stops as soon as the cap is passed, so an oversized info
+    dict is rejected without building its encoding.
+    """
+    size = 0
+    pending = [value]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            size += len(item) + 2
+        elif isinstance(item, dict):
+            size += 2
+            for key, child in item.items():
+                size += len(str(key)) + 6  # Quotes, ": " and ", "
+                pending.append(child)
+        elif isinstance(item, (list, tuple)):
+            size += 2 + 2 * len(item)
+            pending.extend(item)
+        else:
+            size += len(str(item))
+        if size > max_bytes:
+            return True
+    return False
+
+
+# Keys of the yt-dlp info dict the output builders actually read; everything
+# else is dropped while ingesting subprocess output
+INFO_KEYS = {
+    "_type", "id", "title", "webpage_url", "duration", "upload_date", "http_headers",
+    "formats", "subtitles", "automatic_captions", "thumbnails", "entries", "playlist_count",
+}
+FORMAT_KEYS = {
+    "url", "format_id", "protocol", "ext", "tbr", "filesize", "filesize_approx",
+    "vcodec", "acodec", "fps", "height", "width", "abr", "http_headers", "preference",
+    "has_drm", "is_premium", "format_note", "language", "container", "manifest_url",
+    "fragments", "fragment_base_url",
+}
+PLAYLIST_ENTRY_KEYS = {"_type", "id", "url", "webpage_url", "title", "duration", "filesize"}
+SUBTITLE_KEYS = {"url", "ext", "name", "protocol"}
+THUMBNAIL_KEYS = {"url", "height", "width"}
+
+READ_CHUNK_SIZE = 256 * 1024
+MAX_STDERR_SIZE = 64 * 1024
+
+# Above this size peak memory matters more than decode speed, so the
+# projecting scanner is used even when orjson is installed
+FAST_JSON_MAX_BYTES = 8 * 1024 * 1024
+
+
+def project_format(f):
+    """Keep only the format keys used downstream and cap the fragment list."""
+    if not isinstance(f, dict):
+        return f
+    projected = {k: v for k, v in f.items() if k in FORMAT_KEYS}
+    fragments = projected.get("fragments")
+    max_fragments = LARGE_CONFIG.get("maxFragments", 10000)
+    # Byte-range lists are kept whole: coalescing needs every range and
+    # turns them into a handful of entries anyway
+    if (isinstance(fragments, list) and len(fragments) > max_fragments
+            and not (LARGE_CONFIG.get("coalesceByteRanges", True) and is_byte_range_fragment(fragments[0]))):
+        projected["fragments"] = fragments[:max_fragments]
+        projected["_fragment_total"] = len(fragments)
+    return projected
+
+
+def project_playlist_entry(e):
+    """Keep only the flat playlist entry keys used downstream."""
+    if not isinstance(e, dict):
+        return e
+    return {k: v for k, v in e.items() if k in PLAYLIST_ENTRY_KEYS}
+
+
+def subtitle_track_rank(track):
+    """Sort key preferring vtt, then srt, over other subtitle formats."""
+    ext = track.get("ext")
+    return 2 if ext == "vtt" else (1 if ext == "srt" else 0)
+
+
+def wanted_subtitle_languages():
+    """Subtitle languages to keep from subtitleLanguages, or None for all."""
+    languages = LARGE_CONFIG.get("subtitleLanguages")
+    if languages is None:
+        return set(LANGUAGE_PREFERENCE)
+    if languages == "all" or not isinstance(languages, list):
+        return None
+    return {lang for lang in languages if isinstance(lang, str)}
+
+
+def project_subtitles(subs):
+    """Keep the wanted languages, each reduced to its best track's used keys.
+
+    A language matches when listed as-is or by its base code, so "en"
+    also keeps "en-US" and "en-orig".
+    """
+    if not isinstance(subs, dict):
+        return subs
+    wanted = wanted_subtitle_languages()
+    projected = {}
+    for lang, tracks in subs.items():
+        if wanted is not None and lang not in wanted and lang.split("-")[0] not in wanted:
+            continue
+        tracks = [t for t in tracks or () if isinstance(t, dict)]
+        if tracks:
+            best = max(tracks, key=subtitle_track_rank)
+            projected[lang] = [{k: v for k, v in best.items() if k in SUBTITLE_KEYS}]
+    return projected
+
+
+def project_thumbnails(thumbs):
+    """Keep only the thumbnail keys used downstream."""
+    if not isinstance(thumbs, list):
+        return thumbs
+    return [{k: v for k, v in t.items() if k in THUMBNAIL_KEYS} for t in thumbs if isinstance(t, dict)]
+
+
+# Top-level arrays decoded element by element, with their projections
+ARRAY_PROJECTIONS = {
+    "formats": project_format,
+    "entries": project_playlist_entry,
+}
+
+# Top-level values decoded whole, then trimmed before they are kept
+VALUE_PROJECTIONS = {
+    "subtitles": project_subtitles,
+    "automatic_captions": project_subtitles,
+    "thumbnails": project_thumbnails,
+}
+
+
+def project_info(info):
+    """Drop info dict keys the output builders never read."""
+    if not isinstance(info, dict):
+        return info
+    projected = {k: v for k, v in info.items() if k in INFO_KEYS}
+    for key, project in ARRAY_PROJECTIONS.items():
+        if isinstance(projected.get(key), list):
+            projected[key] = [project(v) for v in projected[key]]
+    for key, project in VALUE_PROJECTIONS.items():
+        if key in projected:
+            projected[key] = project(projected[key])
+    return projected
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _skip_whitespace(text, pos):
+    return _JSON_WHITESPACE.match(text, pos).end()
+
+
+def _scan_array(text, pos, decoder, project):
+    """Decode the JSON array at text[pos] one element at a time."""
+    items = []
+    pos = _skip_whitespace(text, pos + 1)
+    if text[pos] == "]":
+        return items, pos + 1
+    while True:
+        value, pos = decoder.raw_decode(text, pos)
+        items.append(project(value))
+        pos = _skip_whitespace(text, pos)
+        if text[pos] == ",":
+            pos = _skip_whitespace(text, pos + 1)
+        elif text[pos] == "]":
+            return items, pos + 1
+        else:
+            raise ValueError(f"Expecting ',' delimiter: char {pos}")
+
+
+def scan_info(text):
+    """Decode a yt-dlp info object member by member, materializing only used keys.
+
+    Top-level members are decoded one at a time and unused ones are released
+    immediately; formats and playlist entries are projected as each element
+    completes. The whole text is still held, but the decoded object tree,
+    which is several times larger, only ever holds the kept data.
+    Raises ValueError on malformed or truncated JSON.
+    """
+    try:
+        return _scan_object(text)
+    except IndexError:
+        raise ValueError(f"Unexpected end of JSON: char {len(text)}") from None
+
+
+def _scan_object(text):
+    decoder = json.JSONDecoder()
+    pos = _skip_whitespace(text, 0)
+    if text[pos] != "{":
+        return decoder.decode(text)
+
+    info = {}
+    pos = _skip_whitespace(text, pos + 1)
+    if text[pos] == "}":
+        pos += 1
+    else:
+        while True:
+            key, pos = decoder.raw_decode(text, pos)
+            if not isinstance(key, str):
+                raise ValueError(f"Expecting property name: char {pos}")
+            pos = _skip_whitespace(text, pos)
+            if text[pos] != ":":
+                raise ValueError(f"Expecting ':' delimiter: char {pos}")
+            pos = _skip_whitespace(text, pos + 1)
+
+            if key in ARRAY_PROJECTIONS and text[pos] == "[":
+                info[key], pos = _scan_array(text, pos, decoder, ARRAY_PROJECTIONS[key])
+            else:
+                value, pos = decoder.raw_decode(text, pos)
+                if key in VALUE_PROJECTIONS:
+                    info[key] = VALUE_PROJECTIONS[key](value)
+                elif key in INFO_KEYS:
+                    info[key] = value
+                del value
+
+            pos = _skip_whitespace(text, pos)
+            if text[pos] == ",":
+                pos = _skip_whitespace(text, pos + 1)
+            elif text[pos] == "}":
+                pos += 1
+                break
+            else:
+                raise ValueError(f"Expecting ',' delimiter: char {pos}")
+
+    if _skip_whitespace(text, pos) != len(text):
+        raise ValueError(f"Extra data: char {pos}")
+    return info
+
+
+def load_fast_json():
+    """Return orjson.loads when orjson is installed, else None."""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return None
+
+
+def decode_info(buffer):
+    """Decode yt-dlp's JSON output into a projected info dict.
+
+    Consumes (clears) the buffer as soon as it has been decoded. Small
+    payloads use orjson when available; large ones (or no orjson) use the
+    projecting stdlib scanner. That briefly holds the output twice (bytes
+    and text) but never builds the unused part of the object tree, so its
+    peak is lower than decoding everything and projecting afterwards.
+    """
+    fast_loads = load_fast_json() if len(buffer) <= FAST_JSON_MAX_BYTES else None
+    if fast_loads:
+        info = fast_loads(buffer)
+        buffer.clear()
+        return project_info(info)
+    text = buffer.decode("utf-8", "replace")
+    buffer.clear()
+    return scan_info(text)
+
+
+def read_stdout_limited(proc, max_bytes):
+    """Read proc.stdout incrementally as bytes, killing it past max_bytes."""
+    buffer = bytearray()
+    while True:
+        chunk = proc.stdout.read1(READ_CHUNK_SIZE)
+        if not chunk:
+            return buffer
+        if len(buffer) + len(chunk) > max_bytes:
+            proc.kill()
+            raise ExtractionError("Output too large - possible malicious response")
+        buffer += chunk
+
+
+def drain_stderr(proc):
+    """Collect proc.stderr on the side so a chatty yt-dlp can't block on a full pipe.
+
+    Returns the list the (size-capped) chunks are appended to and the thread.
+    """
+    stderr_chunks = []
+
+    def drain():
+        size = 0
+        for chunk in iter(lambda: proc.stderr.read1(READ_CHUNK_SIZE), b""):
+            if size < MAX_STDERR_SIZE:
+                stderr_chunks.append(chunk)
+                size += len(chunk)
+
+    stderr_thread = threading.Thread(target=drain, daemon=True)
+    stderr_thread.start()
+    return stderr_chunks, stderr_thread
+
+
+def run_ytdlp_subprocess(cmd, timeout):
+    """Run the yt-dlp executable and return its parsed JSON output.
+
+    Output is streamed with the maxOutputSize cap enforced as it arrives,
+    rather than buffered in full and checked afterwards.
+    """
+    import subprocess
+    timings = active.timings
+    spawn_started = time.perf_counter() if timings is not None else None
+    try:
+        # Use explicit arguments to prevent shell injection
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False,  # CRITICAL: Never use shell=True
+            env={**os.environ, "PYTHONIOENCODING": "utf-8"}  # Controlled environment
+        )
+    except Exception as e:
+        raise ExtractionError(f"Failed to run yt-dlp: {e}")
+    if timings is not None:
+        timings.add("spawn", spawn_started)
+
+    stderr_chunks, stderr_thread = drain_stderr(proc)
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill_on_timeout)
+    timer.start()
+    try:
+        # Limit output size to prevent memory exhaustion (configurable)
+        with timed("ytdlp"):
+            buffer = read_stdout_limited(proc, LARGE_CONFIG.get("maxOutputSize", 50 * 1024 * 1024))
+            proc.wait()
+    finally:
+        timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        stderr_thread.join(5)
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if timed_out.is_set():
+        raise ExtractionError(f"Extraction timed out after {timeout} seconds. Try a more specific URL.", "TIMEOUT")
+
+    if proc.returncode != 0:
+        # Sanitize error output before returning
+        stderr = b"".join(stderr_chunks).decode("utf-8", "replace")
+        raise ExtractionError(sanitize_error_output(stderr))
+
+    if timings is not None:
+        timings.bytes["ytdlpStdout"] = len(buffer)
+    try:
+        with timed("decode"):
+            return decode_info(buffer)
+    except (ValueError, IndexError) as e:
+        raise ExtractionError(f"Failed to parse yt-dlp output: {e}")
+
+
+# === OUTPUT FORMATTING ===
 
 # Language preference mapping (higher = better for user)
 LANGUAGE_PREFERENCE = {
@@ -403,8 +1148,11 @@ def format_filesize(size_bytes):
     return f"{size_bytes} bytes"
 
 
-def score_format(f):
-    """Higher score = better choice."""
+def score_format(f, codec_pref=None, lang_pref=None):
+    """Higher score = better choice.
+
+    Codec and language preferences may be passed in when already computed.
+    """
     tbr = f.get("tbr") or 0
     height = f.get("height") or 0
     filesize = f.get("filesize") or f.get("filesize_approx") or 0
@@ -413,12 +1161,15 @@ def score_format(f):
     is_hls = proto.startswith("m3u8")
     has_video = f.get("vcodec", "none") != "none"
     has_audio = f.get("acodec", "none") != "none"
-    codec_pref = get_codec_preference(f)
-    lang_pref = get_language_preference(f)
+    if codec_pref is None:
+        codec_pref = get_codec_preference(f)
+    if lang_pref is None:
+        lang_pref = get_language_preference(f)
     preference = f.get("preference") or 0
 
     score = preference * 10  # Use yt-dlp's preference as base
 
+    profile = active.profile
     if profile == "FASTEST":
         score += 1000 if (has_video and has_audio) else 0
         score += tbr * 2
@@ -449,8 +1200,58 @@ def score_format(f):
     return score
 
 
-def build_format(f, entry_info, format_index):
-    """Build FDM-compatible format object with security sanitization."""
+def build_entry_headers(entry_info):
+    """Sanitized headers shared by every format of an entry."""
+    return {
+        "User-Agent": sanitize_text_output(active.user_agent or entry_info.get("http_headers", {}).get("User-Agent", ""), 512),
+        "Referer": sanitize_url_output(entry_info.get("webpage_url", "")) or "",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-us,en;q=0.5"
+    }
+
+
+def build_format_headers(f, entry_headers):
+    """Sanitized headers for one format: only the ones differing from
+    entry_headers with compactHeaders, otherwise the full merged set."""
+    compact_headers = LARGE_CONFIG.get("compactHeaders", True)
+    http_headers = {} if compact_headers else dict(entry_headers)
+    
+    # Merge any format-specific headers (sanitized)
+    fmt_headers = f.get("http_headers") or {}
+    for k, v in fmt_headers.items():
+        if isinstance(k, str) and isinstance(v, str):
+            key = sanitize_text_output(k, 64)
+            value = sanitize_text_output(v, 512)
+            if not compact_headers or entry_headers.get(key) != value:
+                http_headers[key] = value
+    return http_headers
+
+
+def format_expiry(fmt):
+    """Earliest signed-URL expiry among a built format's URLs, or None."""
+    expiries = [get_url_expiry(fmt.get(key)) for key in ("url", "manifestUrl", "fragment_base_url")]
+    expiries = [e for e in expiries if e]
+    return min(expiries) if expiries else None
+
+
+def add_large_download_hints(fmt, size):
+    """Mark formats over 1 GB as large downloads; returns whether it did."""
+    if not size or size <= 1024 * 1024 * 1024:
+        return False
+    fmt["_largeDownload"] = True
+    fmt["_filesizeFormatted"] = format_filesize(size)
+    fmt["_suggestedChunkSize"] = LARGE_CONFIG.get("chunkSize", 10 * 1024 * 1024)
+    return True
+
+
+def build_format(f, entry_info, format_index, entry_headers=None, expand_fragments=True):
+    """Build FDM-compatible format object with security sanitization.
+
+    With compactHeaders the format's httpHeaders only hold what differs
+    from entry_headers (sent once at entry level); otherwise they are the
+    full merged set. Without expand_fragments a fragmented format only
+    carries its fragment count and formatId (see resolveFormat).
+    """
     proto = get_protocol(f)
     ext = f.get("ext", "mp4")
     vcodec = f.get("vcodec") or "none"
@@ -458,26 +1259,24 @@ def build_format(f, entry_info, format_index):
     has_video = vcodec != "none"
     has_audio = acodec != "none"
 
+    # One file addressed by byte-range fragments is downloaded as that file
+    coalesced = None
+    if f.get("fragments") and LARGE_CONFIG.get("coalesceByteRanges", True):
+        coalesced = coalesce_byte_ranges(f)
+        if coalesced:
+            proto = "http" if coalesced["url"].startswith("http://") else "https"
+
     # Sanitize URL
-    format_url = sanitize_url_output(f["url"])
+    format_url = sanitize_url_output(coalesced["url"] if coalesced else f["url"])
     if not format_url:
         return None
 
     # Build HTTP headers with sanitization
-    http_headers = {
-        "User-Agent": sanitize_text_output(user_agent or entry_info.get("http_headers", {}).get("User-Agent", ""), 512),
-        "Referer": sanitize_url_output(entry_info.get("webpage_url", "")) or "",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Language": "en-us,en;q=0.5"
-    }
-    
-    # Merge any format-specific headers (sanitized)
-    fmt_headers = f.get("http_headers") or {}
-    for k, v in fmt_headers.items():
-        if isinstance(k, str) and isinstance(v, str):
-            http_headers[sanitize_text_output(k, 64)] = sanitize_text_output(v, 512)
+    if entry_headers is None:
+        entry_headers = build_entry_headers(entry_info)
+    http_headers = build_format_headers(f, entry_headers)
 
-    filesize = f.get("filesize") or f.get("filesize_approx")
+    filesize = coalesced["size"] if coalesced else f.get("filesize") or f.get("filesize_approx")
     
     fmt = {
         "url": format_url,
@@ -494,13 +1293,11 @@ def build_format(f, entry_info, format_index):
         "abr": f.get("abr"),
         "httpHeaders": http_headers,
         "preference": f.get("preference") or (100 - format_index),
+        "formatId": sanitize_text_output(str(f["format_id"]), 64) if f.get("format_id") is not None else None,
     }
 
     # Add large download hints
-    if filesize and filesize > 1024 * 1024 * 1024:  # > 1GB
-        fmt["_largeDownload"] = True
-        fmt["_filesizeFormatted"] = format_filesize(filesize)
-        fmt["_suggestedChunkSize"] = LARGE_CONFIG.get("chunkSize", 10 * 1024 * 1024)
+    if add_large_download_hints(fmt, filesize):
         # Hint for resumable downloads
         http_headers["Accept-Ranges"] = "bytes"
 
@@ -510,9 +1307,6 @@ def build_format(f, entry_info, format_index):
             fmt["language"] = sanitize_text_output(lang, 16)
             fmt["languagePreference"] = get_language_preference(f)
 
-    if cookies_string:
-        fmt["cookies"] = sanitize_text_output(cookies_string, 8192)
-
     if has_video:
         fmt["video_ext"] = sanitize_text_output(ext, 16)
     if has_audio and not has_video:
@@ -529,79 +1323,302 @@ def build_format(f, entry_info, format_index):
 
     # Handle fragments with increased limit for large downloads
     max_fragments = LARGE_CONFIG.get("maxFragments", 10000)
-    if f.get("fragments"):
+    if coalesced:
+        fmt["_fragmentsCoalesced"] = coalesced["fragments"]
+    elif f.get("fragments") and not expand_fragments:
+        base_url = sanitize_url_output(f.get("fragment_base_url", ""))
+        if base_url:
+            fmt["fragment_base_url"] = base_url
+        total_fragments = f.get("_fragment_total") or len(f["fragments"])
+        fmt["_fragmentCount"] = total_fragments
+        fmt["_fragmentsDeferred"] = True
+        fmt["_multiFragment"] = total_fragments > 100
+    elif f.get("fragments"):
         base_url = sanitize_url_output(f.get("fragment_base_url", "")) or ""
-        fragments = []
-        total_fragments = len(f["fragments"])
-        skipped_fragments = 0
-        
+        total_fragments = f.get("_fragment_total") or len(f["fragments"])
+
+        candidates = []
         for frag in f["fragments"][:max_fragments]:
-            frag_url = frag.get("url", "")
-            frag_path = frag.get("path", "")
-            if frag_url and base_url and frag_url.startswith(base_url):
-                frag_path = frag_url[len(base_url):]
-            elif frag_url and not frag_path:
-                frag_path = frag_url
-            
+            frag_path = fragment_path(frag, base_url)
             if frag_path:
-                # Validate fragment path
-                path_valid, path_error = is_safe_fragment_path(frag_path, base_url)
-                if not path_valid:
-                    skipped_fragments += 1
-                    continue
-                
-                frag_entry = {"path": sanitize_text_output(frag_path, 2048)}
-                # Include fragment duration if available (helps with large files)
-                if frag.get("duration"):
-                    frag_entry["duration"] = frag["duration"]
-                fragments.append(frag_entry)
+                candidates.append((frag_path, frag))
+
+        # Validate all fragment paths against the base URL in one pass
+        timings = active.timings
+        if timings is not None:
+            validate_started = time.perf_counter()
+        accepted, skipped_fragments = validate_fragment_paths([c[0] for c in candidates], base_url)
+        if timings is not None:
+            timings.add("validateFragments", validate_started)
+            timings.counts["fragmentsValidated"] += len(candidates)
+            timings.counts["fragmentsSkipped"] += skipped_fragments
+
+        fragments = []
+        for i in accepted:
+            frag_path, frag = candidates[i]
+            frag_entry = {"path": sanitize_text_output(frag_path, 2048)}
+            # Include fragment duration if available (helps with large files)
+            if frag.get("duration"):
+                frag_entry["duration"] = frag["duration"]
+            fragments.append(frag_entry)
         
         if base_url:
             fmt["fragment_base_url"] = base_url
         if fragments:
-            fmt["fragments"] = fragments
+            template = compact_fragments(fragments) if LARGE_CONFIG.get("compactFragments", True) else None
+            if template:
+                fmt["fragmentTemplate"] = template
+            else:
+                fmt["fragments"] = fragments
             fmt["_fragmentCount"] = total_fragments
             fmt["_fragmentsSkipped"] = skipped_fragments
             fmt["_multiFragment"] = total_fragments > 100
 
+    if not http_headers:
+        del fmt["httpHeaders"]
+    # Lets a resuming download refresh the URL before it stops working
+    fmt["_expiresAt"] = format_expiry(fmt)
     return {k: v for k, v in fmt.items() if v is not None}
 
 
-def process_single_entry(entry):
-    """Process a single video entry."""
-    formats = []
-    for f in entry.get("formats", []):
+# === FRAGMENT COMPACTION ===
+
+# Shorter lists aren't worth a template
+COMPACT_MIN_FRAGMENTS = 16
+
+_DIGIT_RUNS = re.compile(r'(\d+)')
+
+
+def _fragment_pattern(first, second):
+    """Find the one numeric run that differs between two fragment paths.
+
+    Returns (prefix, start, step, width, suffix) or None.
+    """
+    a = _DIGIT_RUNS.split(first)
+    b = _DIGIT_RUNS.split(second)
+    if len(a) != len(b):
+        return None
+    varying = [i for i in range(1, len(a), 2) if a[i] != b[i]]
+    if len(varying) != 1 or any(a[i] != b[i] for i in range(0, len(a), 2)):
+        return None
+    pos = varying[0]
+    start, step = int(a[pos]), int(b[pos]) - int(a[pos])
+    if step <= 0:
+        return None
+    # Zero-padded counters ("seg-00001") keep their width
+    width = len(a[pos]) if len(a[pos]) > 1 and a[pos].startswith("0") else 0
+    prefix, suffix = "".join(a[:pos]), "".join(a[pos + 1:])
+    if "{" in prefix + suffix or "}" in prefix + suffix:
+        return None
+    return prefix, start, step, width, suffix
+
+
+def compact_fragments(fragments):
+    """Describe an arithmetic fragment list as a template, or return None.
+
+    The template expands to "pattern" with {n} running from "start" in
+    "step" increments (zero-padded to "width" when set), skipping the
+    numbers in "gaps" (fragments rejected by validation), until "count"
+    fragments exist. Every fragment gets "duration" except the indexes in
+    "exceptions", which carry their own path and/or duration.
+    """
+    count = len(fragments)
+    if count < COMPACT_MIN_FRAGMENTS:
+        return None
+    pattern = _fragment_pattern(fragments[0]["path"], fragments[1]["path"])
+    if not pattern:
+        return None
+    prefix, start, step, width, suffix = pattern
+    duration = Counter(frag.get("duration") for frag in fragments).most_common(1)[0][0]
+
+    max_irregular = max(4, count // 10)
+    exceptions = []
+    gaps = []
+    n = start
+    for i, frag in enumerate(fragments):
+        path = frag["path"]
+        number = path[len(prefix):len(path) - len(suffix)]
+        exception = {}
+        if (path.startswith(prefix) and path.endswith(suffix) and number.isdigit()
+                and (not width or len(number) == width) and (width or number == str(int(number)))
+                and int(number) >= n and (int(number) - n) % step == 0):
+            # Numbers skipped since the previous fragment become gaps
+            while n < int(number):
+                gaps.append(n)
+                n += step
+        else:
+            exception["path"] = path
+        n += step
+        if frag.get("duration") != duration:
+            exception["duration"] = frag.get("duration")
+        if exception:
+            exceptions.append({"index": i, **exception})
+        if len(exceptions) + len(gaps) > max_irregular:
+            return None
+
+    template = {
+        "pattern": prefix + "{n}" + suffix,
+        "start": start,
+        "step": step,
+        "count": count,
+    }
+    if width:
+        template["width"] = width
+    if duration is not None:
+        template["duration"] = duration
+    if gaps:
+        template["gaps"] = gaps
+    if exceptions:
+        template["exceptions"] = exceptions
+    return template
+
+
+def expand_fragment_template(template):
+    """Expand a compact_fragments() template back into a fragment list."""
+    gaps = set(template.get("gaps", ()))
+    width = template.get("width", 0)
+    duration = template.get("duration")
+    fragments = []
+    n = template["start"]
+    while len(fragments) < template["count"]:
+        if n not in gaps:
+            number = str(n).zfill(width) if width else str(n)
+            frag = {"path": template["pattern"].replace("{n}", number)}
+            if duration is not None:
+                frag["duration"] = duration
+            fragments.append(frag)
+        n += template["step"]
+    for exception in template.get("exceptions", ()):
+        frag = fragments[exception["index"]]
+        if "path" in exception:
+            frag["path"] = exception["path"]
+        if "duration" in exception:
+            if exception["duration"] is None:
+                frag.pop("duration", None)
+            else:
+                frag["duration"] = exception["duration"]
+    return fragments
+
+
+def intern_fragment_lists(formats):
+    """Store fragment lists/templates shared by several formats only once.
+
+    Returns the {ref: fragments} table; formats using a shared list get a
+    "fragmentsRef" instead of their own copy.
+    """
+    groups = {}
+    for fmt in formats:
+        for key in ("fragments", "fragmentTemplate"):
+            if key in fmt:
+                signature = json.dumps(fmt[key], sort_keys=True)
+                groups.setdefault(signature, []).append((fmt, key))
+
+    table = {}
+    for users in groups.values():
+        if len(users) < 2:
+            continue
+        ref = str(len(table))
+        first_fmt, first_key = users[0]
+        table[ref] = first_fmt[first_key]
+        for fmt, key in users:
+            del fmt[key]
+            fmt["fragmentsRef"] = ref
+    return table
+
+
+class FormatFeatures:
+    """Ranking values computed once per usable format."""
+
+    __slots__ = ("fmt", "score", "audio_score")
+
+    def __init__(self, fmt, score, audio_score):
+        self.fmt = fmt
+        self.score = score
+        self.audio_score = audio_score  # None unless the format is audio-only
+
+
+def _by_score(features):
+    return features.score
+
+
+def _by_audio_score(features):
+    return features.audio_score
+
+
+def rank_formats(formats, max_formats, max_audio=5):
+    """Score every usable format in one pass and select the top candidates.
+
+    Returns (top formats by score, top audio-only formats by bitrate, codec
+    and language), each ordered exactly like a stable descending sort.
+    """
+    candidates = []
+    audio_candidates = []
+    for f in formats:
         if not is_format_usable(f):
             continue
-        f["_score"] = score_format(f)
-        formats.append(f)
+        codec_pref = get_codec_preference(f)
+        lang_pref = get_language_preference(f)
+        audio_score = None
+        if f.get("acodec", "none") != "none" and f.get("vcodec", "none") == "none":
+            audio_score = (f.get("abr") or 0) + codec_pref + lang_pref
+        features = FormatFeatures(f, score_format(f, codec_pref, lang_pref), audio_score)
+        candidates.append(features)
+        if audio_score is not None:
+            audio_candidates.append(features)
 
-    formats.sort(key=lambda x: x["_score"], reverse=True)
-    
+    # nlargest is documented to match sorted(..., reverse=True)[:n], ties included
+    top = heapq.nlargest(max_formats, candidates, key=_by_score)
+    top_audio = heapq.nlargest(max_audio, audio_candidates, key=_by_audio_score)
+    return [c.fmt for c in top], [c.fmt for c in top_audio]
+
+
+def top_picks(formats, audio_formats):
+    """The best-ranked video format and audio-only format, the ones FDM would download."""
+    video = next((f for f in formats if (f.get("vcodec") or "none") != "none"), None)
+    audio = audio_formats[0] if audio_formats else None
+    return [p for p in (video, audio) if p is not None]
+
+
+def expands_fragments(f, picks):
+    """Whether build_format should expand f's fragments (always, unless lazyFragments)."""
+    if picks is None or f.get("format_id") is None:
+        return True
+    return any(f is p for p in picks)
+
+
+# Cap on subtitle languages per video after language filtering
+MAX_SUBTITLE_LANGUAGES = 100
+
+
+def process_single_entry(entry):
+    """Process a single video entry."""
     # Use configurable max formats
     max_formats = LARGE_CONFIG.get("maxFormats", 50)
-    formats = formats[:max_formats]
+    with timed("rank"):
+        formats, audio_formats = rank_formats(entry.get("formats", []), max_formats)
 
+    timings = active.timings
+    build_started = time.perf_counter() if timings is not None else None
+    entry_headers = build_entry_headers(entry)
+    picks = top_picks(formats, audio_formats) if LARGE_CONFIG.get("lazyFragments") else None
     fdm_formats = []
     for i, f in enumerate(formats):
-        built = build_format(f, entry, i)
+        built = build_format(f, entry, i, entry_headers, expands_fragments(f, picks))
         if built:
             fdm_formats.append(built)
 
     # Include best audio-only tracks
-    audio_formats = [f for f in entry.get("formats", []) 
-                     if is_format_usable(f)
-                     and f.get("acodec", "none") != "none" 
-                     and f.get("vcodec", "none") == "none"]
-    if audio_formats:
-        audio_formats.sort(
-            key=lambda x: (x.get("abr") or 0) + get_codec_preference(x) + get_language_preference(x), 
-            reverse=True
-        )
-        for i, af in enumerate(audio_formats[:5]):  # Increased audio options
-            audio_fmt = build_format(af, entry, len(fdm_formats) + i)
-            if audio_fmt and not any(f["url"] == audio_fmt["url"] for f in fdm_formats):
-                fdm_formats.append(audio_fmt)
+    seen_urls = {f["url"] for f in fdm_formats}
+    for i, af in enumerate(audio_formats):  # Increased audio options
+        audio_fmt = build_format(af, entry, len(fdm_formats) + i, entry_headers, expands_fragments(af, picks))
+        if audio_fmt and audio_fmt["url"] not in seen_urls:
+            fdm_formats.append(audio_fmt)
+            seen_urls.add(audio_fmt["url"])
+
+    if timings is not None:
+        timings.add("build", build_started)
+        timings.counts["formatsSeen"] += len(entry.get("formats") or [])
+        timings.counts["formatsKept"] += len(fdm_formats)
 
     result = {
         "id": sanitize_text_output(entry.get("id"), 128),
@@ -612,17 +1629,20 @@ def process_single_entry(entry):
         "formats": fdm_formats
     }
 
-    # Subtitles (increased limit)
-    subs = entry.get("subtitles") or entry.get("automatic_captions") or {}
+    if fdm_formats and LARGE_CONFIG.get("compactHeaders", True):
+        result["httpHeaders"] = entry_headers
+
+    if LARGE_CONFIG.get("compactFragments", True):
+        fragment_lists = intern_fragment_lists(fdm_formats)
+        if fragment_lists:
+            result["fragmentLists"] = fragment_lists
+
+    # Subtitles in the wanted languages, manual ones preferred
+    subs = project_subtitles(entry.get("subtitles")) or project_subtitles(entry.get("automatic_captions")) or {}
     if subs:
         result["subtitles"] = {}
-        for lang, arr in list(subs.items())[:100]:  # Increased limit
-            if not arr:
-                continue
-            sorted_subs = sorted(arr, key=lambda s: (
-                2 if s.get("ext") == "vtt" else (1 if s.get("ext") == "srt" else 0)
-            ), reverse=True)
-            sub = sorted_subs[0]
+        for lang, arr in list(subs.items())[:MAX_SUBTITLE_LANGUAGES]:
+            sub = arr[0]
             sub_url = sanitize_url_output(sub.get("url"))
             if sub_url:
                 sub_entry = {
@@ -638,25 +1658,52 @@ def process_single_entry(entry):
     # Thumbnails
     thumbs = entry.get("thumbnails") or []
     if thumbs:
-        sorted_thumbs = sorted(thumbs, key=lambda t: (t.get("height") or 0) * (t.get("width") or 0))
-        result["thumbnails"] = []
-        for i, t in enumerate(sorted_thumbs[:20]):
-            thumb_url = sanitize_url_output(t.get("url"))
-            if thumb_url:
-                result["thumbnails"].append({
-                    "url": thumb_url,
-                    "height": t.get("height"),
-                    "width": t.get("width"),
-                    "preference": i
-                })
+        result["thumbnails"] = build_thumbnails(thumbs, LARGE_CONFIG.get("maxThumbnails", 20))
 
     return result
 
 
-# Handle playlists vs single videos
-max_playlist_entries = LARGE_CONFIG.get("maxPlaylistEntries", 500)
+def build_thumbnails(thumbs, limit):
+    """The limit smallest thumbnails by area, smallest first.
+
+    heapq.nsmallest is a stable partial sort, so this matches sorting the
+    whole list and slicing it without sorting what gets thrown away.
+    """
+    selected = heapq.nsmallest(limit, thumbs, key=lambda t: (t.get("height") or 0) * (t.get("width") or 0))
+    built = []
+    for i, t in enumerate(selected):
+        thumb_url = sanitize_url_output(t.get("url"))
+        if thumb_url:
+            built.append({
+                "url": thumb_url,
+                "height": t.get("height"),
+                "width": t.get("width"),
+                "preference": i
+            })
+    return built
+
+
+def build_playlist_entry(e):
+    """Build one FDM playlist entry from a flat yt-dlp entry, or None without a URL."""
+    entry_url = sanitize_url_output(e.get("webpage_url") or e.get("url"))
+    if not entry_url:
+        return None
+    entry_data = {
+        "_type": "url",
+        "url": entry_url,
+        "title": sanitize_text_output(e.get("title", "Media"), 512),
+        "duration": e.get("duration")
+    }
+    # Include filesize hint if available
+    if e.get("filesize"):
+        entry_data["_filesize"] = e["filesize"]
+        entry_data["_filesizeFormatted"] = format_filesize(e["filesize"])
+    return entry_data
+
 
-if info.get("_type") == "playlist" and info.get("entries"):
+def build_playlist_output(info):
+    """Build the FDM playlist object from a flat yt-dlp playlist."""
+    max_playlist_entries = LARGE_CONFIG.get("maxPlaylistEntries", 500)
     entries = [e for e in info["entries"] if e][:max_playlist_entries]
     output = {
         "_type": "playlist",
@@ -669,34 +1716,1935 @@ if info.get("_type") == "playlist" and info.get("entries"):
     }
     
     for e in entries:
-        entry_url = sanitize_url_output(e.get("webpage_url") or e.get("url"))
-        if entry_url:
-            entry_data = {
-                "_type": "url",
-                "url": entry_url,
-                "title": sanitize_text_output(e.get("title", "Media"), 512),
-                "duration": e.get("duration")
-            }
-            # Include filesize hint if available
-            if e.get("filesize"):
-                entry_data["_filesize"] = e["filesize"]
-                entry_data["_filesizeFormatted"] = format_filesize(e["filesize"])
+        entry_data = build_playlist_entry(e)
+        if entry_data:
             output["entries"].append(entry_data)
     
     thumbs = info.get("thumbnails") or []
     if thumbs:
-        sorted_thumbs = sorted(thumbs, key=lambda t: (t.get("height") or 0) * (t.get("width") or 0))
-        output["thumbnails"] = []
-        for i, t in enumerate(sorted_thumbs[:10]):
-            thumb_url = sanitize_url_output(t.get("url"))
-            if thumb_url:
-                output["thumbnails"].append({
-                    "url": thumb_url,
-                    "height": t.get("height"),
-                    "width": t.get("width"),
-                    "preference": i
-                })
-else:
-    output = process_single_entry(info)
-
-print(json.dumps(output))
+        output["thumbnails"] = build_thumbnails(thumbs, 10)
+    return output
+
+
+def build_resolved_format(info, format_id):
+    """Output holding one fully expanded format, for resolveFormat requests."""
+    if info.get("_type") == "playlist":
+        raise ExtractionError("resolveFormat needs a single video URL", "FORMAT_NOT_FOUND")
+    entry_headers = build_entry_headers(info)
+    for i, f in enumerate(info.get("formats") or []):
+        if str(f.get("format_id")) != format_id or not is_format_usable(f):
+            continue
+        built = build_format(f, info, i, entry_headers)
+        if not built:
+            break
+        output = {
+            "id": sanitize_text_output(info.get("id"), 128),
+            "formats": [built],
+            "_resolvedFormat": sanitize_text_output(format_id, 64),
+        }
+        if LARGE_CONFIG.get("compactHeaders", True):
+            output["httpHeaders"] = entry_headers
+        return output
+    raise ExtractionError(f"Format not found: {sanitize_text_output(format_id, 64)}", "FORMAT_NOT_FOUND")
+
+
+def build_refreshed_format(info, format_id):
+    """Fresh URL and headers for one format, for refreshFormat requests.
+
+    Skips ranking, every other format and fragment lists: fragment paths
+    are relative to fragment_base_url, which is the part that gets re-signed.
+    """
+    if info.get("_type") == "playlist":
+        raise ExtractionError("refreshFormat needs a single video URL", "FORMAT_NOT_FOUND")
+    for f in info.get("formats") or []:
+        if str(f.get("format_id")) != format_id or not is_format_usable(f):
+            continue
+        coalesced = None
+        if f.get("fragments") and LARGE_CONFIG.get("coalesceByteRanges", True):
+            coalesced = coalesce_byte_ranges(f)
+        format_url = sanitize_url_output(coalesced["url"] if coalesced else f["url"])
+        if not format_url:
+            break
+        entry_headers = build_entry_headers(info)
+        fmt = {
+            "url": format_url,
+            "protocol": ("http" if format_url.startswith("http://") else "https") if coalesced else get_protocol(f),
+            "formatId": sanitize_text_output(format_id, 64),
+            "httpHeaders": build_format_headers(f, entry_headers),
+        }
+        if f.get("fragment_base_url") and not coalesced:
+            fmt["fragment_base_url"] = sanitize_url_output(f["fragment_base_url"])
+        if fmt["protocol"] == "m3u8_native":
+            fmt["manifestUrl"] = sanitize_url_output(f.get("manifest_url") or f["url"])
+        fmt["_expiresAt"] = format_expiry(fmt)
+        if not fmt["httpHeaders"]:
+            del fmt["httpHeaders"]
+        output = {
+            "id": sanitize_text_output(info.get("id"), 128),
+            "formats": [{k: v for k, v in fmt.items() if v is not None}],
+            "_refreshedFormat": fmt["formatId"],
+        }
+        if LARGE_CONFIG.get("compactHeaders", True):
+            output["httpHeaders"] = entry_headers
+        return output
+    raise ExtractionError(f"Format not found: {sanitize_text_output(format_id, 64)}", "FORMAT_NOT_FOUND")
+
+
+def build_output(info):
+    """Handle playlists vs single videos."""
+    if info.get("_type") == "playlist" and info.get("entries"):
+        return build_playlist_output(info)
+    return process_single_entry(info)
+
+
+# === BYTE-RANGE COALESCING ===
+
+# "range=first-last" query parameter (inclusive, as YouTube chunked formats use)
+_RANGE_QUERY_RE = re.compile(r'([?&])range=(\d+)-(\d+)(&|$)')
+
+
+def is_byte_range_fragment(frag):
+    """Cheap check whether a fragment addresses a byte range of some URL."""
+    if not isinstance(frag, dict):
+        return False
+    return bool(frag.get("byte_range")) or "range=" in (frag.get("url") or frag.get("path") or "")
+
+
+def fragment_byte_range(frag, base_url):
+    """(resource URL, first byte, last byte) of a byte-range fragment, or None.
+
+    Understands yt-dlp's byte_range ({"start", "end"}, end exclusive) and
+    a range=first-last query parameter, which is dropped from the URL.
+    """
+    url = frag.get("url")
+    if not url and frag.get("path"):
+        url = frag["path"] if not base_url else base_url.rstrip("/") + "/" + frag["path"].lstrip("/")
+    if not url:
+        return None
+    byte_range = frag.get("byte_range")
+    if byte_range:
+        try:
+            return url, int(byte_range["start"]), int(byte_range["end"]) - 1
+        except (KeyError, TypeError, ValueError):
+            return None
+    match = _RANGE_QUERY_RE.search(url)
+    if not match:
+        return None
+    # Keep the separator before the parameter only if another one follows
+    joiner = match.group(1) if match.group(4) else ""
+    return url[:match.start()] + joiner + url[match.end():], int(match.group(2)), int(match.group(3))
+
+
+def coalesce_byte_ranges(f):
+    """Merge a format's fragments when they are consecutive byte ranges of one file.
+
+    Every fragment must address the same URL and together they must cover
+    it from byte 0 without gaps or overlaps. Returns {"url", "size",
+    "fragments"} for downloading that URL as one file, or None.
+    """
+    fragments = f["fragments"]
+    if len(fragments) < 2 or (f.get("_fragment_total") or 0) > len(fragments):
+        return None
+    base_url = f.get("fragment_base_url") or ""
+    resource = None
+    expected = 0
+    for frag in fragments:
+        parsed = fragment_byte_range(frag, base_url) if isinstance(frag, dict) else None
+        if parsed is None:
+            return None
+        url, first, last = parsed
+        if resource is None:
+            resource = url
+        if url != resource or first != expected or last < first:
+            return None
+        expected = last + 1
+
+    # yt-dlp's last chunked-format range may end one byte past the file
+    filesize = f.get("filesize")
+    if filesize and expected == filesize + 1:
+        expected = filesize
+    # The file URL is built from the fragment paths, so they get the checks
+    # the fragment list would; any rejected path keeps the fragment list
+    if not _URL_ORIGIN_RE.match(resource):
+        return None
+    paths = [fragment_path(frag, base_url) for frag in fragments]
+    if validate_fragment_paths(paths, base_url)[1]:
+        return None
+    return {"url": resource, "size": expected, "fragments": len(fragments)}
+
+
+# === RESULT CACHE ===
+
+# Config keys that change what gets cached; the playlist mode, page and
+# extractor args go into the key from the request, where they are resolved
+CACHE_KEY_CONFIG_KEYS = (
+    "maxOutputSize", "maxFormats", "maxFragments", "maxPlaylistEntries", "chunkSize",
+    "compactFragments", "compactHeaders", "coalesceByteRanges", "subtitleLanguages", "maxThumbnails",
+    "lazyFragments", "resolveFormat", "refreshFormat",
+    "resolvePlaylistEntries", "entryTimeout", "resolveHlsFormats", "streamPlaylist",
+)
+
+# Query parameters holding an absolute expiry timestamp in signed URLs
+EXPIRY_QUERY_PARAMS = ("expire", "expires", "Expires", "exp")
+
+# Re-extract a little before the earliest signed URL actually expires
+CACHE_EXPIRY_MARGIN = 120
+CACHE_MAX_TTL = 6 * 3600
+
+# Playlists have no signed URLs but gain entries over time
+CACHE_PLAYLIST_TTL = 600
+
+# A resolveFormat result only bridges the gap until the user picks a format
+CACHE_RESOLVED_FORMAT_TTL = 300
+
+# Failures that won't go away by retrying right now (lowercase substrings)
+PERMANENT_ERROR_PATTERNS = (
+    "private video", "video is private", "video unavailable", "video is not available",
+    "has been removed", "been terminated", "no longer available", "does not exist",
+    "not available in your country", "geo restrict", "geo-restrict", "geoblock",
+    "http error 404", "http error 410", "members-only", "join this channel",
+)
+
+# Format selection failures, which a different plan or client can fix
+RETRYABLE_ERROR_PATTERNS = ("requested format is not available", "no video formats found")
+
+# Tracking parameters dropped when normalizing URLs for cache keys
+TRACKING_QUERY_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid", "ref", "ref_src"}
+
+
+def get_url_expiry(url_str):
+    """Return the Unix expiry time embedded in a signed URL, or None."""
+    if not url_str or "?" not in url_str:
+        return None
+    try:
+        params = dict(parse_qsl(urlparse(url_str).query))
+    except ValueError:
+        return None
+
+    candidates = [params.get(name) for name in EXPIRY_QUERY_PARAMS]
+    # Akamai tokens carry "exp=" inside the token value
+    for token_name in ("hdnts", "hdnea", "__token__"):
+        match = re.search(r'(?:^|~)exp=(\d+)', params.get(token_name, ""))
+        if match:
+            candidates.append(match.group(1))
+
+    expiries = []
+    for value in candidates:
+        if value and value.isdigit():
+            ts = int(value)
+            if 1_000_000_000 < ts < 100_000_000_000:  # Plausible Unix seconds
+                expiries.append(ts)
+
+    # AWS SigV4: X-Amz-Date (YYYYMMDDTHHMMSSZ) plus X-Amz-Expires seconds
+    amz_date = params.get("X-Amz-Date", "")
+    amz_expires = params.get("X-Amz-Expires", "")
+    if amz_expires.isdigit() and re.match(r'^\d{8}T\d{6}Z$', amz_date):
+        import calendar
+        signed = calendar.timegm(time.strptime(amz_date, "%Y%m%dT%H%M%SZ"))
+        expiries.append(signed + int(amz_expires))
+
+    return min(expiries) if expiries else None
+
+
+def normalize_url(url_str):
+    """Normalize a URL so trivially different spellings share a cache key."""
+    parsed = urlparse(url_str)
+    netloc = parsed.netloc.lower()
+    if parsed.scheme == "https" and netloc.endswith(":443"):
+        netloc = netloc[:-4]
+    elif parsed.scheme == "http" and netloc.endswith(":80"):
+        netloc = netloc[:-3]
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k not in TRACKING_QUERY_PARAMS and not k.startswith("utm_")
+    )
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=netloc, query=urlencode(query), fragment="").geturl()
+
+
+def _hash_text(text):
+    return hashlib.sha256((text or "").encode("utf-8", "replace")).hexdigest()
+
+
+def cache_key(request):
+    """Cache key for the active request: URL, profile, cookies, proxy, user agent,
+    playlist mode and page, extractor args and the output-shaping config."""
+    cookies_digest = hashlib.sha256(request.get("cookies_string", "").encode("utf-8", "replace"))
+    if request["cookies_file"]:
+        try:
+            with open(request["cookies_file"], "rb") as fh:
+                cookies_digest.update(fh.read(1024 * 1024))
+        except OSError:
+            pass
+
+    config = {k: LARGE_CONFIG.get(k) for k in CACHE_KEY_CONFIG_KEYS}
+    config.update(playlist_mode=request["playlist_mode"], page=request["page"],
+                  extractor_args=request["extractor_args"])
+    parts = [
+        normalize_url(request["url"]),
+        request["profile"],
+        cookies_digest.hexdigest(),
+        _hash_text(request["proxy_url"]),
+        _hash_text(request["user_agent"]),
+        _hash_text(json.dumps(config, sort_keys=True, default=str)),
+    ]
+    return _hash_text("\n".join(parts))
+
+
+def private_temp_dir(name):
+    """Per-user directory in the temp dir, created with owner-only permissions.
+
+    The temp dir is shared, so the path may already exist, created by
+    someone else to read or plant files. Raises OSError unless it is a
+    real directory owned by this user with no group/other permissions.
+    """
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    path = os.path.join(tempfile.gettempdir(), f"fdm-smo-{name}-{uid}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or stat.S_IMODE(st.st_mode) & 0o077:
+            raise OSError(f"{path} is not a private directory of this user")
+    return path
+
+
+def cache_dir():
+    """Per-user cache directory; raises OSError, which disables caching, when unsafe."""
+    return private_temp_dir("cache")
+
+
+def iter_output_formats(output):
+    """Yield every format in an output, including resolved playlist entries."""
+    yield from output.get("formats", [])
+    for entry in output.get("entries", []):
+        yield from entry.get("formats", [])
+
+
+def output_ttl(output):
+    """Seconds a formatted output stays valid, from its earliest signed-URL expiry."""
+    default_ttl = LARGE_CONFIG.get("cacheTtl", 1800)
+    max_ttl = CACHE_MAX_TTL
+    if output.get("_type") == "playlist":
+        default_ttl = max_ttl = min(CACHE_PLAYLIST_TTL, default_ttl)
+    elif "_resolvedFormat" in output:
+        default_ttl = max_ttl = min(CACHE_RESOLVED_FORMAT_TTL, default_ttl)
+
+    expiries = [fmt["_expiresAt"] for fmt in iter_output_formats(output) if fmt.get("_expiresAt")]
+    if not expiries:
+        return default_ttl
+    return min(min(expiries) - time.time() - CACHE_EXPIRY_MARGIN, max_ttl)
+
+
+def is_retryable_format_error(message):
+    """True for "no formats" errors a different extraction plan may avoid."""
+    lowered = (message or "").lower()
+    return any(pattern in lowered for pattern in RETRYABLE_ERROR_PATTERNS)
+
+
+def is_permanent_failure(message):
+    """True for errors (private, removed, geo-blocked...) worth caching briefly."""
+    lowered = (message or "").lower()
+    if is_retryable_format_error(lowered):
+        return False
+    return any(pattern in lowered for pattern in PERMANENT_ERROR_PATTERNS)
+
+
+def write_file_atomic(path, data):
+    """Write bytes via a temp file and rename so readers never see partial data."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def cache_get(key):
+    """Return a live cache entry ({"output": ...} or {"error": ...}) or None."""
+    try:
+        path = os.path.join(cache_dir(), key + ".json")
+        with open(path, "rb") as fh:
+            entry = json.loads(fh.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("expiresAt", 0) <= time.time():
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)  # mtime doubles as the LRU recency stamp
+    except OSError:
+        pass
+    return entry
+
+
+def cache_put(key, entry, ttl):
+    """Store a cache entry for ttl seconds and evict least recently used files."""
+    if ttl <= 0:
+        return
+    max_bytes = LARGE_CONFIG.get("cacheMaxBytes", 64 * 1024 * 1024)
+    data = json.dumps({**entry, "expiresAt": time.time() + ttl}).encode("utf-8")
+    if len(data) > max_bytes // 4:
+        return  # Not worth evicting a quarter of the cache for one entry
+    try:
+        directory = cache_dir()
+        write_file_atomic(os.path.join(directory, key + ".json"), data)
+        evict_cache(directory, max_bytes)
+    except OSError:
+        pass  # Caching is best effort
+
+
+def evict_cache(directory, max_bytes):
+    """Drop the least recently used entries until the cache fits max_bytes."""
+    files = []
+    total = 0
+    with os.scandir(directory) as it:
+        for item in it:
+            if not item.name.endswith(".json"):
+                continue
+            try:
+                st = item.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, item.path))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+    files.sort()
+    for _, size, path in files:
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
+
+
+# === PLAYLIST RESOLUTION ===
+
+def _url_host(url_str):
+    return urlparse(url_str).netloc.lower()
+
+
+def resolve_entry(entry_data, request, host_slots, deadline):
+    """Fully extract one playlist entry and attach its formats in place.
+
+    The extraction takes an admission slot like any other and must finish
+    by deadline. Leaves the bare URL entry untouched when the URL is
+    unsafe or the extraction fails; one cut short by the deadline (or
+    entryTimeout) is marked "_unresolved": "timeout".
+    """
+    url_valid, _ = is_safe_url(entry_data["url"])
+    if not url_valid:
+        return False
+    if time.monotonic() >= deadline:
+        entry_data["_unresolved"] = "timeout"
+        return False
+    entry_request = {
+        **request,
+        "url": entry_data["url"],
+        "playlist_mode": False,
+        "page": None,
+    }
+    with host_slots(_url_host(entry_data["url"])):
+        try:
+            with admission(entry_request, deadline):
+                entry_request["timeout"] = min(LARGE_CONFIG.get("entryTimeout", 60), deadline - time.monotonic())
+                info = run_planned_extraction(entry_request)
+            if info.get("_type") == "playlist":
+                return False
+            result = process_single_entry(info)
+        except ExtractionError as e:
+            if e.code == "TIMEOUT":
+                entry_data["_unresolved"] = "timeout"
+            return False
+        except Exception:
+            return False
+    if not result["formats"]:
+        return False
+    entry_data["formats"] = result["formats"]
+    for key in ("httpHeaders", "fragmentLists"):
+        if key in result:
+            entry_data[key] = result[key]
+    entry_data["_resolved"] = True
+    return True
+
+
+def resolve_playlist_entries(output, request, deadline=None):
+    """Resolve the first resolvePlaylistEntries entries concurrently.
+
+    Uses a bounded worker pool plus a per-host concurrency cap so one site
+    isn't hit by every worker at once. Everything finishes by deadline
+    (the request's timeout from now by default); entries it leaves
+    pending are counted in "_entriesTimedOut".
+    """
+    entries = output["entries"][:LARGE_CONFIG.get("resolvePlaylistEntries", 0)]
+    if not entries:
+        return output
+    deadline = deadline or time.monotonic() + request["timeout"]
+
+    per_host = max(1, LARGE_CONFIG.get("perHostConcurrency", 2))
+    semaphores = {}
+    semaphores_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def host_slots(host):
+        with semaphores_lock:
+            semaphore = semaphores.setdefault(host, threading.BoundedSemaphore(per_host))
+        with semaphore:
+            yield
+
+    import concurrent.futures
+    workers = max(1, min(LARGE_CONFIG.get("playlistWorkers", 4), len(entries)))
+
+    def resolve(entry_data):
+        with use_request(request):
+            return resolve_entry(entry_data, request, host_slots, deadline)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(resolve, entries))
+    output["_entriesResolved"] = sum(results)
+    timed_out = sum(1 for entry_data in entries if entry_data.get("_unresolved") == "timeout")
+    if timed_out:
+        output["_entriesTimedOut"] = timed_out
+    return output
+
+
+# === HLS PRE-RESOLUTION ===
+
+# Media playlists larger than this are not worth parsing for hints
+MAX_HLS_PLAYLIST_BYTES = 8 * 1024 * 1024
+MAX_HLS_FORMATS = 8
+
+_HLS_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_hls_attributes(text):
+    """Parse an M3U8 attribute list (KEY=value,KEY="quoted value")."""
+    return {key: value.strip('"') for key, value in _HLS_ATTRIBUTE.findall(text)}
+
+
+def parse_hls_byterange(value):
+    """Length of an EXT-X-BYTERANGE value ("length[@offset]"), or None."""
+    length = value.split("@", 1)[0].strip()
+    return int(length) if length.isdigit() else None
+
+
+def parse_media_playlist(text):
+    """Summarize an HLS media playlist: segments, durations, byte ranges.
+
+    Returns None for a master playlist or anything that isn't M3U8.
+    "bytes" is only set when every segment (and the init section) has an
+    explicit byte range, which makes it the exact media size.
+    """
+    lines = text.splitlines()
+    if not lines or not lines[0].lstrip("\ufeff").startswith("#EXTM3U"):
+        return None
+
+    segments = ranged = range_bytes = 0
+    total_duration = 0.0
+    target_duration = None
+    pending_range = None
+    init_bytes = 0
+    init_unranged = False
+    first_uri = None
+    single_file = True
+    encrypted = ended = False
+    for line in lines[1:]:
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("#"):
+            segments += 1
+            if pending_range is not None:
+                ranged += 1
+                range_bytes += pending_range
+                pending_range = None
+            if first_uri is None:
+                first_uri = line
+            elif line != first_uri:
+                single_file = False
+        elif line.startswith("#EXTINF:"):
+            try:
+                total_duration += float(line[8:].split(",", 1)[0])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            pending_range = parse_hls_byterange(line[17:])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            value = line[22:].strip()
+            target_duration = int(value) if value.isdigit() else None
+        elif line.startswith("#EXT-X-MAP:"):
+            init_range = parse_hls_byterange(parse_hls_attributes(line[11:]).get("BYTERANGE", ""))
+            if init_range is None:
+                init_unranged = True
+            else:
+                init_bytes += init_range
+        elif line.startswith("#EXT-X-KEY:"):
+            encrypted = encrypted or parse_hls_attributes(line[11:]).get("METHOD", "NONE") != "NONE"
+        elif line == "#EXT-X-ENDLIST":
+            ended = True
+        elif line.startswith("#EXT-X-STREAM-INF"):
+            return None  # Master playlist: the variants are separate formats
+
+    byte_ranges = segments > 0 and ranged == segments
+    return {
+        "segments": segments,
+        "targetDuration": target_duration,
+        "totalDuration": round(total_duration, 3),
+        "byteRanges": byte_ranges,
+        "singleFile": byte_ranges and single_file,
+        "bytes": range_bytes + init_bytes if byte_ranges and not init_unranged else None,
+        "live": not ended,
+        "encrypted": encrypted,
+    }
+
+
+def is_safe_hls_url(url):
+    """is_safe_url() for media playlist fetches and their redirects."""
+    return is_safe_url(url)[0]
+
+
+def build_hls_opener(request):
+    """A urllib opener using the request's proxy and cookies that only
+    follows redirects to URLs passing is_safe_hls_url. None when the proxy
+    can't be used by urllib (SOCKS), so nothing bypasses it."""
+    import urllib.request
+
+    proxy_url = request.get("proxy_url")
+    if proxy_url and urlparse(proxy_url).scheme not in ("http", "https"):
+        return None
+
+    class SafeRedirectHandler(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            if not is_safe_hls_url(newurl):
+                return None
+            return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+    handlers = [SafeRedirectHandler(), urllib.request.ProxyHandler(
+        {"http": proxy_url, "https": proxy_url} if proxy_url else {})]
+    if request.get("cookies_file"):
+        import http.cookiejar
+        jar = http.cookiejar.MozillaCookieJar()
+        try:
+            jar.load(request["cookies_file"], ignore_discard=True, ignore_expires=True)
+        except (OSError, http.cookiejar.LoadError):
+            pass
+        handlers.append(urllib.request.HTTPCookieProcessor(jar))
+    return urllib.request.build_opener(*handlers)
+
+
+def fetch_media_playlist(opener, url, headers, timeout):
+    """Download and parse one media playlist; raises OSError/ValueError on failure."""
+    import urllib.request
+
+    with opener.open(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+        data = response.read(MAX_HLS_PLAYLIST_BYTES + 1)
+    if len(data) > MAX_HLS_PLAYLIST_BYTES:
+        raise ValueError("Media playlist too large")
+    return parse_media_playlist(data.decode("utf-8", "replace"))
+
+
+def cached_media_playlist(opener, url, headers, timeout):
+    """parse_media_playlist() result for url, from the result cache when possible.
+
+    Finished (VOD) playlists are cached until their URL expires; live
+    ones change every target duration and are always fetched.
+    """
+    use_cache = LARGE_CONFIG.get("resultCache")
+    key = "hls-" + _hash_text(url) if use_cache else None
+    cached = cache_get(key) if key else None
+    if cached and "playlist" in cached:
+        return cached["playlist"], True
+
+    playlist = fetch_media_playlist(opener, url, headers, timeout)
+    if key and playlist and not playlist["live"]:
+        expiry = get_url_expiry(url)
+        ttl = expiry - time.time() - CACHE_EXPIRY_MARGIN if expiry else LARGE_CONFIG.get("cacheTtl", 1800)
+        cache_put(key, {"playlist": playlist}, min(ttl, CACHE_MAX_TTL))
+    return playlist, False
+
+
+def apply_media_playlist(fmt, playlist):
+    """Add segment, duration and size hints from a parsed media playlist to a format."""
+    fmt["_fragmentCount"] = playlist["segments"]
+    fmt["_multiFragment"] = playlist["segments"] > 100
+    if playlist["targetDuration"]:
+        fmt["_targetDuration"] = playlist["targetDuration"]
+    fmt["_totalDuration"] = playlist["totalDuration"]
+    if playlist["byteRanges"]:
+        fmt["_byteRanges"] = True
+        fmt["_singleFile"] = playlist["singleFile"]
+    if playlist["live"]:
+        fmt["_live"] = True
+    if playlist["encrypted"]:
+        fmt["_encrypted"] = True
+
+    size = playlist["bytes"]
+    if size:
+        fmt["_sizeExact"] = True
+    elif fmt.get("tbr") and playlist["totalDuration"] and not playlist["live"]:
+        size = int(fmt["tbr"] * 125 * playlist["totalDuration"])  # kbit/s to bytes
+    if size:
+        fmt["_estimatedSize"] = size
+        add_large_download_hints(fmt, size)
+
+
+def resolve_hls_formats(output, request):
+    """Fetch the media playlists of the top resolveHlsFormats HLS formats concurrently.
+
+    Formats are in rank order, so the first HLS ones of each object holding
+    formats are the likely downloads. A playlist that can't be fetched in
+    hlsPlaylistTimeout seconds (or isn't a media playlist) leaves its
+    format as it was.
+    """
+    limit = min(LARGE_CONFIG.get("resolveHlsFormats", 0), MAX_HLS_FORMATS)
+    jobs = []
+    for holder in [output] + output.get("entries", []):
+        hls_formats = [fmt for fmt in holder.get("formats", []) if fmt.get("protocol") == "m3u8_native"]
+        for fmt in hls_formats[:limit]:
+            if is_safe_hls_url(fmt["url"]):
+                headers = {**holder.get("httpHeaders", {}), **fmt.get("httpHeaders", {})}
+                headers.pop("Accept-Ranges", None)
+                if active.cookies_string:
+                    headers["Cookie"] = sanitize_text_output(active.cookies_string, 8192)
+                jobs.append((fmt, headers))
+    if not jobs:
+        return output
+    opener = build_hls_opener(request)
+    if opener is None:
+        return output
+
+    timeout = LARGE_CONFIG.get("hlsPlaylistTimeout", 5)
+
+    def fetch(job):
+        fmt, headers = job
+        try:
+            with use_request(request):
+                return cached_media_playlist(opener, fmt["url"], headers, timeout)
+        except (OSError, ValueError):
+            return None, False
+
+    # Up to MAX_HLS_FORMATS per object holding formats; resolved playlist
+    # entries share one bounded pool
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(jobs), MAX_HLS_FORMATS)) as pool:
+        results = list(pool.map(fetch, jobs))
+
+    resolved = 0
+    for (fmt, _), (playlist, from_cache) in zip(jobs, results):
+        if not playlist:
+            continue
+        apply_media_playlist(fmt, playlist)
+        resolved += 1
+        if active.timings is not None:
+            active.timings.counts["hlsPlaylistsCached" if from_cache else "hlsPlaylistsFetched"] += 1
+    output["_hlsResolved"] = resolved
+    return output
+
+
+# === PLAYLIST PAGINATION ===
+
+def _cursor_scope(url):
+    """Short digest tying a cursor to the playlist it was issued for."""
+    return _hash_text(normalize_url(url))[:16]
+
+
+def encode_cursor(url, offset, size):
+    import base64
+    payload = json.dumps({"v": 1, "u": _cursor_scope(url), "o": offset, "n": size}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, url):
+    """Return (offset, size) from a cursor issued for this URL; raises ExtractionError."""
+    import base64
+    try:
+        if not isinstance(cursor, str) or len(cursor) > 256:
+            raise ValueError
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset, size = payload["o"], payload["n"]
+        if (payload.get("v") != 1 or payload.get("u") != _cursor_scope(url)
+                or not isinstance(offset, int) or not isinstance(size, int) or offset < 0 or size < 1):
+            raise ValueError
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ExtractionError("Invalid playlist cursor", "INVALID_CURSOR")
+    return offset, size
+
+
+def requested_page(url):
+    """(offset, size) of the requested playlist page, or None when not paging."""
+    cursor = LARGE_CONFIG.get("playlistCursor")
+    if cursor:
+        offset, size = decode_cursor(cursor, url)
+    else:
+        offset, size = LARGE_CONFIG.get("playlistOffset") or 0, LARGE_CONFIG.get("playlistPageSize") or 0
+        if not isinstance(offset, int) or not isinstance(size, int) or offset < 0 or size < 0:
+            raise ExtractionError("Security: Invalid playlist page")
+        if not size:
+            return None
+    return offset, min(size, LARGE_CONFIG.get("maxPlaylistEntries", 500))
+
+
+def playlist_item_range(request, bounded=False):
+    """yt-dlp playlist_items range for the request, or None for the whole playlist.
+
+    Asks for one entry past the page (or past maxPlaylistEntries when
+    bounded) so a full page can be told apart from the last one.
+    """
+    if not request["playlist_mode"] or not (request["page"] or bounded):
+        return None
+    offset = request["page"][0] if request["page"] else 0
+    return f"{offset + 1}-{offset + LARGE_CONFIG.get('maxPlaylistEntries', 500) + 1}"
+
+
+def add_page_fields(output, request, has_more):
+    """Add the page position and the cursor for the next page, if any."""
+    offset, size = request["page"]
+    output["_page"] = {"offset": offset, "size": size}
+    output["_nextCursor"] = encode_cursor(request["url"], offset + size, size) if has_more else None
+    if output.get("_totalEntries") is None and not has_more:
+        output["_totalEntries"] = offset + output["_entriesIncluded"]
+    return output
+
+
+def build_page_output(info, request):
+    """Playlist output for one page of a paged request."""
+    output = build_playlist_output(info)
+    offset, size = request["page"]
+    has_more = len(info["entries"]) > size
+    if info.get("playlist_count"):
+        has_more = has_more or offset + size < info["playlist_count"]
+    output["_totalEntries"] = info.get("playlist_count")
+    return add_page_fields(output, request, has_more)
+
+
+# === PLAYLIST STREAMING ===
+
+# Playlist-level fields yt-dlp copies onto every flat entry
+PLAYLIST_HEADER_FIELDS = {
+    "id": "playlist_id",
+    "title": "playlist_title",
+    "webpage_url": "playlist_webpage_url",
+}
+
+# Keys of the first stream line; a cached stream is the header plus its trailer fields
+STREAM_HEADER_KEYS = ("_type", "_stream", "id", "title", "webpage_url")
+
+_STREAM_END = object()
+
+
+class PlaylistEntryStream:
+    """Flat playlist entries handed over as yt-dlp enumerates them.
+
+    yt-dlp runs on a background thread in lazy playlist mode; entries arrive
+    on a queue so they can be written out before enumeration finishes.
+    Entries carry yt-dlp's playlist_* fields; anything else the run returns
+    (a single video, or the final playlist dict) ends up in .info.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.queue = queue.Queue()
+        self.info = None
+        self.error = None
+        self.truncated = None
+        self.proc = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        """Stop enumerating; entries already queued are dropped."""
+        self.stopped.set()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+    def iter_entries(self, deadline):
+        """Yield raw entries until the run ends, or stop it once the deadline passes."""
+        while True:
+            try:
+                e = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.truncated = "timeout"
+                self.stop()
+                return
+            if e is _STREAM_END:
+                return
+            if e:
+                yield e
+
+    def _run(self):
+        with use_request(self.request):
+            try:
+                ytdlp_module = select_engine()
+                if ytdlp_module:
+                    self._run_inprocess(ytdlp_module)
+                else:
+                    self._run_subprocess()
+            except ExtractionError as e:
+                self.error = e
+            except Exception as e:
+                # Stopping an in-process run surfaces as yt-dlp's DownloadCancelled
+                if not self.stopped.is_set():
+                    self.error = ExtractionError(sanitize_error_output(f"Failed to run yt-dlp: {e}"))
+            finally:
+                self.queue.put(_STREAM_END)
+
+    def _run_inprocess(self, ytdlp):
+        stream = self
+
+        class EntrySink(ytdlp.postprocessor.PostProcessor):
+            # pre_process hooks see each flat entry as soon as it's enumerated
+            def run(self, info):
+                if stream.stopped.is_set():
+                    raise ytdlp.utils.DownloadCancelled()
+                if "playlist_index" in info:
+                    stream.queue.put(dict(info))
+                return [], info
+
+        collector = _ErrorCollector()
+        opts = build_ytdlp_options(True, self.request["cookies_file"], self.request["proxy_url"],
+                                   self.request["user_agent"], playlist_item_range(self.request, True))
+        opts.update(lazy_playlist=True, logger=collector)
+        with ytdlp.YoutubeDL(opts) as ydl:
+            ydl.add_post_processor(EntrySink(), when="pre_process")
+            info = ydl.extract_info(self.request["url"], download=False)
+        if not info:
+            raise ExtractionError(sanitize_error_output("\n".join(collector.errors)))
+        self.info = project_info(info)
+
+    def _run_subprocess(self):
+        cmd = build_ytdlp_command(self.request["url"], True, self.request["cookies_file"],
+                                  self.request["proxy_url"], self.request["user_agent"],
+                                  playlist_item_range(self.request, True))
+        # -j prints every entry as its own line instead of one document at the end
+        cmd[cmd.index("-J")] = "-j"
+        cmd.insert(1, "--lazy-playlist")
+        import subprocess
+        try:
+            self.proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=False,  # CRITICAL: Never use shell=True
+                env={**os.environ, "PYTHONIOENCODING": "utf-8"}
+            )
+        except Exception as e:
+            raise ExtractionError(f"Failed to run yt-dlp: {e}")
+
+        stderr_chunks, stderr_thread = drain_stderr(self.proc)
+
+        max_bytes = LARGE_CONFIG.get("maxOutputSize", 50 * 1024 * 1024)
+        received = 0
+        try:
+            for line in self.proc.stdout:
+                received += len(line)
+                if received > max_bytes:
+                    self.truncated = "maxOutputSize"
+                    self.proc.kill()
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    value = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(value, dict) and "playlist_index" in value:
+                    self.queue.put(value)
+                else:
+                    self.info = project_info(value)
+            self.proc.wait()
+        finally:
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+            stderr_thread.join(5)
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+
+        if self.proc.returncode != 0 and not (self.truncated or self.stopped.is_set()) and self.info is None:
+            stderr = b"".join(stderr_chunks).decode("utf-8", "replace")
+            self.error = ExtractionError(sanitize_error_output(stderr))
+
+
+def build_stream_header(source, request):
+    """First line of a playlist stream, from a flat entry or the playlist dict."""
+    is_entry = "playlist_index" in source
+    header = {"_type": "playlist", "_stream": True}
+    for key, entry_key in PLAYLIST_HEADER_FIELDS.items():
+        header[key] = source.get(entry_key) if is_entry else source.get(key)
+    header["id"] = sanitize_text_output(header["id"], 128)
+    header["title"] = sanitize_text_output(header["title"] or "Playlist", 512)
+    header["webpage_url"] = sanitize_url_output(header["webpage_url"] or request["url"])
+    return header
+
+
+def write_stream_line(obj):
+    sys.stdout.write(dump_output(obj) + "\n")
+    sys.stdout.flush()
+
+
+def stream_playlist(request, header_extra=None):
+    """Write a playlist as NDJSON: a header, one line per entry, then a trailer.
+
+    Entries are written as yt-dlp finds them. Hitting the extraction timeout,
+    maxPlaylistEntries or maxOutputSize ends the stream early with whatever
+    was found and a "_truncated" reason in the trailer instead of an error.
+    A URL that turns out not to be a playlist gets the regular single output.
+    header_extra is merged into the first line written.
+    """
+    header_extra = header_extra or {}
+    key = cache_key(request) if LARGE_CONFIG.get("resultCache") else None
+    cached = cache_get(key) if key else None
+    if cached and "error" in cached:
+        raise ExtractionError(cached["error"], cached.get("errorCode"))
+    if cached and "output" in cached:
+        output = cached["output"]
+        if output.get("_type") != "playlist":
+            output["_cached"] = True
+            write_stream_line({**attach_cookies(output), **header_extra})
+            return
+        write_stream_line({**{k: output[k] for k in STREAM_HEADER_KEYS if k in output}, **header_extra})
+        for entry_data in output["entries"]:
+            write_stream_line(entry_data)
+        trailer = {k: v for k, v in output.items() if k not in STREAM_HEADER_KEYS and k != "entries"}
+        trailer = {"_streamEnd": True, **trailer, "_cached": True}
+        if active.timings is not None:
+            trailer["_timings"] = active.timings.to_dict()
+        write_stream_line(trailer)
+        return
+
+    max_entries = LARGE_CONFIG.get("maxPlaylistEntries", 500)
+    stream = PlaylistEntryStream(request)
+    stream.start()
+    deadline = time.monotonic() + request["timeout"]
+
+    header = None
+    entries = []
+    total_entries = None
+    truncated = None
+    for e in stream.iter_entries(deadline):
+        if total_entries is None:
+            total_entries = e.get("playlist_count")
+        if len(entries) >= max_entries:
+            truncated = "maxPlaylistEntries"
+            stream.stop()
+            break
+        entry_data = build_playlist_entry(e)
+        if not entry_data:
+            continue
+        if header is None:
+            header = build_stream_header(e, request)
+            write_stream_line({**header, **header_extra})
+        write_stream_line(entry_data)
+        entries.append(entry_data)
+    truncated = truncated or stream.truncated
+
+    if header is None:
+        # Nothing streamed: report the failure, or the non-playlist result
+        if stream.error and not truncated:
+            if key and is_permanent_failure(str(stream.error)):
+                cache_put(key, error_output(stream.error), LARGE_CONFIG.get("cacheNegativeTtl", 300))
+            raise stream.error
+        if stream.info and stream.info.get("_type") != "playlist":
+            output = process_single_entry(stream.info)
+            if key:
+                cache_put(key, {"output": output}, output_ttl(output))
+            write_stream_line({**attach_cookies(output), **header_extra})
+            return
+        if truncated == "timeout":
+            raise ExtractionError(f"Extraction timed out after {request['timeout']} seconds. Try a more specific URL.", "TIMEOUT")
+        header = build_stream_header(stream.info or {}, request)
+        write_stream_line({**header, **header_extra})
+
+    trailer = {"_streamEnd": True}
+    if not truncated and stream.error:
+        truncated = "error"
+        trailer["_error"] = str(stream.error)
+    trailer["_totalEntries"] = total_entries or (None if truncated or request["page"] else len(entries))
+    trailer["_entriesIncluded"] = len(entries)
+    if request["page"]:
+        # Filling the page is the normal end of a paged stream
+        has_more = truncated == "maxPlaylistEntries"
+        if has_more:
+            truncated = None
+        add_page_fields(trailer, request, has_more)
+    if truncated:
+        trailer["_truncated"] = truncated
+    if active.timings is not None:
+        active.timings.counts["entriesStreamed"] += len(entries)
+        trailer["_timings"] = active.timings.to_dict()
+    write_stream_line(trailer)
+
+    # Only complete (or deterministically capped) listings are worth reusing
+    if key and trailer.get("_truncated", "maxPlaylistEntries") == "maxPlaylistEntries":
+        output = dict(header, entries=entries)
+        output.update((k, v) for k, v in trailer.items() if k not in ("_streamEnd", "_timings"))
+        cache_put(key, {"output": output}, output_ttl(output))
+
+
+# === PLAYLIST SYNC ===
+
+def sync_dir():
+    """Per-user directory of seen-entry archives; kept out of the temp dir so syncs survive reboots."""
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "fdm-smo", "sync")
+
+
+def sync_archive_path(url):
+    return os.path.join(sync_dir(), _hash_text(normalize_url(url)) + ".json")
+
+
+def load_sync_archive(path):
+    """(entry IDs already returned, newest first; incomplete flag), or (None, False) on first sync.
+
+    incomplete is set while an earlier sync was cut short and entries past
+    the ones it returned have not been returned yet.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            archive = json.load(fh)
+        ids = archive["ids"]
+        if archive.get("v") != 1 or not isinstance(ids, list):
+            return None, False
+        return [i for i in ids if isinstance(i, str)], bool(archive.get("incomplete"))
+    except (OSError, ValueError, KeyError, TypeError):
+        # Missing or damaged archive: treat as a first sync
+        return None, False
+
+
+def save_sync_archive(path, ids, incomplete=False):
+    """Atomically write the archive, keeping the newest syncArchiveSize IDs."""
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        archive = {"v": 1, "ids": ids[:LARGE_CONFIG.get("syncArchiveSize", 10000)]}
+        if incomplete:
+            archive["incomplete"] = True
+        data = json.dumps(archive, separators=(",", ":"))
+        write_file_atomic(path, data.encode("utf-8"))
+    except OSError:
+        pass  # The next sync just returns these entries again
+
+
+def sync_entry_id(e):
+    """Stable identity of a flat playlist entry."""
+    return str(e.get("id") or normalize_url(e.get("webpage_url") or e.get("url") or ""))[:256]
+
+
+def sync_playlist(request):
+    """Return only the playlist entries earlier syncs haven't returned.
+
+    Enumeration stops after syncStopAfterKnown consecutive known entries,
+    which for newest-first sources (channels, uploads) means only the new
+    head of the playlist is fetched. Returned entries are added to the
+    per-playlist archive so the next sync skips them.
+
+    A sync cut short (maxPlaylistEntries, timeout, error) marks the archive
+    incomplete; until a sync gets through the whole playlist, known
+    entries are scanned past instead of ending the sync, so the entries
+    the short sync never reached are still returned.
+    """
+    path = sync_archive_path(request["url"])
+    known_ids, incomplete = load_sync_archive(path)
+    known = set(known_ids or ())
+    stop_after = LARGE_CONFIG.get("syncStopAfterKnown", 5) if known_ids and not incomplete else 0
+    max_entries = LARGE_CONFIG.get("maxPlaylistEntries", 500)
+
+    stream = PlaylistEntryStream(request)
+    stream.start()
+    deadline = time.monotonic() + request["timeout"]
+
+    source = None
+    entries = []
+    new_ids = []
+    skipped = 0
+    known_run = 0
+    total_entries = None
+    stopped_early = False
+    truncated = None
+    for e in stream.iter_entries(deadline):
+        source = source or e
+        if total_entries is None:
+            total_entries = e.get("playlist_count")
+        entry_id = sync_entry_id(e)
+        if entry_id in known:
+            skipped += 1
+            known_run += 1
+            if stop_after and known_run >= stop_after:
+                stopped_early = True
+                stream.stop()
+                break
+            continue
+        known_run = 0
+        if len(entries) >= max_entries:
+            truncated = "maxPlaylistEntries"
+            stream.stop()
+            break
+        entry_data = build_playlist_entry(e)
+        if entry_data:
+            entries.append(entry_data)
+            new_ids.append(entry_id)
+            known.add(entry_id)
+    truncated = truncated or stream.truncated
+
+    if source is None:
+        if stream.error and not truncated:
+            raise stream.error
+        if stream.info and stream.info.get("_type") != "playlist":
+            return attach_cookies(process_single_entry(stream.info))
+        if truncated == "timeout":
+            raise ExtractionError(f"Extraction timed out after {request['timeout']} seconds. Try a more specific URL.", "TIMEOUT")
+
+    output = build_stream_header(source or stream.info or {}, request)
+    del output["_stream"]
+    if not truncated and stream.error and not stopped_early:
+        truncated = "error"
+    output["entries"] = entries
+    output["_totalEntries"] = total_entries
+    output["_entriesIncluded"] = len(entries)
+    output["_sync"] = {
+        "new": len(entries),
+        "skipped": skipped,
+        "initial": known_ids is None,
+        "stoppedEarly": stopped_early,
+    }
+    if truncated:
+        output["_truncated"] = truncated
+        output["_sync"]["incomplete"] = True
+
+    # An early stop means everything older was returned by earlier syncs
+    if new_ids or incomplete != bool(truncated):
+        save_sync_archive(path, new_ids + (known_ids or []), incomplete=bool(truncated))
+    return output
+
+
+# === ADMISSION CONTROL ===
+
+# A shared result is reused by requests that waited on the extraction that
+# produced it, or that arrive just after it finished
+FLIGHT_RESULT_TTL = 10
+
+# Flight files unused for a day are pruned, checked at most once an hour
+LOCK_MAX_AGE = 24 * 3600
+LOCK_PRUNE_INTERVAL = 3600
+
+
+# Slot files held by the admission() block running on this thread
+_admission_slots = threading.local()
+
+
+def lock_dir():
+    """Per-user directory of slot and single-flight lock files.
+
+    Raises OSError when the directory isn't private to this user; slots
+    and single-flight are then skipped.
+    """
+    return private_temp_dir("locks")
+
+
+def try_lock_file(path):
+    """Open path and lock it exclusively without blocking; the open file, or None.
+
+    The lock belongs to the open file, so the OS drops it when the file is
+    closed or the process dies - a crashed run never keeps a slot.
+    """
+    fh = open(path, "a+b")
+    try:
+        fh.seek(0)
+        if fcntl:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        return fh
+    except OSError:
+        fh.close()
+        return None
+
+
+def wait_for_lock(paths, deadline):
+    """Lock the first free file of paths, polling with backoff until deadline.
+
+    Returns the locked file, or None once the deadline has passed.
+    """
+    delay = 0.02
+    while True:
+        for path in paths:
+            fh = try_lock_file(path)
+            if fh:
+                return fh
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+
+
+def slot_paths(directory, name, count):
+    """Slot files of one limit, starting at a per-process offset to spread contention."""
+    start = os.getpid() % count
+    return [os.path.join(directory, f"slot-{name}-{(start + i) % count}.lock") for i in range(count)]
+
+
+def site_key(url):
+    """The part of a URL's host naming the site (example.com for www.example.com)."""
+    return ".".join((_url_host(url) or "").split(".")[-2:])
+
+
+@contextlib.contextmanager
+def admission(request, deadline=None):
+    """Hold a per-site and a host-wide extraction slot while yt-dlp runs.
+
+    The limits (maxSiteExtractions, maxConcurrentExtractions) are shared
+    by every extractor.py process and the warm service of this user.
+    Yields the seconds spent queueing; raises a TIMEOUT ExtractionError
+    when no slot frees up before deadline. Without a usable lock
+    directory nothing is limited.
+    """
+    deadline = deadline or time.monotonic() + request["timeout"]
+    started = time.monotonic()
+    limits = [
+        ("site-" + _hash_text(site_key(request["url"]))[:16], LARGE_CONFIG.get("maxSiteExtractions", 2)),
+        ("all", LARGE_CONFIG.get("maxConcurrentExtractions", 4)),
+    ]
+    held = []
+    outer = getattr(_admission_slots, "held", None)
+    _admission_slots.held = held
+    try:
+        try:
+            directory = lock_dir()
+        except OSError:
+            limits = []
+        # Site slot first: waiting on it must not hold up other sites
+        for name, count in limits:
+            if not isinstance(count, int) or count <= 0:
+                continue
+            with timed("queue"):
+                fh = wait_for_lock(slot_paths(directory, name, count), deadline)
+            if fh is None:
+                raise ExtractionError("Timed out waiting for other extractions to finish. Try again shortly.", "TIMEOUT")
+            held.append(fh)
+        yield time.monotonic() - started
+    finally:
+        _admission_slots.held = outer
+        for fh in held:
+            fh.close()
+
+
+def hold_admission_until(thread):
+    """Keep this thread's admission slots until thread finishes.
+
+    For a request giving up on work it can't stop (an in-process
+    extraction past its timeout): the slots stay taken while the
+    abandoned work still runs, instead of admitting more on top of it.
+    """
+    held = getattr(_admission_slots, "held", None)
+    if not held:
+        return
+    files = list(held)
+    del held[:]
+
+    def release():
+        thread.join()
+        for fh in files:
+            fh.close()
+
+    threading.Thread(target=release, daemon=True).start()
+
+
+def prune_lock_dir(directory):
+    """Delete flight files unused for LOCK_MAX_AGE, at most once per LOCK_PRUNE_INTERVAL."""
+    marker = os.path.join(directory, ".pruned")
+    try:
+        if time.time() - os.path.getmtime(marker) < LOCK_PRUNE_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        with open(marker, "ab"):
+            pass
+        os.utime(marker)
+        cutoff = time.time() - LOCK_MAX_AGE
+        for entry in os.scandir(directory):
+            if entry.name.startswith("flight-") and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+    except OSError:
+        pass
+
+
+def open_flight(key, deadline):
+    """Lock the single-flight file of a request key, waiting while another
+    process extracts the same request.
+
+    Returns (locked file or None, seconds waited). The file carries the
+    last result written with write_flight_result().
+    """
+    try:
+        directory = lock_dir()
+    except OSError:
+        return None, 0.0
+    prune_lock_dir(directory)
+    started = time.monotonic()
+    with timed("queue"):
+        fh = wait_for_lock([os.path.join(directory, f"flight-{key[:32]}.lock")], deadline)
+    return fh, time.monotonic() - started
+
+
+def read_flight_result(fh):
+    """The result another process left in a flight file, if still fresh."""
+    try:
+        fh.seek(0)
+        entry = json.loads(fh.read() or b"null")
+    except (OSError, ValueError):
+        return None
+    if isinstance(entry, dict) and entry.get("expiresAt", 0) > time.time():
+        return entry
+    return None
+
+
+def write_flight_result(fh, entry):
+    """Leave an output/error entry in a locked flight file for waiting requests."""
+    try:
+        fh.seek(0)
+        fh.truncate()
+        fh.write(json.dumps({**entry, "expiresAt": time.time() + FLIGHT_RESULT_TTL}).encode("utf-8"))
+        fh.flush()
+    except OSError:
+        pass
+
+
+# === REQUEST HANDLING ===
+
+def configure_request(url, profile_arg="BALANCED", cookies_file=None, cookies_string_arg="",
+                      proxy_url=None, user_agent_arg=None, config_override=None):
+    """Validate and sanitize all inputs and make them the active request.
+
+    Sets LARGE_CONFIG to the defaults plus config_override and makes the
+    request's profile/user agent/cookies the active ones on this thread.
+    Returns a request dict for extract(); raises ExtractionError on bad input.
+    """
+    url_valid, url_error = is_safe_url(url)
+    if not url_valid:
+        raise ExtractionError(f"Security: {url_error}")
+    request = request_for_url(configure_settings(profile_arg, cookies_file, cookies_string_arg, proxy_url,
+                                                 user_agent_arg, config_override), url)
+    activate(request)
+    return request
+
+
+def configure_settings(profile_arg="BALANCED", cookies_file=None, cookies_string_arg="",
+                       proxy_url=None, user_agent_arg=None, config_override=None):
+    """The URL-independent part of configure_request().
+
+    Returns a request dict without URL fields; see request_for_url().
+    """
+    active.timings = None
+    try:
+        req_profile = validate_profile(profile_arg)
+        cookies_file = sanitize_string_arg(cookies_file or None, "cookies_file", 1024)
+        req_cookies_string = sanitize_string_arg(cookies_string_arg or "", "cookies_string", 8192)
+        proxy_url = sanitize_string_arg(proxy_url or None, "proxy_url", 512)
+        req_user_agent = sanitize_string_arg(user_agent_arg or None, "user_agent", 512)
+
+        # Validate proxy URL if provided
+        if proxy_url:
+            proxy_valid, proxy_error = is_safe_url(proxy_url.replace("socks5://", "http://").replace("socks4://", "http://"))
+            if not proxy_valid and "scheme" not in (proxy_error or ""):
+                raise ExtractionError(f"Security: Invalid proxy URL - {proxy_error}")
+    except ValueError as e:
+        raise ExtractionError(f"Security: {e}")
+
+    # Validate cookies file for authenticated downloads
+    validated_cookies = None
+    if cookies_file:
+        try:
+            validated_cookies = validate_file_path(cookies_file, must_exist=True)
+        except ValueError as e:
+            raise ExtractionError(f"Security: Cookies file - {e}")
+
+    config = DEFAULT_LARGE_CONFIG.copy()
+    if isinstance(config_override, dict):
+        config.update(config_override)
+    state = {
+        "config": config,
+        "profile": req_profile,
+        "user_agent": req_user_agent,
+        "cookies_string": req_cookies_string,
+        "timings": Timings() if config.get("timings") else None,
+    }
+    request = {
+        "state": state,
+        "profile": req_profile,
+        "cookies_file": validated_cookies,
+        "cookies_string": req_cookies_string or "",
+        "proxy_url": proxy_url,
+        "user_agent": req_user_agent,
+        # Extraction timeout from config
+        "timeout": config.get("extractionTimeout", 300),
+    }
+    activate(request)
+    # Plans come from this request's extractionPlans, so only once it's active
+    request["extractor_args"] = extraction_plan(req_profile)
+    return request
+
+
+def request_for_url(request, url):
+    """A request dict for a validated URL under the settings of request.
+
+    Derives the playlist mode and requested page from the URL; a page
+    also sets maxPlaylistEntries, in a config of the new request's own.
+    """
+    # Check if this looks like a playlist URL
+    is_playlist_url = any(pattern in url.lower() for pattern in [
+        'list=', '/playlist/', '/album/', '/channel/', '/user/', '/c/', '/sets/', '/@'
+    ])
+
+    # Get playlist context from config
+    is_playlist_context = LARGE_CONFIG.get("isPlaylistContext", False)
+    # A format is resolved/refreshed from the single video, even on a playlist URL
+    single_format = LARGE_CONFIG.get("resolveFormat") is not None or LARGE_CONFIG.get("refreshFormat") is not None
+    playlist_mode = bool(is_playlist_url or is_playlist_context) and not single_format
+
+    page = requested_page(url) if playlist_mode else None
+    state = request["state"]
+    if page:
+        state = {**state, "config": {**state["config"], "maxPlaylistEntries": page[1]}}
+
+    return {**request, "state": state, "url": url, "playlist_mode": playlist_mode, "page": page}
+
+
+def run_extraction(request, ydl=None, collector=None):
+    """Run yt-dlp for a configured request and return the raw info dict."""
+    # A pooled YoutubeDL implies the in-process engine; the plan is read
+    # from its params on every extraction
+    if ydl is not None:
+        ydl.params["extractor_args"] = request["extractor_args"]
+        ydl.params["ignore_no_formats_error"] = bool(request["extractor_args"])
+        return run_ytdlp_inprocess(None, request["url"], None, request["timeout"], ydl, collector)
+
+    # Prefer the in-process engine; fall back to the yt-dlp executable when the
+    # module can't be imported (or the subprocess engine is forced via config)
+    with timed("engine"):
+        ytdlp_module = select_engine()
+    if ytdlp_module:
+        ydl_opts = build_ytdlp_options(request["playlist_mode"], request["cookies_file"],
+                                       request["proxy_url"], request["user_agent"],
+                                       playlist_item_range(request), request["extractor_args"])
+        return run_ytdlp_inprocess(ytdlp_module, request["url"], ydl_opts, request["timeout"])
+
+    cmd = build_ytdlp_command(request["url"], request["playlist_mode"], request["cookies_file"],
+                              request["proxy_url"], request["user_agent"], playlist_item_range(request),
+                              request["extractor_args"])
+    return run_ytdlp_subprocess(cmd, request["timeout"])
+
+
+def has_usable_formats(info):
+    """Whether a single-video info dict has any format the output builders can use."""
+    return any(is_format_usable(f) for f in info.get("formats") or [])
+
+
+def run_planned_extraction(request, ydl=None, collector=None):
+    """run_extraction() with the profile's plan, retried without it when the
+    plan left a video with no usable formats (e.g. an HLS-only live stream).
+
+    The plan's extraction runs with ignore_no_formats_error, so this usually
+    sees an info dict without formats; the error is still caught for yt-dlp
+    builds that raise it anyway. URLs of other sites run without a plan.
+    """
+    request = {**request, "extractor_args": plan_for_url(request["extractor_args"] or {}, request["url"])}
+    if not request["extractor_args"]:
+        return run_extraction(request, ydl, collector)
+    try:
+        info = run_extraction(request, ydl, collector)
+    except ExtractionError as e:
+        if not is_retryable_format_error(str(e)):
+            raise
+        info = None
+    if info is None or (info.get("_type") != "playlist" and not has_usable_formats(info)):
+        info = run_extraction({**request, "extractor_args": {}}, ydl, collector)
+    return info
+
+
+def attach_cookies(output):
+    """Add the request's cookie string to every format.
+
+    With compactHeaders it is added once to each object holding formats
+    (the output itself or resolved playlist entries) instead. Kept out of
+    build_format so cached outputs never hold cookie values.
+    """
+    if not active.cookies_string:
+        return output
+    cookies = sanitize_text_output(active.cookies_string, 8192)
+    if not LARGE_CONFIG.get("compactHeaders", True):
+        for fmt in iter_output_formats(output):
+            fmt["cookies"] = cookies
+        return output
+    for holder in [output] + output.get("entries", []):
+        if holder.get("formats"):
+            holder["cookies"] = cookies
+    return output
+
+
+def extract(request, ydl=None, collector=None):
+    """Extract and format media info for a configured request."""
+    refresh_format = LARGE_CONFIG.get("refreshFormat")
+    with timed("cacheLookup"):
+        # A refresh exists to get newer URLs than any cached output has
+        key = cache_key(request) if LARGE_CONFIG.get("resultCache") and refresh_format is None else None
+        cached = cache_get(key) if key else None
+    if cached and "error" in cached:
+        raise ExtractionError(cached["error"], cached.get("errorCode"))
+    if cached and "output" in cached:
+        output = cached["output"]
+        output["_cached"] = True
+        return attach_cookies(output)
+
+    # Identical concurrent requests queue behind one extraction and reuse
+    # its result; everything else waits for an admission slot
+    deadline = time.monotonic() + request["timeout"]
+    flight, waited = None, 0.0
+    if LARGE_CONFIG.get("singleFlight", True):
+        flight, waited = open_flight(key or cache_key(request), deadline)
+    try:
+        shared = read_flight_result(flight) if flight else None
+        if shared and "error" in shared:
+            raise ExtractionError(shared["error"], shared.get("errorCode"))
+        if shared and "output" in shared:
+            output = shared["output"]
+            output["_coalesced"] = True
+            output["_queueWaitMs"] = round(waited * 1000)
+            return attach_cookies(output)
+
+        with admission(request, deadline) as queued:
+            waited += queued
+            try:
+                info = run_planned_extraction(request, ydl, collector)
+                if refresh_format is not None:
+                    output = build_refreshed_format(info, str(refresh_format))
+                elif LARGE_CONFIG.get("resolveFormat") is not None:
+                    output = build_resolved_format(info, str(LARGE_CONFIG["resolveFormat"]))
+                elif request["page"] and info.get("_type") == "playlist":
+                    output = build_page_output(info, request)
+                else:
+                    output = build_output(info)
+            except ExtractionError as e:
+                if flight:
+                    write_flight_result(flight, error_output(e))
+                if key and is_permanent_failure(str(e)):
+                    cache_put(key, error_output(e), LARGE_CONFIG.get("cacheNegativeTtl", 300))
+                raise
+        # Entry extractions queue for slots of their own and playlist fetches
+        # need none, so the playlist's slots are already released here
+        if output.get("_type") == "playlist" and LARGE_CONFIG.get("resolvePlaylistEntries", 0) > 0:
+            with timed("resolveEntries"):
+                resolve_playlist_entries(output, request, deadline)
+        if refresh_format is None and LARGE_CONFIG.get("resolveHlsFormats", 0) > 0:
+            with timed("resolveHls"):
+                resolve_hls_formats(output, request)
+        if flight:
+            write_flight_result(flight, {"output": output})
+    finally:
+        if flight:
+            flight.close()
+
+    if key:
+        with timed("cacheStore"):
+            cache_put(key, {"output": output}, output_ttl(output))
+    output["_queueWaitMs"] = round(waited * 1000)
+    return attach_cookies(output)
+
+
+def error_output(error):
+    """Build the error object returned to the plugin."""
+    output = {"error": str(error)}
+    if getattr(error, "code", None):
+        output["errorCode"] = error.code
+    return output
+
+
+def parse_args(argv):
+    """Map extractor.py positional arguments to configure_request() kwargs."""
+    config_override = {}
+    # Parse large download configuration if provided
+    if len(argv) > 7 and argv[7]:
+        try:
+            config_override = json.loads(argv[7])
+        except json.JSONDecodeError:
+            pass  # Use defaults if parsing fails
+
+    return {
+        "url": argv[1],
+        "profile_arg": argv[2] if len(argv) > 2 else "BALANCED",
+        "cookies_file": argv[3] if len(argv) > 3 and argv[3] else None,
+        "cookies_string_arg": argv[4] if len(argv) > 4 and argv[4] else "",
+        "proxy_url": argv[5] if len(argv) > 5 and argv[5] else None,
+        "user_agent_arg": argv[6] if len(argv) > 6 and argv[6] else None,
+        "config_override": config_override,
+    }
+
+
+# === WARM SERVICE CLIENT ===
+
+def service_socket_path():
+    """Per-user Unix socket path of the warm extraction service."""
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(tempfile.gettempdir(), f"fdm-smo-{uid}.sock")
+
+
+def start_service(path):
+    """Launch extractor_service.py detached so later requests find it warm."""
+    import subprocess
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extractor_service.py")
+    try:
+        subprocess.Popen(
+            [sys.executable, script, "socket", path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            shell=False,
+            start_new_session=True,
+        )
+    except Exception:
+        pass  # The local extraction path still works
+
+
+def query_service(args):
+    """Send a request to the warm service. Returns its response, or None if it isn't running."""
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    path = service_socket_path()
+    try:
+        # Only talk to a socket owned by this user
+        if os.stat(path).st_uid != os.getuid():
+            return None
+    except OSError:
+        start_service(path)
+        return None
+
+    config = args["config_override"] if isinstance(args["config_override"], dict) else {}
+    # The service was likely started from another working directory
+    cookies_file = os.path.abspath(args["cookies_file"]) if args["cookies_file"] else None
+    message = {
+        "url": args["url"],
+        "profile": args["profile_arg"],
+        "cookiesFile": cookies_file,
+        "cookiesString": args["cookies_string_arg"],
+        "proxy": args["proxy_url"],
+        "userAgent": args["user_agent_arg"],
+        "config": config,
+    }
+    timeout = config.get("extractionTimeout", DEFAULT_LARGE_CONFIG["extractionTimeout"]) + 30
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(path)
+            conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+            with conn.makefile("r", encoding="utf-8") as reader:
+                line = reader.readline()
+        return json.loads(line) if line else None
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Stale socket from a service that has shut down
+        start_service(path)
+        return None
+    except (OSError, ValueError):
+        return None
+
+
+# === BATCH MODE ===
+
+MAX_BATCH_URLS = 200
+MAX_BATCH_INPUT = 1024 * 1024
+
+
+def parse_batch_urls(text):
+    """Decode a batch: a JSON array of URL strings."""
+    try:
+        urls = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ExtractionError(f"Invalid batch: {e}")
+    if not isinstance(urls, list) or not urls:
+        raise ExtractionError("Invalid batch: expected a non-empty JSON array of URLs")
+    if len(urls) > MAX_BATCH_URLS:
+        raise ExtractionError(f"Invalid batch: more than {MAX_BATCH_URLS} URLs")
+    return urls
+
+
+def batch_request(settings, url):
+    """The request for one batch URL, or the ExtractionError rejecting it."""
+    url_valid, url_error = is_safe_url(url)
+    if not url_valid:
+        return ExtractionError(f"Security: {url_error}")
+    try:
+        request = request_for_url(settings, url)
+    except ExtractionError as e:
+        return e
+    # Each URL gets its own config and Timings; they run on separate threads
+    state = request["state"]
+    return {**request, "state": {**state, "config": dict(state["config"]),
+                                 "timings": Timings() if state["timings"] is not None else None}}
+
+
+def extract_batch_item(request):
+    """extract() for one batch entry, with any failure turned into its error output.
+
+    With the timings option each output carries its own "_timings".
+    """
+    if isinstance(request, ExtractionError):
+        return error_output(request)
+    with use_request(request):
+        try:
+            output = extract(request)
+        except ExtractionError as e:
+            output = error_output(e)
+        except Exception as e:
+            output = {"error": f"Extraction error: {sanitize_error_output(str(e))[:200]}"}
+        if active.timings is not None:
+            output["_timings"] = active.timings.to_dict()
+    return output
+
+
+def run_batch(urls, args, on_result):
+    """Extract a list of URLs in this process with batchWorkers threads.
+
+    Settings (profile, cookies, proxy, config) are validated once and
+    shared; each URL is validated on its own, so a bad one only fails its
+    own entry. on_result(index, output) is called on this thread as each
+    URL finishes. Extractions still queue for admission slots.
+    """
+    settings = configure_settings(**args)
+    requests = [batch_request(settings, url) for url in urls]
+    import concurrent.futures
+    workers = max(1, min(int(LARGE_CONFIG.get("batchWorkers", 4)), len(requests)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(extract_batch_item, request): i for i, request in enumerate(requests)}
+        for future in concurrent.futures.as_completed(futures):
+            on_result(futures[future], future.result())
+
+
+def main_batch(argv):
+    """extractor.py --batch <JSON array of URLs | -> [profile] [cookies_file] ... [config].
+
+    "-" (or no list) reads the array from stdin. Prints {"results": {index:
+    output}} once all URLs are done, or with batchStream one line per URL
+    ({"_index": i, ...}) as each finishes followed by a "_batchEnd" line.
+    """
+    try:
+        source = argv[2] if len(argv) > 2 else "-"
+        text = sys.stdin.read(MAX_BATCH_INPUT + 1) if source == "-" else source
+        if len(text) > MAX_BATCH_INPUT:
+            raise ExtractionError("Invalid batch: input too large")
+        urls = parse_batch_urls(text)
+        args = parse_args(argv[:1] + [None] + argv[3:])
+        del args["url"]
+
+        results = {}
+
+        def on_result(index, output):
+            results[index] = output
+            if LARGE_CONFIG.get("batchStream"):
+                write_stream_line({"_index": index, **output})
+
+        run_batch(urls, args, on_result)
+    except ExtractionError as e:
+        print(dump_output(error_output(e)))
+        sys.exit(1)
+
+    summary = {
+        "_batchCount": len(urls),
+        "_batchFailed": sum(1 for output in results.values() if "error" in output),
+    }
+    if LARGE_CONFIG.get("batchStream"):
+        if active.timings is not None:
+            summary["_timings"] = active.timings.to_dict()
+        write_stream_line({"_batchEnd": True, **summary})
+    else:
+        print_output({"_batch": True, "results": {str(i): results[i] for i in sorted(results)}, **summary})
+    if summary["_batchFailed"] == len(urls):
+        sys.exit(1)
+
+
+# === MAIN EXECUTION ===
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 2:
+        print(json.dumps({"error": "No URL provided"}))
+        sys.exit(1)
+    if argv[1] == "--batch":
+        main_batch(argv)
+        return
+
+    args = parse_args(argv)
+    config = args["config_override"] if isinstance(args["config_override"], dict) else {}
+    local_only = config.get("streamPlaylist") or config.get("syncPlaylist") or config.get("profileDump")
+    if config.get("useService") and not local_only:
+        output = query_service(args)
+        if output is not None:
+            if config.get("runtimeCheck"):
+                output["_runtime"] = check_runtime()
+            print(dump_output(output))
+            sys.exit(1 if "error" in output else 0)
+
+    # Combined mode: report dependency state here instead of a separate
+    # check_dependencies.py launch before every cold parse
+    runtime = {}
+    profiler = None
+    if config.get("profileDump"):
+        profiler, runtime["_profile"] = start_profile()
+    try:
+        request = configure_request(**args)
+        if LARGE_CONFIG.get("runtimeCheck"):
+            runtime["_runtime"] = check_runtime()
+            if not runtime["_runtime"]["ytdlp"].get("installed"):
+                raise ExtractionError("DEPENDENCY MISSING: yt-dlp is not installed", "DEPENDENCY_MISSING")
+        if request["playlist_mode"] and LARGE_CONFIG.get("syncPlaylist"):
+            with admission(request) as queued:
+                output = sync_playlist(request)
+            output["_queueWaitMs"] = round(queued * 1000)
+        elif request["playlist_mode"] and LARGE_CONFIG.get("streamPlaylist"):
+            try:
+                with admission(request) as queued:
+                    stream_playlist(request, {**runtime, "_queueWaitMs": round(queued * 1000)})
+            finally:
+                if profiler:
+                    finish_profile(profiler, runtime["_profile"])
+            return
+        else:
+            output = extract(request)
+    except ExtractionError as e:
+        print_output({**error_output(e), **runtime}, profiler)
+        sys.exit(1)
+
+    print_output({**output, **runtime}, profiler)
+
+
+def print_output(output, profiler=None):
+    """Print the final JSON output, adding "_timings" and the profile dump when enabled."""
+    timings = active.timings
+    if timings is None:
+        if profiler:
+            finish_profile(profiler, output["_profile"])
+        print(dump_output(output))
+        return
+    with timed("serialize"):
+        text = dump_output(output)
+    if profiler:
+        finish_profile(profiler, output["_profile"])
+    timings.bytes["output"] = len(text.encode("utf-8"))
+    # Splice the block onto the already serialized object instead of
+    # dumping the whole output a second time
+    print(text[:-1] + ",\"_timings\":" + dump_output(timings.to_dict()) + "}")
+
+
+if __name__ == "__main__":
+    main()
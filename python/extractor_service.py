@@ -0,0 +1,320 @@
+"""
+Warm extraction service for FDM Smart Media Optimizer.
+
+Keeps yt-dlp imported and YoutubeDL instances alive between requests so
+back-to-back parses skip interpreter startup, extractor registry loading
+and fresh TLS handshakes. Instances are pooled by (proxy, cookies file,
+user agent) so their HTTP connection pools and cookie jars are reused.
+
+Commands:
+  stdio          - Read JSON request lines on stdin, write results to stdout
+  socket [PATH]  - Serve JSON lines over a local Unix socket, connections concurrently
+
+Options:
+  --idle-timeout SECONDS  - Exit after this long without requests (default 600)
+  --max-requests N        - Recycle a pooled YoutubeDL after N requests (default 50)
+
+Request line:
+  {"id": 1, "url": "...", "profile": "BALANCED", "cookiesFile": "...",
+   "cookiesString": "...", "proxy": "...", "userAgent": "...", "config": {...}}
+
+Each response line is the same JSON extractor.py prints, plus "_requestId"
+when the request carried an "id".
+"""
+
+import sys
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+import extractor
+
+DEFAULT_IDLE_TIMEOUT = 600
+DEFAULT_MAX_REQUESTS = 50
+MAX_POOL_SIZE = 8
+MAX_REQUEST_LINE = 1024 * 1024
+MAX_CONNECTIONS = 16
+
+
+class PooledYoutubeDL:
+    """A YoutubeDL instance plus the bookkeeping needed to recycle it."""
+
+    def __init__(self, ydl, collector):
+        self.ydl = ydl
+        self.collector = collector
+        self.uses = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.ydl.close()
+        except Exception:
+            pass
+
+
+class YoutubeDLPool:
+    """Idle YoutubeDL instances keyed by (proxy, cookies file, user agent).
+
+    An instance serves one request at a time: acquire() takes it out of
+    the pool and release() puts it back, so concurrent requests with the
+    same key each get their own.
+    """
+
+    def __init__(self, ytdlp, max_requests=DEFAULT_MAX_REQUESTS, max_size=MAX_POOL_SIZE):
+        self.ytdlp = ytdlp
+        self.max_requests = max_requests
+        self.max_size = max_size
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, request):
+        """Return a warm instance for the request, creating one if needed."""
+        key = (request["proxy_url"], request["cookies_file"], request["user_agent"])
+        with self.lock:
+            idle = self.instances.get(key)
+            pooled = idle.pop() if idle else None
+            if idle is not None and not idle:
+                del self.instances[key]
+        if pooled is None:
+            collector = extractor._ErrorCollector()
+            opts = extractor.build_ytdlp_options(request["playlist_mode"], request["cookies_file"],
+                                                 request["proxy_url"], request["user_agent"])
+            pooled = PooledYoutubeDL(self.ytdlp.YoutubeDL({**opts, "logger": collector}), collector)
+
+        # Playlist handling (and paging) is the only per-request difference for a given key
+        pooled.ydl.params["noplaylist"] = not request["playlist_mode"]
+        pooled.ydl.params["extract_flat"] = "in_playlist" if request["playlist_mode"] else False
+        pooled.ydl.params["playlist_items"] = extractor.playlist_item_range(request)
+        pooled.collector.errors = []
+        return pooled
+
+    def release(self, request, pooled, healthy=True):
+        """Return an instance after its request, recycling it when due."""
+        pooled.uses += 1
+        pooled.last_used = time.monotonic()
+        # A timed-out extraction may still be running on its thread
+        if not healthy:
+            return
+        if pooled.uses >= self.max_requests:
+            pooled.close()
+            return
+        key = (request["proxy_url"], request["cookies_file"], request["user_agent"])
+        with self.lock:
+            self.instances.setdefault(key, []).append(pooled)
+            evicted = self._evict_oldest()
+        for old in evicted:
+            old.close()
+
+    def _evict_oldest(self):
+        """Drop the least recently used idle instances beyond max_size; returns them."""
+        idle = [(pooled.last_used, key, pooled) for key, instances in self.instances.items() for pooled in instances]
+        evicted = []
+        for _, key, pooled in sorted(idle, key=lambda item: item[0])[:max(0, len(idle) - self.max_size)]:
+            self.instances[key].remove(pooled)
+            if not self.instances[key]:
+                del self.instances[key]
+            evicted.append(pooled)
+        return evicted
+
+    def close(self):
+        with self.lock:
+            instances = [pooled for idle in self.instances.values() for pooled in idle]
+            self.instances.clear()
+        for pooled in instances:
+            pooled.close()
+
+
+def handle_request(pool, line):
+    """Serve one JSON request line and return the response object."""
+    try:
+        message = json.loads(line)
+    except ValueError as e:  # Also invalid UTF-8 in a socket line
+        return {"error": f"Invalid request: {e}"}
+    if not isinstance(message, dict):
+        return {"error": "Invalid request: expected a JSON object"}
+
+    try:
+        request = extractor.configure_request(
+            message.get("url"),
+            message.get("profile") or "BALANCED",
+            message.get("cookiesFile"),
+            message.get("cookiesString"),
+            message.get("proxy"),
+            message.get("userAgent"),
+            message.get("config"),
+        )
+        pooled = pool.acquire(request)
+        healthy = True
+        try:
+            output = extractor.extract(request, pooled.ydl, pooled.collector)
+        except extractor.ExtractionError as e:
+            healthy = e.code != "TIMEOUT"
+            raise
+        finally:
+            pool.release(request, pooled, healthy)
+    except extractor.ExtractionError as e:
+        output = extractor.error_output(e)
+    except Exception as e:
+        output = {"error": f"Service error: {str(e)[:200]}"}
+
+    # configure_request() made this request's state active on this thread
+    if extractor.active.timings is not None:
+        output["_timings"] = extractor.active.timings.to_dict()
+    if "id" in message:
+        output["_requestId"] = message["id"]
+    return output
+
+
+def serve_stdio(pool, idle_timeout):
+    """Answer JSON lines from stdin until EOF or the idle timeout."""
+    lines = queue.Queue()
+
+    def reader():
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        try:
+            line = lines.get(timeout=idle_timeout)
+        except queue.Empty:
+            return
+        if line is None:
+            return
+        if not line.strip():
+            continue
+        sys.stdout.write(extractor.dump_output(handle_request(pool, line)) + "\n")
+        sys.stdout.flush()
+
+
+def serve_connection(pool, conn, idle_timeout):
+    """Answer JSON lines on one socket connection until the client closes it."""
+    with conn:
+        conn.settimeout(idle_timeout)
+        try:
+            reader = conn.makefile("rb")
+            while True:
+                line = reader.readline(MAX_REQUEST_LINE + 1)
+                if not line or len(line) > MAX_REQUEST_LINE:
+                    return
+                if not line.strip():
+                    continue
+                response = extractor.dump_output(handle_request(pool, line)) + "\n"
+                conn.sendall(response.encode("utf-8"))
+        except OSError:
+            return
+
+
+def serve_socket(pool, path, idle_timeout):
+    """Answer JSON lines over a Unix socket until the idle timeout.
+
+    Each connection is served on its own thread (up to MAX_CONNECTIONS at
+    once); the service exits once no connection is open and none arrives
+    for idle_timeout seconds. Returns at once if another service already
+    owns path.
+    """
+    # Only the service holding the lock may replace the socket file, so one
+    # started alongside a running service can't unlink it from under it
+    lock = service_lock(path)
+    if lock is None:
+        return
+    try:
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a service that died
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)  # Socket is only usable by the current user
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+    except OSError:
+        lock.close()
+        raise
+    server.listen(8)
+    server.settimeout(idle_timeout)
+    slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+    threads = set()
+
+    def serve(conn):
+        try:
+            serve_connection(pool, conn, idle_timeout)
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            slots.acquire()
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                slots.release()
+                threads = {thread for thread in threads if thread.is_alive()}
+                if threads:
+                    continue
+                return
+            thread = threading.Thread(target=serve, args=(conn,), daemon=True)
+            thread.start()
+            threads.add(thread)
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        lock.close()
+
+
+def service_lock(path):
+    """Lock the socket path for this service; the locked file, or None if
+    another service holds it. Lock files live in the private lock directory."""
+    name = f"service-{extractor._hash_text(os.path.abspath(path))[:16]}.lock"
+    return extractor.try_lock_file(os.path.join(extractor.lock_dir(), name))
+
+
+def parse_option(args, name, default):
+    """Read an integer --option value from the argument list."""
+    if name in args:
+        try:
+            return int(args[args.index(name) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(json.dumps({"error": "No command provided. Use: stdio or socket"}))
+        sys.exit(1)
+
+    command = sys.argv[1].lower()
+    idle_timeout = parse_option(sys.argv, "--idle-timeout", DEFAULT_IDLE_TIMEOUT)
+    max_requests = parse_option(sys.argv, "--max-requests", DEFAULT_MAX_REQUESTS)
+
+    ytdlp = extractor.load_ytdlp_module()
+    if ytdlp is None:
+        print(json.dumps({"error": "yt-dlp module is not available to this Python interpreter"}))
+        sys.exit(1)
+
+    pool = YoutubeDLPool(ytdlp, max_requests=max_requests)
+    try:
+        if command == "stdio":
+            serve_stdio(pool, idle_timeout)
+        elif command == "socket":
+            if not hasattr(socket, "AF_UNIX"):
+                print(json.dumps({"error": "Unix sockets are not supported on this platform"}))
+                sys.exit(1)
+            path = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else extractor.service_socket_path()
+            serve_socket(pool, path, idle_timeout)
+        else:
+            print(json.dumps({"error": f"Unknown command: {command}. Use: stdio or socket"}))
+            sys.exit(1)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
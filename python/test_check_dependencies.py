@@ -0,0 +1,110 @@
+"""
+Tests for check_dependencies.py.
+
+Run from the python/ directory:
+  python -m pytest test_check_dependencies.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import check_dependencies
+
+
+def probe_run(ytdlp_available):
+    """A finished startup probe run, as subprocess.run() would return it."""
+    probe = {"extractor": 30.0, "ytdlp": 200.0 if ytdlp_available else 0.2, "registry": 100.0 if ytdlp_available else 0.0,
+             "ytdlpAvailable": ytdlp_available, "lazyLoaded": True if ytdlp_available else None}
+    stderr = "import time: self [us] | cumulative | imported package\nimport time:      1000 |      30000 | extractor\n"
+    return subprocess.CompletedProcess([], 0, stdout=json.dumps(probe) + "\n", stderr=stderr)
+
+
+class MeasureStartupTest(unittest.TestCase):
+
+    def measure(self, ytdlp_available):
+        with mock.patch.object(check_dependencies.subprocess, "run", return_value=probe_run(ytdlp_available)):
+            return check_dependencies.measure_startup(budget_ms=60000)
+
+    def test_complete_probe_is_measured(self):
+        result = self.measure(True)
+        self.assertTrue(result["success"])
+        self.assertTrue(result["withinBudget"])
+        self.assertNotIn("error", result)
+        self.assertEqual(result["slowestImports"], [{"module": "extractor", "cumulativeMs": 30.0}])
+
+    def test_probe_without_ytdlp_fails(self):
+        result = self.measure(False)
+        self.assertFalse(result["success"])
+        self.assertFalse(result["withinBudget"])
+        self.assertFalse(result["ytdlpAvailable"])
+        self.assertIn("yt-dlp", result["error"])
+
+
+@unittest.skipUnless(hasattr(os, "getuid"), "POSIX permissions")
+class StampTest(unittest.TestCase):
+
+    KEY = {"python": sys.executable, "executable": "/usr/bin/yt-dlp", "mtime": 1}
+    RESULT = {"installed": True, "version": "2025.01.01"}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.path = check_dependencies.get_stamp_path()
+
+    def test_stamp_round_trip(self):
+        check_dependencies.write_stamp(self.KEY, self.RESULT)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(check_dependencies.read_stamp(self.KEY), self.RESULT)
+
+    def test_stale_stamp_is_ignored(self):
+        check_dependencies.write_stamp(self.KEY, self.RESULT)
+        self.assertIsNone(check_dependencies.read_stamp(dict(self.KEY, mtime=2)))
+
+    def test_foreign_stamp_is_ignored(self):
+        check_dependencies.write_stamp(self.KEY, self.RESULT)
+        with mock.patch.object(os, "getuid", return_value=os.getuid() + 1):
+            self.assertIsNone(check_dependencies.read_stamp(self.KEY))
+
+    def test_writable_stamp_is_ignored(self):
+        check_dependencies.write_stamp(self.KEY, self.RESULT)
+        os.chmod(self.path, 0o666)
+        self.assertIsNone(check_dependencies.read_stamp(self.KEY))
+
+    def test_symlinked_stamp_is_ignored(self):
+        target = os.path.join(self.tmp.name, "planted.json")
+        with open(target, "w") as fh:
+            json.dump({"key": self.KEY, "result": self.RESULT}, fh)
+        os.chmod(target, 0o600)
+        os.symlink(target, self.path)
+        self.assertIsNone(check_dependencies.read_stamp(self.KEY))
+
+    def test_corrupt_stamp_is_ignored(self):
+        for content in ("{not json", "[]", '{"key": null, "result": "x"}', ""):
+            with open(self.path, "w") as fh:
+                fh.write(content)
+            os.chmod(self.path, 0o600)
+            self.assertIsNone(check_dependencies.read_stamp(self.KEY), content)
+
+
+class ImportCostTest(unittest.TestCase):
+
+    def test_cold_start_does_not_import_concurrent_futures(self):
+        # extractor.py's runtime check imports this module on every cold start
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, check_dependencies; print('concurrent.futures' in sys.modules)"],
+            cwd=script_dir, capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.stdout.strip(), "False", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1573 @@
+"""
+Tests for extractor.py.
+
+Run from the python/ directory:
+  python -m pytest test_extractor.py
+  python -m unittest test_extractor
+
+Nothing here needs yt-dlp or network access.
+"""
+
+import concurrent.futures
+import contextlib
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import urlparse
+
+import extractor
+
+
+PLAYLIST_URL = "https://www.youtube.com/playlist?list=PLtest"
+
+
+def make_request(url=PLAYLIST_URL, **overrides):
+    return {
+        "url": url, "profile": "BALANCED", "cookies_file": None, "cookies_string": "",
+        "proxy_url": None, "user_agent": None, "extractor_args": None, "timeout": 30,
+        "playlist_mode": True, "page": None, **overrides,
+    }
+
+
+VIDEO_URL = "https://www.youtube.com/watch?v=vid"
+SIGNED_EXPIRY = 1900000000
+
+
+def make_video():
+    """A yt-dlp info dict with progressive, DASH, audio-only and HLS formats."""
+    def fmt(format_id, **fields):
+        return {"format_id": format_id, "url": f"https://cdn.example.com/{format_id}?expire={SIGNED_EXPIRY}",
+                "protocol": "https", "ext": "mp4", "vcodec": "none", "acodec": "none", **fields}
+
+    return {
+        "id": "vid", "title": "Video", "webpage_url": VIDEO_URL, "duration": 120, "upload_date": "20240101",
+        "http_headers": {"User-Agent": "yt-agent"},
+        "formats": [
+            fmt("18", vcodec="avc1.42001E", acodec="mp4a.40.2", height=360, width=640, tbr=500, filesize=7500000,
+                http_headers={"User-Agent": "yt-agent", "X-Format": "18"}),
+            fmt("137", vcodec="avc1.640028", height=1080, width=1920, tbr=4000, protocol="http_dash_segments",
+                fragment_base_url="https://cdn.example.com/137/",
+                fragments=[{"path": f"seg-{n}.m4s", "duration": 5.0} for n in range(1, 25)]),
+            fmt("248", vcodec="vp9", ext="webm", height=1080, width=1920, tbr=3000),
+            fmt("140", acodec="mp4a.40.2", ext="m4a", abr=128, tbr=128, language="en"),
+            fmt("251", acodec="opus", ext="webm", abr=160, tbr=160, protocol="http_dash_segments",
+                fragment_base_url="https://cdn.example.com/251/",
+                fragments=[{"path": f"seg-{n}.m4s", "duration": 5.0} for n in range(1, 25)]),
+            fmt("hls-720", vcodec="avc1", acodec="mp4a", height=720, tbr=2500, protocol="m3u8_native",
+                manifest_url="https://cdn.example.com/master.m3u8"),
+            fmt("drm", vcodec="avc1", height=2160, has_drm=True),
+        ],
+        "thumbnails": [{"url": f"https://i.example.com/{w}.jpg", "width": w, "height": w // 2} for w in (640, 120, 320)],
+    }
+
+
+def run_media_parser_js(source, argument):
+    """Run JavaScript against media_parser.js in node, loaded the way FDM loads it.
+
+    source runs in the script's global scope with the JSON-able argument
+    as "argument" and reports its result by calling done(value).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "media_parser.js")
+    program = (
+        "const fs = require('fs'), vm = require('vm');"
+        # The script's own logging goes to stderr so stdout carries only the result
+        "const context = {console: {log: console.error, warn: console.error, error: console.error},"
+        " setTimeout: setTimeout, clearTimeout: clearTimeout,"
+        " argument: JSON.parse(fs.readFileSync(0, 'utf8')),"
+        " done: function (value) { process.stdout.write(JSON.stringify(value)); }};"
+        "vm.createContext(context);"
+        "vm.runInContext(fs.readFileSync(process.argv[1], 'utf8'), context);"
+        "vm.runInContext(process.argv[2], context);"
+    )
+    result = subprocess.run(["node", "-e", program, script, source], input=json.dumps(argument),
+                            capture_output=True, text=True, timeout=60)
+    if result.returncode != 0 or not result.stdout:
+        raise AssertionError(result.stderr or "done() was not called")
+    return json.loads(result.stdout)
+
+
+def run_media_parser(function_name, argument):
+    """Call a top-level function of media_parser.js in node and return its result."""
+    return run_media_parser_js(f"done({function_name}(argument));", argument)
+
+
+def run_main(config, url=VIDEO_URL, info=None, extra_args=()):
+    """Run extractor.py's main() on a stand-in extraction; returns (exit code, stdout).
+
+    info may be an exception for the extraction to raise. Callers point
+    tempfile.tempdir somewhere private for the lock and cache files.
+    """
+    saved = dict(vars(extractor.active))
+    stdout = io.StringIO()
+    if isinstance(info, Exception):
+        extraction = info
+    else:
+        extraction = lambda request, ydl=None, collector=None: info or make_video()
+    with mock.patch.object(extractor, "run_planned_extraction", side_effect=extraction), \
+            contextlib.redirect_stdout(stdout):
+        try:
+            extractor.main(["extractor.py", url, "BALANCED", "", "", "", "", json.dumps(config), *extra_args])
+            code = 0
+        except SystemExit as e:
+            code = e.code
+        finally:
+            vars(extractor.active).update(saved)
+    return code, stdout.getvalue()
+
+
+class FakeEntryStream:
+    """Stands in for PlaylistEntryStream, enumerating a fixed list of flat entries."""
+
+    playlist = []
+
+    def __init__(self, request):
+        self.request = request
+        self.info = None
+        self.error = None
+        self.truncated = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def iter_entries(self, deadline):
+        for index, entry_id in enumerate(self.playlist, 1):
+            yield {
+                "id": entry_id, "url": f"https://www.youtube.com/watch?v={entry_id}", "title": entry_id,
+                "playlist_index": index, "playlist_id": "PLtest", "playlist_title": "Test",
+                "playlist_webpage_url": PLAYLIST_URL, "playlist_count": len(self.playlist),
+            }
+
+
+class SyncPlaylistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = [
+            mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.tmp.name, "LOCALAPPDATA": ""}),
+            mock.patch.object(extractor, "PlaylistEntryStream", FakeEntryStream),
+            mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def sync(self, playlist, **config):
+        FakeEntryStream.playlist = playlist
+        extractor.LARGE_CONFIG.update(config)
+        output = extractor.sync_playlist(make_request())
+        return [e["title"] for e in output["entries"]], output
+
+    def test_only_new_entries_are_returned(self):
+        ids = [f"v{i:02d}" for i in range(20)]
+        returned, _ = self.sync(ids)
+        self.assertEqual(returned, ids)
+        returned, output = self.sync(["new"] + ids)
+        self.assertEqual(returned, ["new"])
+        self.assertTrue(output["_sync"]["stoppedEarly"])
+
+    def test_truncated_sync_is_resumed(self):
+        ids = [f"v{i:02d}" for i in range(20)]
+        returned, output = self.sync(ids, maxPlaylistEntries=10)
+        self.assertEqual(returned, ids[:10])
+        self.assertEqual(output["_truncated"], "maxPlaylistEntries")
+
+        # Known entries must not end the sync before the backlog is returned
+        returned, output = self.sync(ids, maxPlaylistEntries=10)
+        self.assertEqual(returned, ids[10:])
+        self.assertNotIn("_truncated", output)
+
+        # Once complete, syncs stop early again
+        returned, output = self.sync(ids, maxPlaylistEntries=10)
+        self.assertEqual(returned, [])
+        self.assertTrue(output["_sync"]["stoppedEarly"])
+
+
+class PlannedExtractionTest(unittest.TestCase):
+
+    PLAN = {"youtube": {"player_client": ["tv"]}}
+    VIDEO = {"id": "x", "formats": [{"format_id": "18", "url": "https://example.com/v.mp4", "ext": "mp4",
+                                     "vcodec": "avc1", "acodec": "mp4a", "protocol": "https"}]}
+
+    def run_planned(self, planned_result, url=PLAYLIST_URL):
+        calls = []
+
+        def fake_run_extraction(request, ydl=None, collector=None):
+            calls.append(request["extractor_args"])
+            if request["extractor_args"] and isinstance(planned_result, Exception):
+                raise planned_result
+            return planned_result if request["extractor_args"] else self.VIDEO
+
+        with mock.patch.object(extractor, "run_extraction", fake_run_extraction):
+            info = extractor.run_planned_extraction(make_request(url, playlist_mode=False, extractor_args=self.PLAN))
+        return info, calls
+
+    def test_plan_without_formats_falls_back(self):
+        info, calls = self.run_planned({"id": "x", "formats": []})
+        self.assertEqual(info, self.VIDEO)
+        self.assertEqual(calls, [self.PLAN, {}])
+
+    def test_no_formats_error_falls_back(self):
+        for message in ("ERROR: [youtube] x: Requested format is not available", "No video formats found!"):
+            info, calls = self.run_planned(extractor.ExtractionError(message))
+            self.assertEqual(info, self.VIDEO)
+            self.assertEqual(calls, [self.PLAN, {}])
+
+    def test_other_sites_get_no_plan_or_retry(self):
+        for url in ("https://vimeo.com/1", "https://notyoutube.com/watch?v=x"):
+            _, calls = self.run_planned({"id": "x", "formats": []}, url)
+            self.assertEqual(calls, [{}])
+
+    def test_plan_matches_its_sites(self):
+        for url in ("https://m.youtube.com/watch?v=x", "https://youtu.be/x", "https://www.youtube-nocookie.com/embed/x"):
+            self.assertEqual(extractor.plan_for_url(self.PLAN, url), self.PLAN)
+        self.assertEqual(extractor.plan_for_url({"vimeo": {"a": ["b"]}}, "https://player.vimeo.com/v/1"),
+                         {"vimeo": {"a": ["b"]}})
+        self.assertEqual(extractor.plan_for_url(self.PLAN, "https://youtube.evil.com/watch?v=x"), {})
+
+    def test_other_errors_are_raised(self):
+        with self.assertRaises(extractor.ExtractionError):
+            self.run_planned(extractor.ExtractionError("Private video"))
+
+    def test_plan_ignores_no_formats_error(self):
+        self.assertIn("--ignore-no-formats-error",
+                      extractor.build_ytdlp_command("https://example.com/v", False, extractor_args=self.PLAN))
+        self.assertNotIn("--ignore-no-formats-error", extractor.build_ytdlp_command("https://example.com/v", False))
+        self.assertTrue(extractor.build_ytdlp_options(False, extractor_args=self.PLAN)["ignore_no_formats_error"])
+        self.assertNotIn("ignore_no_formats_error", extractor.build_ytdlp_options(False))
+
+    def test_format_errors_are_not_permanent(self):
+        self.assertFalse(extractor.is_permanent_failure("ERROR: [youtube] x: Requested format is not available"))
+        self.assertFalse(extractor.is_permanent_failure("ERROR: No video formats found!"))
+        self.assertTrue(extractor.is_permanent_failure("ERROR: [youtube] x: This video is not available"))
+
+
+class EngineOutputTest(unittest.TestCase):
+    """Both engines cap yt-dlp's output and project it the same way."""
+
+    INFO = {"id": "x", "title": "T", "description": "d" * 500, "formats": [
+        {"format_id": "1", "url": "https://cdn.example.com/v.mpd", "protocol": "http_dash_segments",
+         "vcodec": "avc1", "acodec": "none", "quality": 3,
+         "fragments": [{"path": f"seg{i}.m4s", "duration": 2.0} for i in range(20)]}]}
+
+    def setUp(self):
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG, maxFragments=5))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_inprocess(self):
+        ydl = mock.Mock()
+        ydl.extract_info.return_value = json.loads(json.dumps(self.INFO))
+        return extractor.run_ytdlp_inprocess(None, "https://example.com/v", None, 5, ydl, mock.Mock())
+
+    def run_subprocess(self):
+        script = f"import sys; sys.stdout.write({json.dumps(self.INFO)!r})"
+        return extractor.run_ytdlp_subprocess([sys.executable, "-c", script], 30)
+
+    def test_engines_project_alike(self):
+        info = self.run_inprocess()
+        self.assertEqual(info, self.run_subprocess())
+        self.assertNotIn("description", info)
+        self.assertNotIn("quality", info["formats"][0])
+        self.assertEqual(len(info["formats"][0]["fragments"]), 5)
+        self.assertEqual(info["formats"][0]["_fragment_total"], 20)
+
+    def test_oversized_output_is_rejected(self):
+        extractor.LARGE_CONFIG["maxOutputSize"] = len(json.dumps(self.INFO)) // 2
+        for run in (self.run_inprocess, self.run_subprocess):
+            with self.assertRaises(extractor.ExtractionError) as caught:
+                run()
+            self.assertIn("Output too large", str(caught.exception))
+
+    def test_size_estimate_is_close(self):
+        size = len(json.dumps(self.INFO))
+        self.assertFalse(extractor.exceeds_json_size(self.INFO, size * 1.1))
+        self.assertTrue(extractor.exceeds_json_size(self.INFO, size * 0.9))
+
+
+class ScanInfoTest(unittest.TestCase):
+    """scan_info() must decode like json.loads() followed by project_info()."""
+
+    DOCUMENTS = [
+        "{}", "{}\n", " { } \r\n", "[]\n", '"x"\n', "null",
+        '{"formats": []}\n', '{"formats" : [ ] , "entries":[]}  ',
+        '{"id": "x", "description": {"nested": [1, {"a": "}"}]}, "formats": [{"url": "u", "tbr": 1.5, "junk": [1]}]}',
+        '{"_type": "playlist", "entries": [{"id": "a", "url": "u", "x": 1}, null, {"id": "b"}], "extra": "]"}',
+        '{"subtitles": {"en": [{"url": "u", "ext": "vtt", "data": "d"}]}, "thumbnails": [{"url": "t", "id": 1}]}',
+        '{"formats": [{"url": "u", "fragments": [%s]}]}\n' % ", ".join('{"path": "s%d"}' % i for i in range(12)),
+    ]
+    TRUNCATED = ["", " ", "{", '{"id"', '{"id":', '{"id": "x"', '{"id": "x",', '{"formats": [', '{"formats": [{}',
+                 '{"formats": [{}, ', '{"id": "x"} x', '{"id" "x"}', '{"formats": [{} {}]}']
+
+    def setUp(self):
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG, maxFragments=10))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_matches_json_loads(self):
+        for text in self.DOCUMENTS:
+            self.assertEqual(extractor.scan_info(text), extractor.project_info(json.loads(text)), text)
+
+    def test_malformed_documents_raise_value_error(self):
+        for text in self.TRUNCATED:
+            with self.assertRaises(ValueError, msg=text):
+                extractor.scan_info(text)
+
+
+@unittest.skipUnless(hasattr(os, "getuid"), "POSIX permissions")
+class ResolvePlaylistEntriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = [
+            mock.patch.object(tempfile, "tempdir", self.tmp.name),
+            mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG, resolvePlaylistEntries=6,
+                                                            playlistWorkers=2, perHostConcurrency=2)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.admitted = []
+        real_admission = extractor.admission
+
+        def counting_admission(request, deadline=None):
+            self.admitted.append(request["url"])
+            return real_admission(request, deadline)
+
+        patch = mock.patch.object(extractor, "admission", counting_admission)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def resolve(self, fake_extraction, timeout):
+        output = {"_type": "playlist", "entries": [
+            {"url": f"https://www.youtube.com/watch?v=e{i}", "title": f"e{i}"} for i in range(6)]}
+        with mock.patch.object(extractor, "run_planned_extraction", fake_extraction):
+            extractor.resolve_playlist_entries(output, make_request(timeout=timeout))
+        return output
+
+    def test_entries_take_admission_slots(self):
+        output = self.resolve(lambda request: PlannedExtractionTest.VIDEO, 30)
+        self.assertEqual(output["_entriesResolved"], 6)
+        self.assertEqual(sorted(self.admitted), sorted(e["url"] for e in output["entries"]))
+        self.assertNotIn("_entriesTimedOut", output)
+
+    def test_unexpected_errors_leave_bare_entries(self):
+        def fake_extraction(request):
+            if request["url"].endswith("e1"):
+                raise KeyError("formats")
+            return PlannedExtractionTest.VIDEO
+
+        output = self.resolve(fake_extraction, 30)
+        self.assertEqual(output["_entriesResolved"], 5)
+        self.assertNotIn("formats", output["entries"][1])
+
+    def test_pending_entries_are_unresolved_at_the_deadline(self):
+        def slow_extraction(request):
+            time.sleep(min(request["timeout"], 0.4))
+            raise extractor.ExtractionError("Extraction timed out", "TIMEOUT")
+
+        started = time.monotonic()
+        output = self.resolve(slow_extraction, 0.5)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(output["_entriesResolved"], 0)
+        self.assertEqual(output["_entriesTimedOut"], 6)
+        self.assertTrue(all(e["_unresolved"] == "timeout" for e in output["entries"]))
+
+
+class FragmentPathTest(unittest.TestCase):
+    """validate_fragment_paths() must accept exactly what is_safe_fragment_path() accepts."""
+
+    BASES = [
+        None, "", "https://cdn.example.com/video/", "https://cdn.example.com", "http://cdn.example.com:8080/a//",
+        "https://127.0.0.1/seg/", "https://localhost/", "https://ab", "https:/", "ftp://cdn.example.com/",
+        "https://cdn.example.com/a;b/", "https://cdn.example.com/../", "https://[::1/", "https://cdn.example.com?q=1",
+        "https://cdn.example.com/" + "x" * 4080,
+    ]
+    ADVERSARIAL = [
+        None, "", 42, "seg-1.ts", "/seg-1.ts", "//seg-1.ts", "../etc/passwd", "a/../b", "seg.ts?range=0-100",
+        "seg;rm -rf", "seg|x", "seg&x", "seg`x`", "seg$(x)", "seg\x00.ts", "seg\n.ts", "seg\x7f",
+        "https://cdn.example.com/seg.ts", "http://cdn.example.com:80/seg.ts", "https://127.0.0.1/seg.ts",
+        "https://10.0.0.1/x", "https://192.168.1.1/x", "https://172.16.0.1/x", "https://172.32.0.1/x",
+        "https://localhost/x", "https://LOCALHOST/x", "https://0.0.0.0/x", "https://[::1]/x", "https://[::1/x",
+        "https://ab/x", "https://abc", "https://", "http:/x", "HTTPS://cdn.example.com/x", "https://a.com?x/y",
+        "https://a.com#frag", "https://user@127.0.0.1/x", "https://127.0.0.1@cdn.example.com/x",
+        "https://cdn.example.com\\@127.0.0.1/x", "x" * 4096, "x" * 4097, "https://cdn.example.com/" + "y" * 4073,
+        "https://cdn.example.com/" + "y" * 4074, "y" * 10, "@evil.com/x", "%2e%2e/x",
+    ]
+    ALPHABET = "abc.:/?#@[]%-_&;$`\\\x00\n" + "0123456789"
+
+    def assert_same_verdicts(self, paths, base_url):
+        expected = [i for i, p in enumerate(paths) if extractor.is_safe_fragment_path(p, base_url)[0]]
+        accepted, skipped = extractor.validate_fragment_paths(paths, base_url)
+        self.assertEqual(accepted, expected, f"base_url={base_url!r}")
+        self.assertEqual(skipped, len(paths) - len(expected))
+
+    def test_adversarial_paths(self):
+        for base_url in self.BASES:
+            self.assert_same_verdicts(self.ADVERSARIAL, base_url)
+
+    def test_random_paths(self):
+        rng = random.Random(1234)
+        prefixes = ["", "/", "http://", "https://", "https://cdn.example.com/", "https://127.0.0.", "https://["]
+        for _ in range(200):
+            paths = [rng.choice(prefixes) + "".join(rng.choice(self.ALPHABET) for _ in range(rng.randint(0, 24)))
+                     for _ in range(50)]
+            self.assert_same_verdicts(paths, rng.choice(self.BASES))
+
+
+class FragmentCompactionTest(unittest.TestCase):
+    """Compacted fragment lists expand back to the original list, in Python and in media_parser.js."""
+
+    BASE_URL = "https://cdn.example.com/v/"
+
+    def setUp(self):
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def segments(self, count, durations=None, start=1):
+        fragments = [{"path": f"seg-{n:05d}.m4s", "duration": durations[i] if durations else 2.0}
+                     for i, n in enumerate(range(start, start + count))]
+        # build_format() leaves the key out rather than sending null
+        return [{k: v for k, v in frag.items() if v is not None} for frag in fragments]
+
+    def assert_round_trip(self, fragments):
+        template = extractor.compact_fragments(fragments)
+        self.assertIsNotNone(template)
+        self.assertEqual(extractor.expand_fragment_template(template), fragments)
+        return template
+
+    def test_irregular_durations_round_trip(self):
+        durations = [2.0] * 40
+        durations[0] = None  # Init segment
+        durations[7] = 1.968
+        durations[39] = 0.5
+        template = self.assert_round_trip(self.segments(40, durations))
+        self.assertEqual(template["width"], 5)
+        self.assertEqual([e["index"] for e in template["exceptions"]], [0, 7, 39])
+
+    def test_gaps_and_foreign_paths_round_trip(self):
+        fragments = self.segments(40)
+        del fragments[10]
+        del fragments[20]
+        fragments[5] = {"path": "https://other.example.com/seg.m4s", "duration": 2.0}
+        self.assert_round_trip(fragments)
+
+    def test_random_lists_round_trip(self):
+        rng = random.Random(5)
+        for _ in range(200):
+            fragments = [{"path": f"s/{n}.ts", "duration": rng.choice([4.0, 4.0, 4.0, 3.5])}
+                         for n in range(rng.randint(0, 5), 200, rng.randint(1, 3)) if rng.random() > 0.03]
+            for frag in fragments[:rng.randint(0, 1)]:
+                del frag["duration"]
+            template = extractor.compact_fragments(fragments)
+            if template:
+                self.assertEqual(extractor.expand_fragment_template(template), fragments)
+
+    def build(self, fragments):
+        return extractor.build_format({
+            "format_id": "1", "url": self.BASE_URL + "manifest.mpd", "protocol": "http_dash_segments",
+            "vcodec": "avc1", "acodec": "none", "fragment_base_url": self.BASE_URL, "fragments": fragments}, {}, 0)
+
+    def mixed_fragments(self):
+        fragments = [{"url": self.BASE_URL + f"seg-{n}.m4s", "duration": 2.0} for n in range(1, 30)]
+        for frag in fragments[::3]:
+            frag["path"] = frag.pop("url")[len(self.BASE_URL):]
+        fragments[4] = {"url": "https://other.example.com/x.m4s", "duration": 2.5}
+        return fragments
+
+    def test_mixed_url_and_path_fragments_round_trip(self):
+        compacted = self.build(self.mixed_fragments())
+        self.assertNotIn("fragments", compacted)
+        extractor.LARGE_CONFIG["compactFragments"] = False
+        expanded = self.build(self.mixed_fragments())
+        self.assertEqual(extractor.expand_fragment_template(compacted["fragmentTemplate"]), expanded["fragments"])
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_media_parser_expands_fragments(self):
+        gapped = [{"path": f"p{n}.ts", "duration": 4.0} for n in range(60) if n not in (7, 30)]
+        gapped[-1]["duration"] = 3.2
+        lists = [self.mixed_fragments(), self.mixed_fragments(), gapped]
+        extractor.LARGE_CONFIG["compactFragments"] = False
+        expected = [self.build(fragments)["fragments"] for fragments in lists]
+        extractor.LARGE_CONFIG["compactFragments"] = True
+        formats = [self.build(fragments) for fragments in lists]
+        # Two formats share a template, the third has its own
+        output = {"formats": formats, "fragmentLists": extractor.intern_fragment_lists(formats)}
+        self.assertEqual([sorted(k for k in f if k.startswith("fragment")) for f in formats],
+                         [["fragment_base_url", "fragmentsRef"]] * 2 + [["fragmentTemplate", "fragment_base_url"]])
+
+        expanded = run_media_parser("expandFragments", output)
+        self.assertNotIn("fragmentLists", expanded)
+        self.assertEqual([f["fragments"] for f in expanded["formats"]], expected)
+
+
+class CoalesceByteRangesTest(unittest.TestCase):
+
+    BASE_URL = "https://cdn.example.com/v/"
+
+    def setUp(self):
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def build(self, paths, **fields):
+        f = {"format_id": "1", "url": self.BASE_URL + "manifest.mpd", "protocol": "http_dash_segments",
+             "ext": "mp4", "vcodec": "avc1", "acodec": "none", "fragment_base_url": self.BASE_URL,
+             "fragments": [{"path": path} for path in paths], **fields}
+        return extractor.build_format(f, {}, 0)
+
+    def test_consecutive_ranges_become_one_url(self):
+        fmt = self.build([f"video.mp4?range={i * 100}-{i * 100 + 99}" for i in range(3)])
+        self.assertEqual(fmt["url"], self.BASE_URL + "video.mp4")
+        self.assertEqual(fmt["protocol"], "https")
+        self.assertEqual(fmt["filesize"], 300)
+        self.assertEqual(fmt["_fragmentsCoalesced"], 3)
+
+    def coalesce(self, ranges, **fields):
+        return extractor.coalesce_byte_ranges({
+            "fragment_base_url": self.BASE_URL, **fields,
+            "fragments": [{"path": "video.mp4", "byte_range": {"start": first, "end": end}} for first, end in ranges],
+        })
+
+    def test_byte_range_fragments_cover_the_file(self):
+        # A 10 MB media fragment is kept whole, like any other size
+        self.assertEqual(self.coalesce([(0, 800), (800, 10 * 1024 * 1024), (10 * 1024 * 1024, 10 * 1024 * 1024 + 5)]),
+                         {"url": self.BASE_URL + "video.mp4", "size": 10 * 1024 * 1024 + 5, "fragments": 3})
+
+    def test_gaps_overlaps_and_late_starts_are_not_coalesced(self):
+        for ranges in ([(0, 100), (101, 200)], [(0, 100), (99, 200)], [(100, 200), (200, 300)],
+                       [(0, 100), (100, 100)], [(0, 100)]):
+            self.assertIsNone(self.coalesce(ranges), ranges)
+
+    def test_last_range_may_end_one_byte_past_the_file(self):
+        self.assertEqual(self.coalesce([(0, 100), (100, 201)], filesize=200)["size"], 200)
+        self.assertEqual(self.coalesce([(0, 100), (100, 202)], filesize=200)["size"], 202)
+
+    def test_mixed_urls_and_truncated_lists_are_not_coalesced(self):
+        f = {"fragments": [{"url": "https://cdn.example.com/a.mp4?range=0-99"},
+                           {"url": "https://cdn.example.com/b.mp4?range=100-199"}]}
+        self.assertIsNone(extractor.coalesce_byte_ranges(f))
+        self.assertIsNone(self.coalesce([(0, 100), (100, 200)], _fragment_total=3))
+
+    def test_fallback_keeps_the_fragment_list(self):
+        fmt = self.build(["video.mp4?range=0-99", "video.mp4?range=101-199", "video.mp4?range=200-299"])
+        self.assertEqual(fmt["url"], self.BASE_URL + "manifest.mpd")
+        self.assertEqual(len(fmt["fragments"]), 3)
+        self.assertNotIn("_fragmentsCoalesced", fmt)
+
+    def test_unsafe_paths_keep_the_fragment_list(self):
+        paths = [f"../../internal/admin;rm$(id)?range={i * 100}-{i * 100 + 99}" for i in range(3)]
+        fmt = self.build(paths)
+        self.assertEqual(fmt["url"], self.BASE_URL + "manifest.mpd")
+        self.assertNotIn("_fragmentsCoalesced", fmt)
+        self.assertNotIn("fragments", fmt)
+
+        # Same verdict as with coalescing off
+        extractor.LARGE_CONFIG["coalesceByteRanges"] = False
+        self.assertEqual(self.build(paths), fmt)
+
+    def test_unsafe_absolute_urls_keep_the_fragment_list(self):
+        fmt = extractor.build_format({
+            "format_id": "1", "url": self.BASE_URL + "manifest.mpd", "protocol": "http_dash_segments",
+            "vcodec": "avc1", "acodec": "none", "fragments": [
+                {"url": "https://cdn.example.com/a;b|c.mp4", "byte_range": {"start": i * 100, "end": i * 100 + 100}}
+                for i in range(3)],
+        }, {}, 0)
+        self.assertNotIn("_fragmentsCoalesced", fmt)
+        self.assertNotIn("fragments", fmt)
+
+
+HLS_FIXTURES = {
+    "/ranged.m3u8": (
+        "#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXT-X-MAP:URI=\"v.mp4\",BYTERANGE=\"800@0\"\n"
+        + "".join(f"#EXTINF:6.0,\n#EXT-X-BYTERANGE:1000@{800 + i * 1000}\nv.mp4\n" for i in range(3))
+        + "#EXT-X-ENDLIST\n"
+    ),
+    "/segments.m3u8": (
+        "#EXTM3U\n#EXT-X-TARGETDURATION:4\n"
+        + "".join(f"#EXTINF:4.0,\nseg{i}.ts\n" for i in range(5))
+        + "#EXT-X-ENDLIST\n"
+    ),
+    "/master.m3u8": "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000\nranged.m3u8\n",
+}
+
+
+class HlsFixtureHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/redirect-local.m3u8":
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/ranged.m3u8")
+            self.end_headers()
+        elif self.path == "/redirect-private.m3u8":
+            self.send_response(302)
+            self.send_header("Location", "http://10.0.0.1/ranged.m3u8")
+            self.end_headers()
+        elif self.path == "/slow.m3u8":
+            time.sleep(3)
+            self.send_error(404)
+        elif self.path in HLS_FIXTURES:
+            body = HLS_FIXTURES[self.path].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class HlsFixtureServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+REAL_IS_SAFE_URL = extractor.is_safe_url
+
+
+def allow_loopback(url):
+    """is_safe_url() that also lets fetches reach the loopback fixture server."""
+    if urlparse(url).hostname == "127.0.0.1":
+        return True, None
+    return REAL_IS_SAFE_URL(url)
+
+
+class ResolveHlsFormatsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HlsFixtureServer(("127.0.0.1", 0), HlsFixtureHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(extractor, "is_safe_url", allow_loopback),
+            mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG, resolveHlsFormats=8,
+                                                            hlsPlaylistTimeout=1, resultCache=False)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def resolve(self, *paths):
+        output = {"formats": [{"format_id": p, "url": self.base + p, "protocol": "m3u8_native", "tbr": 800}
+                              for p in paths]}
+        extractor.resolve_hls_formats(output, make_request(playlist_mode=False))
+        return output, {f["format_id"]: f for f in output["formats"]}
+
+    def test_byte_ranged_playlist_has_exact_size(self):
+        output, formats = self.resolve("/ranged.m3u8")
+        fmt = formats["/ranged.m3u8"]
+        self.assertEqual(output["_hlsResolved"], 1)
+        self.assertEqual(fmt["_estimatedSize"], 3800)
+        self.assertTrue(fmt["_sizeExact"])
+        self.assertTrue(fmt["_singleFile"])
+        self.assertEqual(fmt["_fragmentCount"], 3)
+
+    def test_segment_playlist_size_is_estimated(self):
+        _, formats = self.resolve("/segments.m3u8")
+        fmt = formats["/segments.m3u8"]
+        self.assertEqual(fmt["_fragmentCount"], 5)
+        self.assertEqual(fmt["_totalDuration"], 20.0)
+        self.assertEqual(fmt["_estimatedSize"], 800 * 125 * 20)
+        self.assertNotIn("_sizeExact", fmt)
+
+    def test_unusable_playlists_leave_formats_alone(self):
+        started = time.monotonic()
+        output, formats = self.resolve("/master.m3u8", "/missing.m3u8", "/slow.m3u8", "/redirect-private.m3u8")
+        self.assertLess(time.monotonic() - started, 2.5)
+        self.assertEqual(output["_hlsResolved"], 0)
+        self.assertTrue(all("_fragmentCount" not in f for f in formats.values()))
+
+    def test_safe_redirect_is_followed(self):
+        _, formats = self.resolve("/redirect-local.m3u8")
+        self.assertEqual(formats["/redirect-local.m3u8"]["_estimatedSize"], 3800)
+
+    def test_loopback_is_refused(self):
+        with mock.patch.object(extractor, "is_safe_url", REAL_IS_SAFE_URL):
+            output, _ = self.resolve("/ranged.m3u8")
+        self.assertNotIn("_hlsResolved", output)
+
+    def test_fetches_share_a_bounded_pool(self):
+        paths = ["/segments.m3u8"] * (extractor.MAX_HLS_FORMATS * 3)
+        output = {"formats": [], "entries": [
+            {"formats": [{"url": self.base + p, "protocol": "m3u8_native"} for p in paths[i::3]]} for i in range(3)]}
+        real_pool = concurrent.futures.ThreadPoolExecutor
+        with mock.patch("concurrent.futures.ThreadPoolExecutor",
+                        side_effect=lambda max_workers: real_pool(max_workers)) as pool:
+            extractor.resolve_hls_formats(output, make_request(playlist_mode=False))
+        pool.assert_called_once_with(max_workers=extractor.MAX_HLS_FORMATS)
+        self.assertEqual(output["_hlsResolved"], len(paths))
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        saved = dict(vars(extractor.active))
+        self.addCleanup(vars(extractor.active).update, saved)
+
+    def test_urls_get_their_own_config_and_timings(self):
+        seen = {}
+        barrier = threading.Barrier(2, timeout=5)
+
+        def fake_extract(request, ydl=None, collector=None):
+            barrier.wait()  # Both URLs are in flight at once
+            seen[request["url"]] = (extractor.LARGE_CONFIG.get("maxPlaylistEntries"), extractor.active.timings)
+            return {"id": request["url"]}
+
+        urls = [PLAYLIST_URL, "https://www.youtube.com/watch?v=single"]
+        results = {}
+        with mock.patch.object(extractor, "extract", fake_extract):
+            extractor.run_batch(urls, {"config_override": {"playlistPageSize": 5, "timings": True, "batchWorkers": 2}},
+                                results.__setitem__)
+
+        self.assertEqual(seen[urls[0]][0], 5)
+        self.assertEqual(seen[urls[1]][0], extractor.DEFAULT_LARGE_CONFIG["maxPlaylistEntries"])
+        self.assertEqual(extractor.LARGE_CONFIG.get("maxPlaylistEntries"),
+                         extractor.DEFAULT_LARGE_CONFIG["maxPlaylistEntries"])
+        timings = [seen[url][1] for url in urls]
+        self.assertIsNot(timings[0], timings[1])
+        self.assertNotIn(extractor.active.timings, timings)
+        self.assertTrue(all("_timings" in output for output in results.values()))
+
+
+@unittest.skipUnless(hasattr(os, "getuid"), "POSIX permissions")
+class PrivateTempDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.path = os.path.join(self.tmp.name, f"fdm-smo-cache-{os.getuid()}")
+
+    def test_cache_round_trip(self):
+        extractor.cache_put("k", {"output": {"id": "x"}}, 60)
+        self.assertEqual(extractor.cache_get("k")["output"], {"id": "x"})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o700)
+
+    def test_shared_directory_disables_cache(self):
+        os.mkdir(self.path)
+        os.chmod(self.path, 0o777)
+        extractor.cache_put("k", {"output": {"id": "x"}}, 60)
+        self.assertEqual(os.listdir(self.path), [])
+        with open(os.path.join(self.path, "k.json"), "w") as fh:
+            fh.write('{"output": {"id": "planted"}, "expiresAt": 9999999999}')
+        self.assertIsNone(extractor.cache_get("k"))
+
+    def test_symlinked_directory_disables_cache(self):
+        target = os.path.join(self.tmp.name, "elsewhere")
+        os.mkdir(target, 0o700)
+        os.symlink(target, self.path)
+        extractor.cache_put("k", {"output": {"id": "x"}}, 60)
+        self.assertEqual(os.listdir(target), [])
+
+
+@unittest.skipUnless(hasattr(os, "getuid"), "POSIX permissions")
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = [
+            mock.patch.object(tempfile, "tempdir", self.tmp.name),
+            mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG,
+                                                            maxSiteExtractions=1, maxConcurrentExtractions=1)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.request = make_request(url="https://example.com/video", timeout=5)
+
+    def assert_slot_taken(self):
+        with self.assertRaises(extractor.ExtractionError) as caught:
+            with extractor.admission(self.request, time.monotonic() + 0.1):
+                pass
+        self.assertEqual(caught.exception.code, "TIMEOUT")
+
+    def test_timed_out_extraction_keeps_its_slot(self):
+        release = threading.Event()
+        ydl = mock.Mock()
+        ydl.extract_info.side_effect = lambda url, download: release.wait(5) and {"id": "x"}
+        with self.assertRaises(extractor.ExtractionError):
+            with extractor.admission(self.request):
+                extractor.run_ytdlp_inprocess(None, self.request["url"], None, 0.1, ydl, mock.Mock())
+        self.assert_slot_taken()
+        release.set()
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                with extractor.admission(self.request, time.monotonic() + 0.1):
+                    break
+            except extractor.ExtractionError:
+                self.assertLess(time.monotonic(), deadline)
+
+    def test_shared_lock_directory_is_not_used(self):
+        path = os.path.join(self.tmp.name, f"fdm-smo-locks-{os.getuid()}")
+        os.mkdir(path)
+        os.chmod(path, 0o777)
+        self.assertEqual(extractor.open_flight("k" * 32, time.monotonic() + 1), (None, 0.0))
+        with extractor.admission(self.request):
+            with extractor.admission(self.request, time.monotonic() + 0.1):
+                pass
+        self.assertEqual(os.listdir(path), [])
+
+
+class CompactHeadersTest(unittest.TestCase):
+    """compactHeaders output expands (in Python terms and in media_parser.js) to the per-format copies."""
+
+    COOKIES = "SID=abc; HSID=def"
+
+    def setUp(self):
+        saved = dict(vars(extractor.active))
+        self.addCleanup(vars(extractor.active).update, saved)
+        extractor.active.cookies_string = self.COOKIES
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def build(self, compact):
+        extractor.LARGE_CONFIG["compactHeaders"] = compact
+        return extractor.attach_cookies(extractor.process_single_entry(make_video()))
+
+    def test_formats_only_carry_differing_headers(self):
+        compact, full = self.build(True), self.build(False)
+        shared = compact["httpHeaders"]
+        self.assertEqual(shared["User-Agent"], "yt-agent")
+        self.assertEqual(compact["cookies"], self.COOKIES)
+        for compact_fmt, full_fmt in zip(compact["formats"], full["formats"]):
+            self.assertNotIn("cookies", compact_fmt)
+            self.assertEqual(full_fmt["cookies"], self.COOKIES)
+            self.assertEqual({**shared, **compact_fmt.get("httpHeaders", {})}, full_fmt["httpHeaders"])
+        by_id = {f["formatId"]: f for f in compact["formats"]}
+        self.assertEqual(by_id["18"]["httpHeaders"], {"X-Format": "18"})
+        self.assertNotIn("httpHeaders", by_id["140"])
+        self.assertNotIn("httpHeaders", full)
+
+    def test_resolved_playlist_entries_hold_their_own_cookies(self):
+        output = {"_type": "playlist", "entries": [self.build(True), {"_type": "url", "url": VIDEO_URL}]}
+        del output["entries"][0]["cookies"]
+        extractor.attach_cookies(output)
+        self.assertEqual(output["entries"][0]["cookies"], self.COOKIES)
+        self.assertNotIn("cookies", output["entries"][1])
+        self.assertNotIn("cookies", output)
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_media_parser_expands_headers(self):
+        full = self.build(False)
+        expanded = run_media_parser("expandHeaders", self.build(True))
+        self.assertNotIn("httpHeaders", expanded)
+        self.assertNotIn("cookies", expanded)
+        self.assertEqual([(f["httpHeaders"], f["cookies"]) for f in expanded["formats"]],
+                         [(f["httpHeaders"], f["cookies"]) for f in full["formats"]])
+
+
+class UrlExpiryTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_signed_url_expiry(self):
+        cases = {
+            f"https://r1.googlevideo.com/videoplayback?expire={SIGNED_EXPIRY}&ei=x": SIGNED_EXPIRY,
+            f"https://cdn.example.com/v.mp4?hdnts=st=1~exp={SIGNED_EXPIRY}~acl=/*~hmac=ab": SIGNED_EXPIRY,
+            "https://s3.example.com/v.mp4?X-Amz-Date=20300101T000000Z&X-Amz-Expires=3600": 1893459600,
+            f"https://cdn.example.com/v.mp4?exp={SIGNED_EXPIRY + 10}&expires={SIGNED_EXPIRY}": SIGNED_EXPIRY,
+            "https://cdn.example.com/v.mp4?expire=12345": None,
+            "https://cdn.example.com/v.mp4?expire=soon": None,
+            "https://cdn.example.com/v.mp4": None,
+            None: None,
+        }
+        for url, expected in cases.items():
+            self.assertEqual(extractor.get_url_expiry(url), expected, url)
+
+    def test_formats_report_their_expiry(self):
+        output = extractor.process_single_entry(make_video())
+        self.assertTrue(output["formats"])
+        for fmt in output["formats"]:
+            self.assertEqual(fmt["_expiresAt"], SIGNED_EXPIRY, fmt["formatId"])
+        with mock.patch.object(extractor.time, "time", return_value=SIGNED_EXPIRY - 1000):
+            self.assertEqual(extractor.output_ttl(output), 1000 - extractor.CACHE_EXPIRY_MARGIN)
+        with mock.patch.object(extractor.time, "time", return_value=0):
+            self.assertEqual(extractor.output_ttl(output), extractor.CACHE_MAX_TTL)
+
+    def test_refreshed_format_holds_only_fresh_urls(self):
+        output = extractor.build_refreshed_format(make_video(), "137")
+        self.assertEqual(output["_refreshedFormat"], "137")
+        self.assertEqual(output["formats"], [{
+            "url": f"https://cdn.example.com/137?expire={SIGNED_EXPIRY}", "protocol": "http_dash_segments",
+            "formatId": "137", "fragment_base_url": "https://cdn.example.com/137/", "_expiresAt": SIGNED_EXPIRY,
+        }])
+        self.assertEqual(output["httpHeaders"]["Referer"], VIDEO_URL)
+        for format_id in ("missing", "drm"):
+            with self.assertRaises(extractor.ExtractionError) as caught:
+                extractor.build_refreshed_format(make_video(), format_id)
+            self.assertEqual(caught.exception.code, "FORMAT_NOT_FOUND")
+
+    def test_refresh_bypasses_the_cache(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        extractor.LARGE_CONFIG.update(refreshFormat="18", resultCache=True)
+        with mock.patch.object(tempfile, "tempdir", tmp.name), \
+                mock.patch.object(extractor, "run_planned_extraction", return_value=make_video()), \
+                mock.patch.object(extractor, "cache_get") as cache_get, \
+                mock.patch.object(extractor, "cache_put") as cache_put:
+            output = extractor.extract(make_request(VIDEO_URL, playlist_mode=False))
+        cache_get.assert_not_called()
+        cache_put.assert_not_called()
+        self.assertEqual([f["formatId"] for f in output["formats"]], ["18"])
+
+
+class TimingsTest(unittest.TestCase):
+
+    CONFIG = {"resultCache": False, "singleFlight": False}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_json(self, **config):
+        code, text = run_main({**self.CONFIG, **config})
+        self.assertEqual(code, 0, text)
+        return json.loads(text)
+
+    def test_timings_block(self):
+        output = self.run_json(timings=True)
+        timings = output["_timings"]
+        self.assertTrue({"rank", "build", "validateFragments", "serialize", "total"} <= set(timings["phasesMs"]))
+        self.assertGreater(timings["bytes"]["output"], 0)
+        self.assertEqual(timings["counts"]["formatsSeen"], len(make_video()["formats"]))
+        self.assertEqual(timings["counts"]["formatsKept"], len(output["formats"]))
+        self.assertEqual(timings["counts"]["fragmentsSkipped"], 0)
+
+    def test_output_is_unchanged_without_timings(self):
+        timed_output = self.run_json(timings=True)
+        del timed_output["_timings"]
+        self.assertEqual(self.run_json(), timed_output)
+
+    def test_profile_dump(self):
+        import pstats
+
+        output = self.run_json(profileDump=True)
+        path = output["_profile"]
+        self.assertNotIn("_timings", output)
+        stats = pstats.Stats(path)
+        self.assertTrue(any(name == "process_single_entry" for _, _, name in stats.stats))
+
+
+# Parses a URL twice through parseMedia() with launchPythonScript answering
+# from the argument's list of outputs; reports the launches and results
+PARSE_TWICE_JS = """
+var launches = [];
+var outputs = argument;
+launchPythonScript = function (requestId, interactive, script, args) {
+  launches.push({script: script, args: script === "python/extractor.py" ? [JSON.parse(args[6])] : args});
+  return Promise.resolve({output: JSON.stringify(outputs.shift())});
+};
+qtJsNetworkProxyMgr = {proxyForUrl: function () { return ""; }};
+qtJsSystem = {defaultUserAgent: "UA"};
+var obj = {url: "https://www.youtube.com/watch?v=x", requestId: 1, interactive: false};
+function fail(err) { done({error: err, launches: launches}); }
+parseMedia(obj, false, true).then(function (first) {
+  parseMedia(obj, false, true).then(function (second) {
+    done({launches: launches, results: [first, second], state: ytdlpState});
+  }, fail);
+}, fail);
+"""
+
+
+class RuntimeCheckTest(unittest.TestCase):
+
+    INSTALLED = {"ytdlp": {"installed": True, "version": "2025.01.01"}}
+    MISSING = {"ytdlp": {"installed": False, "version": None}}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_checked(self, runtime):
+        with mock.patch.object(extractor, "check_runtime", return_value=runtime):
+            code, text = run_main({"runtimeCheck": True, "resultCache": False})
+        return code, json.loads(text)
+
+    def test_runtime_block_is_reported(self):
+        code, output = self.run_checked(self.INSTALLED)
+        self.assertEqual(code, 0)
+        self.assertEqual(output["_runtime"], self.INSTALLED)
+        self.assertTrue(output["formats"])
+
+    def test_missing_ytdlp_is_a_structured_error(self):
+        code, output = self.run_checked(self.MISSING)
+        self.assertEqual(code, 1)
+        self.assertEqual(output["errorCode"], "DEPENDENCY_MISSING")
+        self.assertEqual(output["_runtime"], self.MISSING)
+
+    def test_no_engine_is_dependency_missing(self):
+        with mock.patch.object(extractor, "load_ytdlp_module", return_value=None), \
+                mock.patch.object(extractor.shutil, "which", return_value=None), \
+                mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG)):
+            with self.assertRaises(extractor.ExtractionError) as caught:
+                extractor.select_engine()
+        self.assertEqual(caught.exception.code, "DEPENDENCY_MISSING")
+
+    def test_imported_module_reports_its_own_version(self):
+        import check_dependencies
+
+        fake = mock.Mock()
+        fake.version.__version__ = "2025.02.03"
+        with mock.patch.dict(sys.modules, {"yt_dlp": fake}), \
+                mock.patch.object(check_dependencies, "check_lazy_extractors", return_value={"present": True}), \
+                mock.patch.object(check_dependencies, "check_ytdlp") as check_ytdlp:
+            runtime = extractor.check_runtime()
+        check_ytdlp.assert_not_called()
+        self.assertEqual(runtime["ytdlp"]["version"], "2025.02.03")
+        self.assertEqual(runtime["ytdlp"]["source"], "module")
+
+        with mock.patch.dict(sys.modules), mock.patch.object(check_dependencies, "check_ytdlp",
+                                                             return_value={"installed": True}):
+            sys.modules.pop("yt_dlp", None)
+            self.assertEqual(extractor.check_runtime(), {"ytdlp": {"installed": True}})
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_plugin_folds_the_check_into_the_parse(self):
+        video = {"id": "x", "formats": [{"url": "https://cdn.example.com/v.mp4", "formatId": "18"}]}
+        result = run_media_parser_js(PARSE_TWICE_JS, [dict(video, _runtime=self.INSTALLED), video])
+        self.assertNotIn("error", result)
+        # One launch per parse: the first checks yt-dlp itself, the second trusts that check
+        self.assertEqual([(l["script"], l["args"][0]["runtimeCheck"]) for l in result["launches"]],
+                         [("python/extractor.py", True), ("python/extractor.py", False)])
+        self.assertNotIn("_runtime", result["results"][0])
+        self.assertTrue(result["state"]["installed"])
+        self.assertEqual(result["state"]["version"], "2025.01.01")
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_plugin_installs_after_dependency_missing(self):
+        video = {"id": "x", "formats": [{"url": "https://cdn.example.com/v.mp4", "formatId": "18"}]}
+        missing = {"error": "DEPENDENCY MISSING", "errorCode": "DEPENDENCY_MISSING", "_runtime": self.MISSING}
+        result = run_media_parser_js(PARSE_TWICE_JS, [
+            missing, {"installed": False}, {"success": True, "version": "2025.01.01"}, video, video])
+        self.assertNotIn("error", result)
+        self.assertEqual([(l["script"], l["args"][0]) for l in result["launches"]], [
+            ("python/extractor.py", dict(result["launches"][0]["args"][0], runtimeCheck=True)),
+            ("python/check_dependencies.py", "check"),
+            ("python/check_dependencies.py", "install"),
+            ("python/extractor.py", dict(result["launches"][3]["args"][0], runtimeCheck=False)),
+            ("python/extractor.py", dict(result["launches"][4]["args"][0], runtimeCheck=False)),
+        ])
+        self.assertEqual(result["results"][0]["id"], "x")
+
+
+class SubtitleProjectionTest(unittest.TestCase):
+
+    SUBS = {
+        "en-US": [{"url": "https://s.example.com/en.srv3", "ext": "srv3"},
+                  {"url": "https://s.example.com/en.vtt", "ext": "vtt", "fragments": []}],
+        "en-orig": [{"url": "https://s.example.com/orig.srt", "ext": "srt"}],
+        "fr": [{"url": "https://s.example.com/fr.vtt", "ext": "vtt"}],
+        "tlh": [{"url": "https://s.example.com/tlh.vtt", "ext": "vtt"}],
+    }
+
+    def project(self, languages):
+        config = dict(extractor.DEFAULT_LARGE_CONFIG, subtitleLanguages=languages)
+        with mock.patch.object(extractor, "LARGE_CONFIG", config):
+            return extractor.project_subtitles(self.SUBS)
+
+    def test_default_keeps_preferred_languages(self):
+        self.assertEqual(sorted(self.project(None)), ["en-US", "en-orig", "fr"])
+
+    def test_base_code_matches_regional_variants(self):
+        self.assertEqual(sorted(self.project(["en"])), ["en-US", "en-orig"])
+        self.assertEqual(sorted(self.project(["en-orig"])), ["en-orig"])
+
+    def test_all_keeps_every_language(self):
+        self.assertEqual(sorted(self.project("all")), sorted(self.SUBS))
+
+    def test_best_track_is_kept_without_unused_keys(self):
+        self.assertEqual(self.project(["en"]), {
+            "en-US": [{"url": "https://s.example.com/en.vtt", "ext": "vtt"}],
+            "en-orig": [{"url": "https://s.example.com/orig.srt", "ext": "srt"}],
+        })
+
+    def test_manual_subtitles_win_over_captions(self):
+        video = dict(make_video(), subtitles={"fr": self.SUBS["fr"]}, automatic_captions=self.SUBS)
+        config = dict(extractor.DEFAULT_LARGE_CONFIG, subtitleLanguages=None)
+        with mock.patch.object(extractor, "LARGE_CONFIG", config):
+            self.assertEqual(list(extractor.process_single_entry(video)["subtitles"]), ["fr"])
+            del video["subtitles"]
+            self.assertEqual(sorted(extractor.process_single_entry(video)["subtitles"]),
+                             ["en-US", "en-orig", "fr"])
+
+    def test_unwanted_captions_give_no_subtitles(self):
+        video = dict(make_video(), automatic_captions={"tlh": self.SUBS["tlh"]})
+        with mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG)):
+            self.assertNotIn("subtitles", extractor.process_single_entry(video))
+
+
+class ThumbnailSelectionTest(unittest.TestCase):
+
+    def test_matches_a_full_sort(self):
+        rng = random.Random(7)
+        # Few distinct sizes, so ties must keep their original order
+        thumbs = [{"url": f"https://i.example.com/{i}.jpg", "width": rng.choice((None, 120, 320, 640)),
+                   "height": rng.choice((None, 90, 180))} for i in range(60)]
+        for limit in (0, 1, 5, 20, 60, 100):
+            expected = sorted(thumbs, key=lambda t: (t["height"] or 0) * (t["width"] or 0))[:limit]
+            built = extractor.build_thumbnails(thumbs, limit)
+            self.assertEqual([t["url"] for t in built], [t["url"] for t in expected])
+            self.assertEqual([t["preference"] for t in built], list(range(len(expected))))
+
+    def test_max_thumbnails_caps_the_output(self):
+        video = make_video()
+        config = dict(extractor.DEFAULT_LARGE_CONFIG, maxThumbnails=2)
+        with mock.patch.object(extractor, "LARGE_CONFIG", config):
+            thumbnails = extractor.process_single_entry(video)["thumbnails"]
+        self.assertEqual([t["width"] for t in thumbnails], [120, 320])
+
+
+class PlaylistPagingTest(unittest.TestCase):
+
+    URL = "https://www.youtube.com/playlist?list=PL1"
+    ENTRIES = [{"id": f"v{i}", "url": f"https://www.youtube.com/watch?v=v{i}", "title": f"Video {i}"}
+               for i in range(5)]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def fetch_page(self, page, entries, **info):
+        """Run main() for a page request, yt-dlp having returned entries."""
+        config = dict(page, resultCache=False, singleFlight=False)
+        playlist = dict(info, _type="playlist", id="PL1", title="List", entries=entries)
+        code, text = run_main(config, url=self.URL, info=playlist)
+        self.assertEqual(code, 0, text)
+        return json.loads(text)
+
+    def test_cursor_round_trip(self):
+        cursor = extractor.encode_cursor(self.URL, 40, 20)
+        self.assertEqual(extractor.decode_cursor(cursor, self.URL), (40, 20))
+
+    def test_invalid_cursors_are_refused(self):
+        import base64
+
+        def forged(**fields):
+            payload = dict({"v": 1, "u": extractor._cursor_scope(self.URL), "o": 0, "n": 10}, **fields)
+            return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+        self.assertEqual(extractor.decode_cursor(forged(), self.URL), (0, 10))
+        for cursor in (extractor.encode_cursor("https://www.youtube.com/playlist?list=PL2", 0, 10),
+                       "not a cursor", "", "A" * 300, None, 5,
+                       forged(v=2), forged(o=-1), forged(n=0), forged(o="1"), forged(n=None)):
+            with self.assertRaises(extractor.ExtractionError) as caught:
+                extractor.decode_cursor(cursor, self.URL)
+            self.assertEqual(caught.exception.code, "INVALID_CURSOR", cursor)
+
+    def test_item_range_asks_for_one_entry_past_the_page(self):
+        config = dict(extractor.DEFAULT_LARGE_CONFIG, maxPlaylistEntries=50)
+        with mock.patch.object(extractor, "LARGE_CONFIG", config):
+            page = {"playlist_mode": True, "page": (100, 50)}
+            self.assertEqual(extractor.playlist_item_range(page), "101-151")
+            whole = {"playlist_mode": True, "page": None}
+            self.assertIsNone(extractor.playlist_item_range(whole))
+            self.assertEqual(extractor.playlist_item_range(whole, bounded=True), "1-51")
+            self.assertIsNone(extractor.playlist_item_range({"playlist_mode": False, "page": None}, True))
+
+    def test_pages_walk_the_playlist(self):
+        first = self.fetch_page({"playlistPageSize": 2}, self.ENTRIES[0:3])
+        self.assertEqual([e["title"] for e in first["entries"]], ["Video 0", "Video 1"])
+        self.assertEqual(first["_page"], {"offset": 0, "size": 2})
+        self.assertIsNone(first["_totalEntries"])
+        self.assertEqual(extractor.decode_cursor(first["_nextCursor"], self.URL), (2, 2))
+
+        second = self.fetch_page({"playlistCursor": first["_nextCursor"]}, self.ENTRIES[2:5])
+        self.assertEqual([e["title"] for e in second["entries"]], ["Video 2", "Video 3"])
+        self.assertEqual(extractor.decode_cursor(second["_nextCursor"], self.URL), (4, 2))
+
+        last = self.fetch_page({"playlistCursor": second["_nextCursor"]}, self.ENTRIES[4:5])
+        self.assertEqual([e["title"] for e in last["entries"]], ["Video 4"])
+        self.assertIsNone(last["_nextCursor"])
+        self.assertEqual(last["_totalEntries"], 5)
+
+    def test_known_count_is_reported(self):
+        page = self.fetch_page({"playlistOffset": 2, "playlistPageSize": 2}, self.ENTRIES[2:4], playlist_count=5)
+        self.assertEqual(page["_totalEntries"], 5)
+        self.assertEqual(extractor.decode_cursor(page["_nextCursor"], self.URL), (4, 2))
+
+    def test_cursor_for_another_playlist_fails_the_request(self):
+        cursor = extractor.encode_cursor("https://www.youtube.com/playlist?list=PL2", 2, 2)
+        code, text = run_main({"playlistCursor": cursor, "resultCache": False}, url=self.URL)
+        self.assertEqual(code, 1)
+        self.assertEqual(json.loads(text)["errorCode"], "INVALID_CURSOR")
+
+
+class StalledEntryStream(FakeEntryStream):
+    """A FakeEntryStream whose deadline passes after stall_after entries."""
+
+    stall_after = 0
+
+    def iter_entries(self, deadline):
+        for i, entry in enumerate(super().iter_entries(deadline)):
+            if i == self.stall_after:
+                self.truncated = "timeout"
+                return
+            yield entry
+
+
+class StreamPlaylistTest(unittest.TestCase):
+
+    IDS = [f"v{i}" for i in range(5)]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def stream(self, stream_class=FakeEntryStream, **config):
+        stream_class.playlist = self.IDS
+        config = dict(config, streamPlaylist=True, resultCache=False, singleFlight=False)
+        with mock.patch.object(extractor, "PlaylistEntryStream", stream_class):
+            return run_main(config, url=PLAYLIST_URL)
+
+    def lines(self, text):
+        self.assertTrue(text.endswith("\n"))
+        return [json.loads(line) for line in text.splitlines()]
+
+    def test_header_entries_and_trailer(self):
+        code, text = self.stream()
+        self.assertEqual(code, 0)
+        header, *entries, trailer = self.lines(text)
+        self.assertEqual({k: header[k] for k in ("_type", "_stream", "id", "title", "webpage_url")},
+                         {"_type": "playlist", "_stream": True, "id": "PLtest", "title": "Test",
+                          "webpage_url": PLAYLIST_URL})
+        self.assertEqual([e["title"] for e in entries], self.IDS)
+        self.assertEqual(trailer, {"_streamEnd": True, "_totalEntries": 5, "_entriesIncluded": 5})
+
+    def test_entry_cap_truncates_the_stream(self):
+        _, text = self.stream(maxPlaylistEntries=2)
+        header, *entries, trailer = self.lines(text)
+        self.assertEqual([e["title"] for e in entries], self.IDS[:2])
+        self.assertEqual(trailer["_truncated"], "maxPlaylistEntries")
+        self.assertEqual((trailer["_totalEntries"], trailer["_entriesIncluded"]), (5, 2))
+
+    def test_timeout_keeps_what_was_found(self):
+        StalledEntryStream.stall_after = 3
+        code, text = self.stream(StalledEntryStream)
+        self.assertEqual(code, 0)
+        header, *entries, trailer = self.lines(text)
+        self.assertEqual([e["title"] for e in entries], self.IDS[:3])
+        self.assertEqual(trailer["_truncated"], "timeout")
+        self.assertEqual(trailer["_entriesIncluded"], 3)
+
+    def test_timeout_before_any_entry_is_an_error(self):
+        StalledEntryStream.stall_after = 0
+        code, text = self.stream(StalledEntryStream)
+        self.assertEqual(code, 1)
+        self.assertEqual(json.loads(text)["errorCode"], "TIMEOUT")
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_plugin_folds_the_stream(self):
+        _, text = self.stream()
+        folded = run_media_parser("parseExtractorOutput", text)
+        self.assertNotIn("_stream", folded)
+        self.assertNotIn("_streamEnd", folded)
+        self.assertEqual([e["title"] for e in folded["entries"]], self.IDS)
+        self.assertEqual((folded["_totalEntries"], folded["_entriesIncluded"]), (5, 5))
+        self.assertNotIn("_truncated", folded)
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_plugin_keeps_a_cut_off_stream(self):
+        _, text = self.stream()
+        # Killed halfway through the fourth entry, before the trailer
+        lines = text.splitlines(keepends=True)
+        cut = "".join(lines[:4]) + lines[4][:len(lines[4]) // 2]
+        folded = run_media_parser("parseExtractorOutput", cut)
+        self.assertEqual([e["title"] for e in folded["entries"]], self.IDS[:3])
+        self.assertEqual(folded["_entriesIncluded"], 3)
+        self.assertEqual(folded["_truncated"], "incomplete")
+
+    @unittest.skipUnless(shutil.which("node"), "node")
+    def test_plugin_passes_regular_output_through(self):
+        output = {"id": "x", "formats": []}
+        self.assertEqual(run_media_parser("parseExtractorOutput", json.dumps(output)), output)
+
+
+class LazyFragmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def build(self, video, **config):
+        config = dict(extractor.DEFAULT_LARGE_CONFIG, compactFragments=False, **config)
+        with mock.patch.object(extractor, "LARGE_CONFIG", config):
+            return {f["formatId"]: f for f in extractor.process_single_entry(video)["formats"]}
+
+    def test_only_the_top_picks_are_expanded(self):
+        # 137 is the best video; 140 (not fragmented) beats the DASH audio 251
+        formats = self.build(make_video(), lazyFragments=True)
+        self.assertEqual(len(formats["137"]["fragments"]), 24)
+        self.assertNotIn("fragments", formats["251"])
+        self.assertEqual(formats["251"]["_fragmentCount"], 24)
+        self.assertTrue(formats["251"]["_fragmentsDeferred"])
+        self.assertEqual(formats["251"]["fragment_base_url"], "https://cdn.example.com/251/")
+
+    def test_top_audio_pick_is_expanded(self):
+        video = make_video()
+        video["formats"] = [f for f in video["formats"] if f["format_id"] != "140"]
+        formats = self.build(video, lazyFragments=True)
+        self.assertEqual(len(formats["251"]["fragments"]), 24)
+        self.assertNotIn("_fragmentsDeferred", formats["251"])
+
+    def test_everything_is_expanded_by_default(self):
+        formats = self.build(make_video())
+        for format_id in ("137", "251"):
+            self.assertEqual(len(formats[format_id]["fragments"]), 24)
+            self.assertNotIn("_fragmentsDeferred", formats[format_id])
+
+    def resolve(self, format_id, **info):
+        config = {"resolveFormat": format_id, "compactFragments": False, "resultCache": False}
+        code, text = run_main(config, info=dict(make_video(), **info))
+        return code, json.loads(text)
+
+    def test_resolve_format_returns_the_expanded_format(self):
+        code, output = self.resolve("251")
+        self.assertEqual(code, 0)
+        self.assertEqual(output["_resolvedFormat"], "251")
+        [resolved] = output["formats"]
+        self.assertEqual(resolved["fragments"], self.build(make_video())["251"]["fragments"])
+        with mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG)):
+            self.assertLessEqual(extractor.output_ttl(output), extractor.CACHE_RESOLVED_FORMAT_TTL)
+
+    def test_unknown_or_unusable_format_is_not_found(self):
+        for format_id in ("999", "drm"):
+            code, output = self.resolve(format_id)
+            self.assertEqual(code, 1)
+            self.assertEqual(output["errorCode"], "FORMAT_NOT_FOUND", format_id)
+
+    def test_resolve_format_needs_a_single_video(self):
+        code, output = self.resolve("251", _type="playlist", entries=[])
+        self.assertEqual(code, 1)
+        self.assertEqual(output["errorCode"], "FORMAT_NOT_FOUND")
+
+
+class RankFormatsTest(unittest.TestCase):
+    """rank_formats() must pick exactly what a full stable sort of the usable formats picks."""
+
+    def random_formats(self, rng, count):
+        formats = []
+        for n in range(count):
+            if formats and rng.random() < 0.3:
+                # Same features under another ID: an exact tie
+                formats.append(dict(rng.choice(formats), format_id=str(n), url=f"https://cdn.example.com/{n}"))
+                continue
+            vcodec = rng.choice(("none", "avc1.640028", "vp9", "av01.0.08M.08"))
+            acodec = rng.choice(("none", "mp4a.40.2", "opus")) if vcodec != "none" or rng.random() < 0.8 else "none"
+            formats.append({
+                "format_id": str(n), "url": f"https://cdn.example.com/{n}",
+                "vcodec": vcodec, "acodec": acodec, "ext": rng.choice(("mp4", "webm", "m4a")),
+                "protocol": rng.choice(("https", "m3u8_native", "http_dash_segments")),
+                "height": rng.choice((None, 360, 720, 1080)), "tbr": rng.choice((None, 128, 2500)),
+                "abr": rng.choice((None, 64, 128)), "filesize": rng.choice((None, 10 ** 6, 10 ** 9)),
+                "language": rng.choice((None, "en", "fr", "xx")), "preference": rng.choice((None, -1, 0, 1)),
+                "has_drm": rng.random() < 0.05,
+            })
+        return formats
+
+    def reference(self, formats, max_formats):
+        usable = [f for f in formats if extractor.is_format_usable(f)]
+        audio = [f for f in usable if f.get("acodec", "none") != "none" and f.get("vcodec", "none") == "none"]
+        top = sorted(usable, key=extractor.score_format, reverse=True)[:max_formats]
+        top_audio = sorted(audio, key=lambda f: ((f.get("abr") or 0) + extractor.get_codec_preference(f)
+                                                 + extractor.get_language_preference(f)), reverse=True)[:5]
+        return top, top_audio
+
+    def test_matches_a_full_stable_sort(self):
+        rng = random.Random(11)
+        saved = dict(vars(extractor.active))
+        self.addCleanup(vars(extractor.active).update, saved)
+        for profile in ("FASTEST", "BALANCED", "QUALITY"):
+            extractor.active.profile = profile
+            for max_formats in (0, 1, 5, 50):
+                for count in (0, 3, 40):
+                    formats = self.random_formats(rng, count)
+                    top, top_audio = extractor.rank_formats(formats, max_formats)
+                    expected_top, expected_audio = self.reference(formats, max_formats)
+                    case = (profile, max_formats, count)
+                    self.assertEqual([id(f) for f in top], [id(f) for f in expected_top], case)
+                    self.assertEqual([id(f) for f in top_audio], [id(f) for f in expected_audio], case)
+
+    def test_formats_are_not_modified(self):
+        video = make_video()
+        original = json.loads(json.dumps(video))
+        extractor.rank_formats(video["formats"], 50)
+        self.assertEqual(video, original)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = [
+            mock.patch.object(tempfile, "tempdir", self.tmp.name),
+            mock.patch.object(extractor, "check_runtime",
+                              return_value={"ytdlp": {"installed": True, "version": "2025.01.01"}}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def extract(self, url=VIDEO_URL, info=None, **config):
+        code, text = run_main(dict(config, resultCache=True, singleFlight=False), url=url, info=info)
+        return code, json.loads(text)
+
+    def test_settings_that_do_not_change_the_output_share_an_entry(self):
+        self.extract()
+        for config in ({"runtimeCheck": True}, {"timings": True}, {"playlistWorkers": 9},
+                       {"extractionTimeout": 30}, {"engine": "subprocess"}):
+            code, output = self.extract(**config)
+            self.assertEqual(code, 0)
+            self.assertTrue(output.get("_cached"), config)
+
+    def test_settings_that_change_the_output_do_not(self):
+        self.extract()
+        for config in ({"maxFormats": 1}, {"compactHeaders": False}, {"subtitleLanguages": "all"},
+                       {"extractionPlans": {"youtube": {"BALANCED": {"player_client": ["tv"]}}}}):
+            _, output = self.extract(**config)
+            self.assertNotIn("_cached", output, config)
+
+    def test_playlist_context_only_matters_through_the_playlist_mode(self):
+        playlist = {"_type": "playlist", "id": "PLtest", "title": "Test",
+                    "entries": [{"id": "a", "url": "https://www.youtube.com/watch?v=a", "title": "a"}]}
+        self.extract(PLAYLIST_URL, playlist)
+        _, output = self.extract(PLAYLIST_URL, playlist, isPlaylistContext=True)
+        self.assertTrue(output.get("_cached"))
+
+        # On a video URL it switches to playlist mode, which is a different result
+        self.extract()
+        _, output = self.extract(isPlaylistContext=True)
+        self.assertNotIn("_cached", output)
+
+    def test_cursor_and_offset_for_the_same_page_share_a_key(self):
+        def key(**config):
+            with mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG, **config)):
+                return extractor.cache_key(make_request(page=(2, 2)))
+
+        cursor = extractor.encode_cursor(PLAYLIST_URL, 2, 2)
+        self.assertEqual(key(playlistCursor=cursor), key(playlistOffset=2, playlistPageSize=2))
+        with mock.patch.object(extractor, "LARGE_CONFIG", dict(extractor.DEFAULT_LARGE_CONFIG)):
+            self.assertNotEqual(extractor.cache_key(make_request(page=(4, 2))),
+                                extractor.cache_key(make_request(page=(2, 2))))
+
+    def test_permanent_failures_are_remembered(self):
+        code, _ = self.extract(info=extractor.ExtractionError("ERROR: [youtube] vid: Video unavailable"))
+        self.assertEqual(code, 1)
+        code, output = self.extract()
+        self.assertEqual(code, 1)
+        self.assertIn("Video unavailable", output["error"])
+
+    def test_other_failures_are_retried(self):
+        for i, message in enumerate(("ERROR: [youtube] vid: The following content is not available on this app",
+                                     "ERROR: [youtube] vid: Requested format is not available",
+                                     "ERROR: Unable to download webpage: timed out")):
+            url = f"{VIDEO_URL}{i}"
+            self.extract(url, extractor.ExtractionError(message))
+            code, output = self.extract(url)
+            self.assertEqual(code, 0, message)
+            self.assertNotIn("_cached", output)
+
+    def test_permanent_failure_patterns(self):
+        for message in ("Private video. Sign in if you've been granted access", "This video is not available",
+                        "This video is not available in your country", "HTTP Error 404: Not Found",
+                        "This video has been removed by the uploader"):
+            self.assertTrue(extractor.is_permanent_failure(message), message)
+        for message in ("The following content is not available on this app", "Sign in to confirm you're not a bot",
+                        "HTTP Error 429: Too Many Requests", "Requested format is not available"):
+            self.assertFalse(extractor.is_permanent_failure(message), message)
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets")
+class QueryServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "service.sock")
+        patch = mock.patch.object(extractor, "service_socket_path", return_value=self.path)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def query(self, argv):
+        """query_service() against a stand-in service; returns (response, message it received)."""
+        received = []
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(self.path)
+        server.listen(1)
+
+        def answer():
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as reader:
+                received.append(json.loads(reader.readline()))
+                conn.sendall(b'{"id": "x"}\n')
+
+        thread = threading.Thread(target=answer, daemon=True)
+        thread.start()
+        response = extractor.query_service(extractor.parse_args(argv))
+        thread.join(5)
+        return response, received[0]
+
+    def test_relative_cookies_file_is_sent_absolute(self):
+        response, message = self.query(["extractor.py", VIDEO_URL, "BALANCED", "cookies.txt", "", "", "", "{}"])
+        self.assertEqual(response, {"id": "x"})
+        self.assertEqual(message["cookiesFile"], os.path.abspath("cookies.txt"))
+        self.assertTrue(os.path.isabs(message["cookiesFile"]))
+
+    def test_no_cookies_file_is_sent_as_none(self):
+        _, message = self.query(["extractor.py", VIDEO_URL, "BALANCED", "", "", "", "", "{}"])
+        self.assertIsNone(message["cookiesFile"])
+
+
+if __name__ == "__main__":
+    unittest.main()
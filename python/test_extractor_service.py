@@ -0,0 +1,175 @@
+"""
+Tests for extractor_service.py, with a stand-in yt-dlp module.
+
+Run from the python/ directory:
+  python -m pytest test_extractor_service.py
+"""
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import extractor_service
+
+
+class FakeYoutubeDL:
+    """Returns five progressive formats per URL after a short delay."""
+
+    delay = 0.3
+
+    def __init__(self, params):
+        self.params = dict(params)
+
+    def extract_info(self, url, download=False):
+        time.sleep(self.delay)
+        return {"id": "x", "title": "T", "webpage_url": url, "duration": 10, "formats": [
+            {"format_id": str(i), "url": f"https://cdn.example.com/{i}.mp4", "ext": "mp4", "vcodec": "avc1",
+             "acodec": "mp4a", "protocol": "https", "tbr": 100 * i, "height": 100 * i} for i in range(1, 6)]}
+
+    def close(self):
+        pass
+
+
+class FakeYtdlp:
+    YoutubeDL = FakeYoutubeDL
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets")
+class ServeSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.path = os.path.join(self.tmp.name, "service.sock")
+        self.pool = extractor_service.YoutubeDLPool(FakeYtdlp)
+        self.server = threading.Thread(target=extractor_service.serve_socket,
+                                       args=(self.pool, self.path, 1), daemon=True)
+        self.server.start()
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.path):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.server.join(5)
+
+    def query(self, message):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.path)
+            client.sendall((json.dumps(message) + "\n").encode("utf-8"))
+            return json.loads(client.makefile("rb").readline() or b"null")
+
+    def test_concurrent_requests_keep_their_own_settings(self):
+        results = {}
+
+        def run(name, max_formats):
+            results[name] = self.query({
+                "id": name, "url": f"https://example.com/{name}", "userAgent": f"agent-{name}",
+                "config": {"maxFormats": max_formats, "resultCache": False, "timings": name == "a"},
+            })
+
+        threads = [threading.Thread(target=run, args=(name, count)) for name, count in (("a", 1), ("b", 3))]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        # Both extractions overlapped instead of running back to back
+        self.assertLess(time.monotonic() - started, FakeYoutubeDL.delay * 2)
+
+        for name, count in (("a", 1), ("b", 3)):
+            output = results[name]
+            self.assertEqual(output["_requestId"], name)
+            self.assertEqual(output["httpHeaders"]["User-Agent"], f"agent-{name}")
+            self.assertEqual(len(output["formats"]), count)
+        self.assertIn("_timings", results["a"])
+        self.assertNotIn("_timings", results["b"])
+
+    def test_second_service_leaves_the_first_running(self):
+        second = threading.Thread(target=extractor_service.serve_socket,
+                                  args=(extractor_service.YoutubeDLPool(FakeYtdlp), self.path, 1), daemon=True)
+        second.start()
+        second.join(0.5)
+        self.assertFalse(second.is_alive())
+        output = self.query({"url": "https://example.com/a", "config": {"resultCache": False}})
+        self.assertEqual(len(output["formats"]), 5)
+
+    def test_oversized_request_line_closes_connection(self):
+        with mock.patch.object(extractor_service, "MAX_REQUEST_LINE", 64):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(self.path)
+                client.sendall(b'{"url": "' + b"x" * 200)
+                self.assertEqual(client.makefile("rb").readline(), b"")
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets")
+class StaleSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(tempfile, "tempdir", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.path = os.path.join(self.tmp.name, "service.sock")
+
+    def test_socket_of_a_dead_service_is_replaced(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as dead:
+            dead.bind(self.path)
+        server = threading.Thread(target=extractor_service.serve_socket,
+                                  args=(extractor_service.YoutubeDLPool(FakeYtdlp), self.path, 1), daemon=True)
+        server.start()
+        self.addCleanup(server.join, 5)
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(self.path)
+                    client.sendall(b'{"url": "https://example.com/a", "config": {"resultCache": false}}\n')
+                    output = json.loads(client.makefile("rb").readline())
+                break
+            except ConnectionRefusedError:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+        self.assertEqual(len(output["formats"]), 5)
+
+
+class YoutubeDLPoolTest(unittest.TestCase):
+
+    def request(self, proxy=None):
+        return {"proxy_url": proxy, "cookies_file": None, "user_agent": None, "playlist_mode": False, "page": None}
+
+    def test_instance_serves_one_request_at_a_time(self):
+        pool = extractor_service.YoutubeDLPool(FakeYtdlp)
+        first = pool.acquire(self.request())
+        second = pool.acquire(self.request())
+        self.assertIsNot(first, second)
+        pool.release(self.request(), first)
+        self.assertIs(pool.acquire(self.request()), first)
+
+    def test_idle_instances_are_bounded(self):
+        pool = extractor_service.YoutubeDLPool(FakeYtdlp, max_size=2)
+        requests = [self.request(f"http://proxy{i}.example.com") for i in range(4)]
+        held = [pool.acquire(request) for request in requests]
+        for request, pooled in zip(requests, held):
+            pool.release(request, pooled)
+        self.assertEqual(sum(len(idle) for idle in pool.instances.values()), 2)
+        self.assertIs(pool.acquire(requests[3]), held[3])
+
+    def test_timed_out_instance_is_not_reused(self):
+        pool = extractor_service.YoutubeDLPool(FakeYtdlp)
+        pooled = pool.acquire(self.request())
+        pool.release(self.request(), pooled, healthy=False)
+        self.assertIsNot(pool.acquire(self.request()), pooled)
+
+
+if __name__ == "__main__":
+    unittest.main()